@@ -0,0 +1,130 @@
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class AckManager(object):
+    """Queues ack ids per subscription and acknowledges them in batches from
+    a background thread, so consumers don't wait on an acknowledge request
+    for every pull. Pending acks are flushed once max_batch of them are
+    queued or every interval seconds, whichever comes first.
+    """
+
+    def __init__(self, client, max_batch=1000, interval=0.1):
+        """Args:
+            client: the PubSubClient used to send acknowledgements.
+            max_batch: the maximum number of ack ids sent in one request.
+            interval: the maximum number of seconds an ack id is queued
+                      before it is sent.
+        """
+
+        self.client = client
+        self.max_batch = max_batch
+        self.interval = interval
+
+        self.pending = 0
+        self.flushed = 0
+        self.failed = 0
+
+        self._cond = threading.Condition()
+        self._queued = {}
+        self._sending = 0
+        self._flush_requested = False
+        self._closed = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='pubsub-ack-manager')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, subscription, ack_ids):
+        """Queue ack ids to be acknowledged.
+
+        Args:
+            subscription: the full name of the subscription the messages were
+                          pulled from.
+            ack_ids: a list of ack ids to acknowledge.
+        """
+
+        if not ack_ids:
+            return
+
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('AckManager has been closed')
+            self._queued.setdefault(subscription, []).extend(ack_ids)
+            self.pending += len(ack_ids)
+            if self.pending >= self.max_batch:
+                self._cond.notify_all()
+
+    def flush(self):
+        """Send all queued acks and block until they have been sent."""
+
+        with self._cond:
+            self._flush_requested = True
+            self._cond.notify_all()
+            while self.pending or self._sending:
+                self._cond.wait()
+
+    def close(self):
+        """Send all queued acks and stop the background thread."""
+
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def stats(self):
+        """Return a dict of the pending, flushed and failed ack counts."""
+
+        with self._cond:
+            return {
+                'pending': self.pending,
+                'flushed': self.flushed,
+                'failed': self.failed,
+            }
+
+    def _take(self):
+        with self._cond:
+            deadline = time.time() + self.interval
+            while not self._closed and self.pending < self.max_batch and \
+                    not self._flush_requested:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            self._flush_requested = False
+            queued, self._queued = self._queued, {}
+            self._sending = self.pending
+            self.pending = 0
+            return queued, self._closed
+
+    def _run(self):
+        while True:
+            queued, closed = self._take()
+            for subscription, ack_ids in queued.items():
+                for i in range(0, len(ack_ids), self.max_batch):
+                    self._send(subscription, ack_ids[i:i + self.max_batch])
+
+            with self._cond:
+                self._sending = 0
+                self._cond.notify_all()
+            if closed:
+                return
+
+    def _send(self, subscription, ack_ids):
+        try:
+            self.client._send_acknowledge(subscription, ack_ids)
+        except Exception:
+            logger.exception('Failed to acknowledge %d messages for %s',
+                             len(ack_ids), subscription)
+            with self._cond:
+                self.failed += len(ack_ids)
+        else:
+            with self._cond:
+                self.flushed += len(ack_ids)
@@ -0,0 +1,468 @@
+"""An asyncio Pub/Sub client. Requires Python 3.7+ and, for the default
+transport, aiohttp.
+"""
+
+import asyncio
+import base64
+import inspect
+import json
+import logging
+from urllib.parse import quote
+from urllib.parse import urlsplit
+
+from googleapiclient import errors
+import httplib2
+
+from pubsub.client import _credentials
+from pubsub.client import _decode_data
+from pubsub.client import PUBSUB_SCOPE
+from pubsub.push import _STATUSES
+from pubsub.push import _token_matches
+from pubsub.push import decode_push
+from pubsub.push import MAX_BODY_SIZE
+
+logger = logging.getLogger(__name__)
+
+API_ROOT = 'https://www.googleapis.com/pubsub/v1beta1/'
+
+
+def get_async_client(project_id, credentials=None, service_account=None,
+                     private_key=None, transport=None):
+    """Return an instance of AsyncPubSubClient. Either AssertionCredentials or
+    a service account and private key combination need to be provided in
+    order to authenticate requests.
+
+    Args:
+        project_id: the project id.
+        credentials: an AssertionCredentials instance to authenticate
+                     requests.
+        service_account: the Google API service account name.
+        private_key: the private key associated with the service account in
+                     PKCS12 or PEM format.
+        transport: the transport used to send requests, defaults to an
+                   AiohttpTransport.
+
+    Returns:
+        an instance of AsyncPubSubClient.
+    """
+
+    if not credentials and not (service_account and private_key):
+        raise Exception('AssertionCredentials or service account and private'
+                        'key need to be provided')
+
+    if not credentials:
+        credentials = _credentials()(
+            service_account, private_key, scope=PUBSUB_SCOPE)
+
+    return AsyncPubSubClient(credentials, project_id, transport=transport)
+
+
+class AiohttpTransport(object):
+    """Sends requests through a shared aiohttp session, which keeps up to
+    max_connections keep-alive connections open for reuse.
+    """
+
+    def __init__(self, max_connections=100, timeout=90):
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._session = None
+
+    async def request(self, method, url, headers, body=None):
+        """Send a request and return a tuple of the response status and
+        body.
+        """
+
+        if self._session is None:
+            import aiohttp
+
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+        async with self._session.request(method, url, data=body,
+                                         headers=headers) as resp:
+            return resp.status, await resp.read()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class AsyncPubSubClient(object):
+    """A Pub/Sub client whose operations are coroutines, so many requests
+    can be in flight at once on a single event loop.
+    """
+
+    def __init__(self, credentials, project_id, transport=None,
+                 api_root=API_ROOT):
+        self.credentials = credentials
+        self.project_id = project_id
+        self.transport = transport or AiohttpTransport()
+        self.api_root = api_root
+        self._refresh_lock = None
+
+    async def create_topic(self, name):
+        """Create a topic if it doesn't exist. This is idempotent, meaning if
+        the topic already exists, it has no effect.
+
+        Args:
+            name: the name of the topic to create.
+
+        Raises:
+            HttpError if the create failed.
+        """
+
+        name = self._full_topic_name(name)
+        try:
+            await self._request('GET', 'topics/%s' % quote(name))
+        except errors.HttpError as e:
+            if e.resp.status == 404:
+                await self._request('POST', 'topics', {'name': name})
+            else:
+                raise
+
+    async def delete_topic(self, name):
+        """Delete a topic. This is idempotent, meaning if the topic doesn't
+        exist, it has no effect.
+
+        Args:
+            name: the name of the topic to delete.
+
+        Raises:
+            HttpError if the delete failed.
+        """
+
+        name = self._full_topic_name(name)
+        try:
+            await self._request('DELETE', 'topics/%s' % quote(name))
+        except errors.HttpError as e:
+            if e.resp.status == 404:
+                return
+            raise
+
+    async def subscribe(self, name, topic, endpoint=None):
+        """Create a subscription to a topic if it doesn't exist. This is
+        idempotent, meaning if the subscription already exists, it has no
+        effect.
+
+        Args:
+            name: the name of the subscription.
+            topic: the name of the topic to subscribe to.
+            endpoint: an endpoint the subscription should POST to when messages
+                      are received.
+
+        Raises:
+            HttpError if the subscription creation failed.
+        """
+
+        name = self._full_subscription_name(name)
+        try:
+            await self._request('GET', 'subscriptions/%s' % quote(name))
+        except errors.HttpError as e:
+            if e.resp.status == 404:
+                body = {
+                    'name': name,
+                    'topic': self._full_topic_name(topic),
+                    'pushConfig': {
+                        'pushEndpoint': endpoint,
+                    }
+                }
+                await self._request('POST', 'subscriptions', body)
+            else:
+                raise
+
+    async def unsubscribe(self, name):
+        """Delete a subscription to a topic if it exists. This is idempotent,
+        meaning if the subscription doesn't exist, it has no effect.
+
+        Args:
+            name: the name of the subscription to delete.
+
+        Raises:
+            HttpError is the subscription deletion failed.
+        """
+
+        name = self._full_subscription_name(name)
+        try:
+            await self._request('DELETE', 'subscriptions/%s' % quote(name))
+        except errors.HttpError as e:
+            if e.resp.status == 404:
+                return
+            raise
+
+    async def publish(self, topic, message):
+        """Publish a message to a topic.
+
+        Args:
+            topic: the name of the topic to publish to.
+            message: the body of the message as bytes.
+
+        Raises:
+            HttpError if the publish failed.
+        """
+
+        body = {
+            'topic': self._full_topic_name(topic),
+            'message': {
+                'data': base64.b64encode(message).decode('ascii'),
+            }
+        }
+        await self._request('POST', 'topics/publish', body)
+
+    async def pull(self, subscription, block=False):
+        """Pull a single message from a topic subscription.
+
+        Args:
+            subscription: the name of the subscription to pull from.
+            block: bool indicating if the pull should block until a message is
+                   available or a timeout occurs. If false, pull will return
+                   immediately.
+
+        Returns:
+            the message data, decoded with the codec it was published with,
+            or None if no message was retrieved.
+
+        Raises:
+            HttpError if the pull failed, or the error raised decoding the
+            message, which is then left unacknowledged to be redelivered.
+        """
+
+        subscription = self._full_subscription_name(subscription)
+        body = {'subscription': subscription, 'returnImmediately': not block}
+        resp = await self._request('POST', 'subscriptions/pull', body)
+        message = resp.get('pubsubEvent', {}).get('message')
+
+        if message:
+            # The message is only acknowledged once it has been decoded, so
+            # it isn't lost if decoding fails.
+            data = _decode_data(message)
+            ack_body = {'subscription': subscription,
+                        'ackId': [resp.get('ackId')]}
+            await self._request('POST', 'subscriptions/acknowledge', ack_body)
+            return data
+
+        return None
+
+    async def close(self):
+        """Close the connections held by the transport."""
+
+        await self.transport.close()
+
+    async def _request(self, method, path, body=None):
+        headers = {
+            'authorization': 'Bearer %s' % await self._access_token(),
+            'accept': 'application/json',
+        }
+        if body is not None:
+            headers['content-type'] = 'application/json'
+            body = json.dumps(body)
+
+        url = self.api_root + path
+        status, content = await self.transport.request(method, url, headers,
+                                                       body)
+        if status >= 300:
+            raise errors.HttpError(httplib2.Response({'status': status}),
+                                   content, uri=url)
+        if not content:
+            return {}
+        return json.loads(content.decode('utf-8'))
+
+    async def _access_token(self):
+        if self.credentials.access_token and \
+                not self.credentials.access_token_expired:
+            return self.credentials.access_token
+
+        if self._refresh_lock is None:
+            self._refresh_lock = asyncio.Lock()
+
+        # Refreshing makes a blocking token request, so it runs in the
+        # default executor and only one coroutine performs it at a time.
+        async with self._refresh_lock:
+            if not self.credentials.access_token or \
+                    self.credentials.access_token_expired:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, self.credentials.refresh,
+                                           httplib2.Http())
+        return self.credentials.access_token
+
+    def _full_topic_name(self, name):
+        return '/topics/%s/%s' % (self.project_id, name)
+
+    def _full_subscription_name(self, name):
+        return '/subscriptions/%s/%s' % (self.project_id, name)
+
+
+class AsyncPushServer(object):
+    """An HTTP server receiving messages pushed to a subscription's endpoint
+    on an event loop, the asyncio counterpart of pubsub.push.PushApp.
+    Messages are decoded the same way pull does and passed to a coroutine
+    handler. A message is acknowledged by returning 204 once the handler
+    returns; if the handler raises, 500 is returned so the message is
+    redelivered. While max_concurrency messages are being handled, further
+    requests get 429, which makes the push system back off. The limit is
+    checked before the body is decoded, so rejecting a request is cheap, and
+    bodies larger than max_body_size get 413 and the connection is closed.
+    """
+
+    def __init__(self, handler, host='0.0.0.0', port=8080, max_concurrency=100,
+                 max_pending=0, pending_timeout=1, token=None,
+                 as_memoryview=False, max_body_size=MAX_BODY_SIZE):
+        """Args:
+            handler: a coroutine function invoked with each Message.
+            host: the interface to listen on.
+            port: the port to listen on, 0 picks a free one.
+            max_concurrency: the maximum number of messages handled at once.
+            max_pending: the maximum number of requests waiting for one of
+                         the max_concurrency slots.
+            pending_timeout: the maximum number of seconds a request waits
+                             for a slot before being rejected.
+            token: if provided, requests must carry it in a token query
+                   parameter, as set in the subscription's push endpoint,
+                   or they get 403.
+            as_memoryview: bool indicating if raw message data should be
+                           passed to the handler as memoryviews.
+            max_body_size: the maximum size in bytes of a request body.
+        """
+
+        self.handler = handler
+        self.host = host
+        self.port = port
+        self.max_concurrency = max_concurrency
+        self.max_pending = max_pending
+        self.pending_timeout = pending_timeout
+        self.token = token
+        self.as_memoryview = as_memoryview
+        self.max_body_size = max_body_size
+
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.active = 0
+        self._pending = 0
+        self._slots = None
+        self._server = None
+
+    async def start(self):
+        """Start listening. The port picked is stored in port."""
+
+        self._slots = asyncio.Semaphore(self.max_concurrency)
+        self._server = await asyncio.start_server(self._serve, self.host,
+                                                  self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        """Stop listening and close the server."""
+
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    def stats(self):
+        """Return a dict of the number of messages processed, failed and
+        rejected and the number being handled.
+        """
+
+        return {
+            'processed': self.processed,
+            'failed': self.failed,
+            'rejected': self.rejected,
+            'active': self.active,
+        }
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, version = \
+                    request_line.decode('latin-1').split(' ', 2)
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length') or 0)
+                keep_alive = version.strip() == 'HTTP/1.1' and \
+                    headers.get('connection', '').lower() != 'close'
+                if length > self.max_body_size:
+                    # The body is left unread, so the connection can't be
+                    # reused.
+                    status = 413
+                    keep_alive = False
+                else:
+                    status = await self._handle(method, target, reader,
+                                                length)
+
+                writer.write(('HTTP/1.1 %s\r\nContent-Length: 0\r\n%s\r\n' % (
+                    _STATUSES[status],
+                    '' if keep_alive else 'Connection: close\r\n')).encode(
+                        'latin-1'))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            # A malformed request or dropped connection; the push system
+            # redelivers whatever wasn't acknowledged.
+            pass
+        finally:
+            writer.close()
+
+    async def _handle(self, method, target, reader, length):
+        # The body is always read, so the connection can be reused, but it
+        # is only decoded once the request has a slot.
+        body = await reader.readexactly(length) if length else b''
+        if method != 'POST':
+            return 405
+        if self.token is not None and \
+                not _token_matches(self.token, urlsplit(target).query):
+            return 403
+
+        if not await self._acquire():
+            self.rejected += 1
+            return 429
+        self.active += 1
+        try:
+            try:
+                message = decode_push(body, self.as_memoryview)
+            except ValueError:
+                logger.exception('Rejecting invalid push request')
+                return 400
+
+            try:
+                result = self.handler(message)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception:
+                logger.exception('Handler failed for %r', message)
+                self.failed += 1
+                return 500
+        finally:
+            self.active -= 1
+            self._slots.release()
+
+        self.processed += 1
+        return 204
+
+    async def _acquire(self):
+        if not self._slots.locked():
+            await self._slots.acquire()
+            return True
+        if self._pending >= self.max_pending:
+            return False
+
+        self._pending += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(),
+                                   self.pending_timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._pending -= 1
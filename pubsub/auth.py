@@ -0,0 +1,221 @@
+import calendar
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+logger = logging.getLogger(__name__)
+
+# Tokens without an expiry are assumed to last this many seconds.
+DEFAULT_TOKEN_LIFETIME = 3600
+
+
+def default_token_path(credentials):
+    """Return the default token cache file for credentials, which is keyed by
+    the service account and scope so different identities don't share
+    tokens.
+    """
+
+    key = '%s:%s' % (getattr(credentials, 'service_account_name', ''),
+                     getattr(credentials, 'scope', ''))
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return os.path.join(os.path.expanduser('~'), '.cache', 'pubsub-python',
+                        'token-%s.json' % digest)
+
+
+class SharedTokenCredentials(object):
+    """Wraps oauth2client credentials so access tokens are shared between
+    every process using the same token file. Refreshes are serialized with
+    a file lock, so only one process mints a token and the others read it
+    from the file. A background thread refreshes the token refresh_margin
+    seconds before it expires, so requests don't wait on a refresh once the
+    first token has been obtained.
+    """
+
+    def __init__(self, credentials, path=None, refresh_margin=300):
+        """Args:
+            credentials: the oauth2client credentials used to mint tokens.
+            path: the token cache file, defaults to
+                  default_token_path(credentials).
+            refresh_margin: the number of seconds before a token expires that
+                            it is refreshed in the background.
+        """
+
+        self.credentials = credentials
+        self.path = path or default_token_path(credentials)
+        self.refresh_margin = refresh_margin
+
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires_at = 0
+        self._refresher = None
+        self._closed = threading.Event()
+
+    @property
+    def access_token(self):
+        return self.get_access_token()
+
+    @property
+    def access_token_expired(self):
+        return self._token is None or self._expires_at <= time.time()
+
+    def get_access_token(self):
+        """Return a valid access token, reading it from the shared file or
+        refreshing it only if the token held in memory has expired.
+        """
+
+        token = self._token
+        if token is not None and self._expires_at > time.time():
+            return token
+        return self._load()
+
+    def refresh(self, http=None):
+        """Replace the current token, even if it hasn't expired, unless
+        another process has already stored a newer one.
+        """
+
+        self._load(stale=self._token)
+
+    def authorize(self, http):
+        """Authorize an httplib2.Http so every request carries the shared
+        access token. A request rejected with 401 is retried once with a
+        refreshed token.
+        """
+
+        request = http.request
+
+        def authorized_request(uri, method='GET', body=None, headers=None,
+                               *args, **kwargs):
+            token = self.get_access_token()
+            resp, content = request(uri, method, body,
+                                    self._headers(headers, token), *args,
+                                    **kwargs)
+            if resp.status == 401:
+                token = self._load(stale=token)
+                resp, content = request(uri, method, body,
+                                        self._headers(headers, token), *args,
+                                        **kwargs)
+            return resp, content
+
+        http.request = authorized_request
+        return http
+
+    def close(self):
+        """Stop the background refresher."""
+
+        self._closed.set()
+
+    def _headers(self, headers, token):
+        headers = dict(headers or {})
+        headers['authorization'] = 'Bearer %s' % token
+        return headers
+
+    def _load(self, stale=None):
+        with self._lock:
+            now = time.time()
+            if self._token is not None and self._token != stale and \
+                    self._expires_at > now:
+                return self._token
+
+            with self._file_lock():
+                token, expires_at = self._read()
+                # A token stored by another process is used unless it is
+                # about to expire or is the stale one being replaced.
+                if token is None or expires_at - self.refresh_margin <= now \
+                        or token == stale:
+                    token, expires_at = self._mint()
+                    self._write(token, expires_at)
+
+            self._token = token
+            self._expires_at = expires_at
+            self._start_refresher()
+            return token
+
+    def _mint(self):
+        import httplib2
+
+        self.credentials.refresh(httplib2.Http())
+        expiry = getattr(self.credentials, 'token_expiry', None)
+        if expiry is not None:
+            expires_at = calendar.timegm(expiry.utctimetuple())
+        else:
+            expires_at = time.time() + DEFAULT_TOKEN_LIFETIME
+        return self.credentials.access_token, expires_at
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                cached = json.load(f)
+            return cached['access_token'], float(cached['expires_at'])
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None, 0
+
+    def _write(self, token, expires_at):
+        directory = os.path.dirname(self.path)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory, 0o700)
+            fd, tmp_path = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'access_token': token, 'expires_at': expires_at},
+                          f)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError):
+            logger.exception('Failed to write token cache %s', self.path)
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        if fcntl is None:
+            yield
+            return
+
+        directory = os.path.dirname(self.path)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory, 0o700)
+            lock_file = open(self.path + '.lock', 'a')
+        except (IOError, OSError):
+            logger.exception('Failed to lock token cache %s', self.path)
+            yield
+            return
+
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            lock_file.close()
+
+    def _start_refresher(self):
+        # Must be called with self._lock held.
+        if self._refresher is None or not self._refresher.is_alive():
+            self._refresher = threading.Thread(
+                target=self._refresh_loop, name='pubsub-token-refresher')
+            self._refresher.daemon = True
+            self._refresher.start()
+
+    def _refresh_loop(self):
+        while True:
+            # Jitter spreads the refreshes of many processes sharing the file
+            # so most of them find a fresh token already stored.
+            delay = self._expires_at - self.refresh_margin - time.time()
+            delay += random.uniform(0, min(30, self.refresh_margin / 10.0))
+            if self._closed.wait(max(delay, 1)):
+                return
+            if self._expires_at - self.refresh_margin > time.time():
+                continue
+            try:
+                self._load(stale=self._token)
+            except Exception:
+                logger.exception('Failed to refresh access token')
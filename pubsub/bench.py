@@ -0,0 +1,384 @@
+"""Benchmarks publish, pull, acknowledge and admin throughput and latency
+against an in-process pubsub.emulator.Emulator, so runs measure the client
+rather than the network. Run python -m pubsub.bench --help for the options.
+
+Results are written as JSON, so runs made with different versions of the
+library can be compared with --compare.
+"""
+
+import argparse
+import hashlib
+import itertools
+import json
+import platform
+import sys
+import threading
+import time
+
+from pubsub.client import PubSubClient
+from pubsub.emulator import Emulator
+from pubsub.metrics import clock
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+WORKLOADS = ('publish', 'publish_batch', 'batch_publisher', 'pull', 'ack',
+             'admin')
+
+PROJECT = 'bench'
+TOPIC = 'bench-topic'
+SUBSCRIPTION = 'bench-subscription'
+
+# Workloads which send batch_size messages per request. The others send a
+# single message or resource per request.
+_BATCHED = ('publish_batch', 'batch_publisher', 'pull', 'ack')
+
+
+def _payload(size):
+    # Deterministic, poorly compressible data so runs are reproducible.
+    block = hashlib.sha256(b'pubsub-bench').digest()
+    return (block * (size // len(block) + 1))[:size]
+
+
+def _shares(total, parts):
+    return [total // parts + (1 if i < total % parts else 0)
+            for i in range(parts)]
+
+
+def _timed(fn, count):
+    latencies = []
+    for _ in range(count):
+        start = clock()
+        fn()
+        latencies.append(clock() - start)
+    return latencies
+
+
+def _publish(client, payload, count, batch_size, concurrency):
+    tasks = [lambda n=n: (_timed(lambda: client.publish(TOPIC, payload), n),
+                          n)
+             for n in _shares(count, concurrency)]
+    return tasks, None
+
+
+def _publish_batch(client, payload, count, batch_size, concurrency):
+    batch = [payload] * batch_size
+    batches = -(-count // batch_size)
+    tasks = [lambda n=n: (_timed(lambda: client.publish_batch(TOPIC, batch),
+                                 n), n * batch_size)
+             for n in _shares(batches, concurrency)]
+    return tasks, None
+
+
+def _batch_publisher(client, payload, count, batch_size, concurrency):
+    publisher = client.batch_publisher(max_messages=batch_size,
+                                       max_latency=0.005)
+
+    def task(n):
+        # Latency is measured from publish until the message's batch has
+        # been sent.
+        latencies = []
+        for _ in range(n):
+            start = clock()
+            publisher.publish(TOPIC, payload).add_done_callback(
+                lambda future, start=start: latencies.append(
+                    clock() - start))
+        publisher.flush()
+        return latencies, n
+
+    tasks = [lambda n=n: task(n) for n in _shares(count, concurrency)]
+    return tasks, publisher.close
+
+
+def _fill(client, payload, count):
+    for n in _shares(count, -(-count // 1000)):
+        client.publish_batch(TOPIC, [payload] * n)
+
+
+def _pull(client, payload, count, batch_size, concurrency):
+    _fill(client, payload, count)
+
+    def task():
+        latencies = []
+        pulled = 0
+        while True:
+            start = clock()
+            messages = client.pull_many(SUBSCRIPTION,
+                                        max_messages=batch_size)
+            if not messages:
+                return latencies, pulled
+            latencies.append(clock() - start)
+            pulled += len(messages)
+
+    return [task] * concurrency, None
+
+
+def _ack(client, payload, count, batch_size, concurrency):
+    _fill(client, payload, count)
+    ack_ids = []
+    while True:
+        messages = client.pull_many(SUBSCRIPTION, max_messages=1000,
+                                    auto_ack=False)
+        if not messages:
+            break
+        ack_ids.extend(m.ack_id for m in messages)
+
+    chunks = [ack_ids[i:i + batch_size]
+              for i in range(0, len(ack_ids), batch_size)]
+
+    def task(chunks):
+        latencies = []
+        for chunk in chunks:
+            start = clock()
+            client.acknowledge(SUBSCRIPTION, chunk)
+            latencies.append(clock() - start)
+        return latencies, sum(len(chunk) for chunk in chunks)
+
+    return [lambda i=i: task(chunks[i::concurrency])
+            for i in range(concurrency)], None
+
+
+def _admin(client, payload, count, batch_size, concurrency):
+    def task(i, n):
+        latencies = []
+        for j in range(n):
+            name = 'bench-admin-%d-%d' % (i, j)
+            start = clock()
+            client.create_topic(name)
+            client.delete_topic(name)
+            latencies.append(clock() - start)
+        return latencies, n
+
+    return [lambda i=i, n=n: task(i, n)
+            for i, n in enumerate(_shares(count, concurrency))], None
+
+
+_SETUPS = {
+    'publish': _publish,
+    'publish_batch': _publish_batch,
+    'batch_publisher': _batch_publisher,
+    'pull': _pull,
+    'ack': _ack,
+    'admin': _admin,
+}
+
+
+def _new_client(service_factory):
+    client = PubSubClient(service_factory(), PROJECT)
+    client.create_topic(TOPIC)
+    client.subscribe(SUBSCRIPTION, TOPIC)
+    return client
+
+
+def _execute(workload, client, payload, count, batch_size, concurrency):
+    tasks, teardown = _SETUPS[workload](client, payload, count, batch_size,
+                                        concurrency)
+    outcomes = [None] * len(tasks)
+
+    def target(i):
+        outcomes[i] = tasks[i]()
+
+    threads = [threading.Thread(target=target, args=(i,))
+               for i in range(len(tasks))]
+    start = clock()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if teardown:
+        teardown()
+    elapsed = clock() - start
+
+    latencies = []
+    messages = 0
+    for task_latencies, task_messages in outcomes:
+        latencies.extend(task_latencies)
+        messages += task_messages
+    return elapsed, sorted(latencies), messages
+
+
+def _percentile(values, percent):
+    if not values:
+        return None
+    index = int(round(percent / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def run_one(workload, message_size, concurrency, batch_size, messages,
+            service_factory=Emulator, trace_allocations=True):
+    """Run a single benchmark.
+
+    Args:
+        workload: one of WORKLOADS.
+        message_size: the size of each message in bytes.
+        concurrency: the number of threads sharing the client.
+        batch_size: the number of messages per request for batched
+                    workloads.
+        messages: the number of messages, or of topics for the admin
+                  workload.
+        service_factory: a callable returning the service object the client
+                         sends requests to.
+        trace_allocations: bool indicating if the workload should be run a
+                           second time with tracemalloc to measure memory
+                           allocated. Ignored where tracemalloc isn't
+                           available.
+
+    Returns:
+        a dict describing the benchmark and its results.
+    """
+
+    if workload not in _BATCHED:
+        batch_size = 1
+    payload = _payload(message_size)
+
+    elapsed, latencies, count = _execute(
+        workload, _new_client(service_factory), payload, messages,
+        batch_size, concurrency)
+
+    alloc_peak = alloc_retained = None
+    if trace_allocations and tracemalloc is not None:
+        # Tracing slows everything down, so allocations are measured on a
+        # separate run which isn't timed.
+        client = _new_client(service_factory)
+        tracemalloc.start()
+        try:
+            _execute(workload, client, payload, messages, batch_size,
+                     concurrency)
+            alloc_retained, alloc_peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    return {
+        'workload': workload,
+        'message_size': message_size,
+        'concurrency': concurrency,
+        'batch_size': batch_size,
+        'messages': count,
+        'requests': len(latencies),
+        'seconds': elapsed,
+        'msgs_per_sec': count / elapsed if elapsed else None,
+        'latency_p50': _percentile(latencies, 50),
+        'latency_p99': _percentile(latencies, 99),
+        'latency_mean': (sum(latencies) / len(latencies)
+                         if latencies else None),
+        'alloc_peak_bytes': alloc_peak,
+        'alloc_retained_bytes': alloc_retained,
+    }
+
+
+def run(workloads=WORKLOADS, message_sizes=(100, 10000),
+        concurrency_levels=(1, 4), batch_sizes=(10, 100), messages=2000,
+        service_factory=Emulator, trace_allocations=True):
+    """Run every combination of the given workloads and settings. Batch
+    sizes only apply to batched workloads and message sizes don't apply to
+    the admin workload, so those combinations aren't repeated.
+
+    Returns:
+        a list of the result dicts returned by run_one.
+    """
+
+    results = []
+    for workload in workloads:
+        sizes = message_sizes if workload != 'admin' else message_sizes[:1]
+        batches = batch_sizes if workload in _BATCHED else (1,)
+        for size, concurrency, batch_size in itertools.product(
+                sizes, concurrency_levels, batches):
+            results.append(run_one(workload, size, concurrency, batch_size,
+                                   messages, service_factory,
+                                   trace_allocations))
+    return results
+
+
+def _key(result):
+    return (result['workload'], result['message_size'],
+            result['concurrency'], result['batch_size'])
+
+
+def _format(results, baseline=None):
+    baseline = dict((_key(result), result) for result in baseline or ())
+    header = '%-16s %8s %4s %5s %12s %10s %10s' % (
+        'workload', 'size', 'conc', 'batch', 'msgs/sec', 'p50 ms', 'p99 ms')
+    if baseline:
+        header += ' %8s' % 'change'
+    lines = [header]
+    for result in results:
+        line = '%-16s %8d %4d %5d %12.0f %10.3f %10.3f' % (
+            result['workload'], result['message_size'],
+            result['concurrency'], result['batch_size'],
+            result['msgs_per_sec'] or 0, (result['latency_p50'] or 0) * 1000,
+            (result['latency_p99'] or 0) * 1000)
+        previous = baseline.get(_key(result))
+        if previous and previous['msgs_per_sec'] and result['msgs_per_sec']:
+            line += ' %+7.1f%%' % (
+                100.0 * result['msgs_per_sec'] / previous['msgs_per_sec'] -
+                100)
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def _ints(value):
+    return tuple(int(v) for v in value.split(','))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m pubsub.bench',
+                                     description=__doc__.split('\n\n')[0])
+    parser.add_argument('--workloads', default=','.join(WORKLOADS),
+                        help='comma separated workloads to run, out of %s' %
+                        ', '.join(WORKLOADS))
+    parser.add_argument('--sizes', type=_ints, default=(100, 10000),
+                        help='comma separated message sizes in bytes')
+    parser.add_argument('--concurrency', type=_ints, default=(1, 4),
+                        help='comma separated numbers of threads')
+    parser.add_argument('--batch-sizes', type=_ints, default=(10, 100),
+                        help='comma separated messages per request')
+    parser.add_argument('--messages', type=int, default=2000,
+                        help='messages per benchmark')
+    parser.add_argument('--no-allocations', action='store_true',
+                        help="don't measure allocations with tracemalloc")
+    parser.add_argument('--output', help='write the JSON results to this '
+                        'file instead of stdout')
+    parser.add_argument('--compare', help='a JSON results file to compare '
+                        'throughput against')
+    args = parser.parse_args(argv)
+
+    workloads = args.workloads.split(',')
+    for workload in workloads:
+        if workload not in WORKLOADS:
+            parser.error('unknown workload %r' % workload)
+
+    results = run(workloads, args.sizes, args.concurrency, args.batch_sizes,
+                  args.messages, trace_allocations=not args.no_allocations)
+    report = {
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'config': {
+            'workloads': workloads,
+            'sizes': args.sizes,
+            'concurrency': args.concurrency,
+            'batch_sizes': args.batch_sizes,
+            'messages': args.messages,
+        },
+        'results': results,
+    }
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+    sys.stderr.write(_format(results, baseline) + '\n')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
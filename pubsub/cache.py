@@ -0,0 +1,59 @@
+import threading
+import time
+
+
+class TTLCache(object):
+    """A thread-safe set of keys which expire ttl seconds after they were
+    added.
+    """
+
+    def __init__(self, ttl, max_size=10000):
+        """Args:
+            ttl: the number of seconds a key is remembered.
+            max_size: the maximum number of keys. When full, expired keys are
+                      evicted and, if that isn't enough, the whole cache is
+                      cleared.
+        """
+
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._expiries = {}
+
+    def __contains__(self, key):
+        with self._lock:
+            expiry = self._expiries.get(key)
+            if expiry is None:
+                return False
+            if expiry <= time.time():
+                del self._expiries[key]
+                return False
+            return True
+
+    def __len__(self):
+        with self._lock:
+            return len(self._expiries)
+
+    def add(self, key):
+        """Remember key for ttl seconds."""
+
+        now = time.time()
+        with self._lock:
+            if key not in self._expiries and \
+                    len(self._expiries) >= self.max_size:
+                self._expiries = dict(
+                    (k, expiry) for k, expiry in self._expiries.items()
+                    if expiry > now)
+                if len(self._expiries) >= self.max_size:
+                    self._expiries.clear()
+            self._expiries[key] = now + self.ttl
+
+    def discard(self, key):
+        """Forget key if it is present."""
+
+        with self._lock:
+            self._expiries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._expiries.clear()
@@ -1,14 +1,33 @@
-import base64
+import binascii
+import logging
 
-from apiclient import errors
-from apiclient.discovery import build
-import httplib2
+# Only the errors module is imported eagerly. The discovery client and
+# httplib2 are imported when a service is first built to keep importing
+# this module cheap.
+from googleapiclient import errors
+
+from pubsub import codec as _codec
+from pubsub.cache import TTLCache
+from pubsub.metrics import clock
+
+logger = logging.getLogger(__name__)
 
 PUBSUB_SCOPE = "https://www.googleapis.com/auth/pubsub"
 
+# The number of calls packed into a single HTTP batch request. The API
+# accepts at most 1000.
+BATCH_SIZE = 100
+
+try:
+    binascii.b2a_base64(b'', newline=False)
+    _B64_NEWLINE_ARG = True
+except TypeError:
+    _B64_NEWLINE_ARG = False
+
 
 def get_client(project_id, credentials=None, service_account=None,
-               private_key=None):
+               private_key=None, pool_size=None, pool_timeout=None,
+               shared_token_cache=False, token_cache_path=None, **kwargs):
     """Return an instance of PubSubClient. Either AssertionCredentials or a
     service account and private key combination need to be provided in order to
     authenticate requests to BigQuery.
@@ -20,6 +39,21 @@ def get_client(project_id, credentials=None, service_account=None,
         service_account: the Google API service account name.
         private_key: the private key associated with the service account in
                      PKCS12 or PEM format.
+        pool_size: if provided, requests are executed on a pool of up to this
+                   many keep-alive connections sharing the credentials, and
+                   the client can be shared between threads.
+        pool_timeout: the maximum number of seconds to wait for a pooled
+                      connection, or None to wait indefinitely.
+        shared_token_cache: bool indicating if access tokens should be shared
+                            between processes through a locked file and
+                            refreshed in the background. See
+                            pubsub.auth.SharedTokenCredentials. The
+                            background refresher stops when the returned
+                            client is closed.
+        token_cache_path: the shared token file, which defaults to one under
+                          ~/.cache/pubsub-python keyed by the service
+                          account.
+        kwargs: additional arguments passed to PubSubClient.
 
     Returns:
         an instance of PubSubClient.
@@ -29,16 +63,44 @@ def get_client(project_id, credentials=None, service_account=None,
         raise Exception('AssertionCredentials or service account and private'
                         'key need to be provided')
 
-    pubsub_service = _get_pubsub_service(credentials=credentials,
-                                         service_account=service_account,
-                                         private_key=private_key)
+    if shared_token_cache or token_cache_path:
+        from pubsub.auth import SharedTokenCredentials
+
+        if not credentials:
+            credentials = _credentials()(
+                service_account, private_key, scope=PUBSUB_SCOPE)
+        credentials = SharedTokenCredentials(credentials,
+                                             path=token_cache_path)
+        kwargs['owned_credentials'] = credentials
+
+    if not pool_size:
+        pubsub_service = _get_pubsub_service(credentials=credentials,
+                                             service_account=service_account,
+                                             private_key=private_key)
+        return PubSubClient(pubsub_service, project_id, **kwargs)
+
+    from pubsub.discovery import build_service
+    from pubsub.transport import HttpPool
+
+    if not credentials:
+        credentials = _credentials()(
+            service_account, private_key, scope=PUBSUB_SCOPE)
+    http_pool = HttpPool(credentials, size=pool_size, timeout=pool_timeout)
+    with http_pool.connection() as http:
+        pubsub_service = build_service(http)
 
-    return PubSubClient(pubsub_service, project_id)
+    return PubSubClient(pubsub_service, project_id, http_pool=http_pool,
+                        **kwargs)
 
 
 def _get_pubsub_service(credentials=None, service_account=None,
                         private_key=None):
-    """Construct an authorized Pub/Sub service object."""
+    """Construct an authorized Pub/Sub service object from the cached
+    discovery document.
+    """
+    import httplib2
+
+    from pubsub.discovery import build_service
 
     assert credentials or (service_account and private_key)
 
@@ -48,7 +110,7 @@ def _get_pubsub_service(credentials=None, service_account=None,
 
     http = httplib2.Http()
     http = credentials.authorize(http)
-    service = build('pubsub', 'v1beta1', http=http)
+    service = build_service(http)
 
     return service
 
@@ -60,11 +122,163 @@ def _credentials():
     return SignedJwtAssertionCredentials
 
 
+class Message(object):
+    """A message pulled from a subscription."""
+
+    def __init__(self, subscription, ack_id, data, message_id=None, size=0,
+                 decode_error=None):
+        """Args:
+            subscription: the name of the subscription the message was
+                          pulled from.
+            ack_id: the id used to acknowledge the message.
+            data: the body of the message, decoded with the codec it was
+                  published with.
+            message_id: the id assigned to the message when it was published.
+            size: the size of the message data on the wire in bytes.
+            decode_error: the exception raised decoding the message's data
+                          with its codec, in which case data holds the bytes
+                          as they were published, or None.
+        """
+
+        self.subscription = subscription
+        self.ack_id = ack_id
+        self.data = data
+        self.message_id = message_id
+        self.size = size
+        self.decode_error = decode_error
+
+    def __repr__(self):
+        return '<Message %s ack_id=%s>' % (self.message_id, self.ack_id)
+
+
 class PubSubClient(object):
 
-    def __init__(self, pubsub_service, project_id):
+    def __init__(self, pubsub_service, project_id, http_pool=None,
+                 resource_cache_ttl=None, create_first=False, codec=None,
+                 retry=None, metrics=None, rate_limiter=None,
+                 owned_credentials=None):
+        """Args:
+            pubsub_service: the Pub/Sub service object requests are built
+                            from.
+            project_id: the project id.
+            http_pool: an optional HttpPool. If provided, every request is
+                       executed on a connection checked out from the pool,
+                       which makes the client safe to share between threads.
+            resource_cache_ttl: if provided, topics and subscriptions which
+                                were created or found to exist are
+                                remembered for this many seconds, and
+                                create_topic and subscribe make no requests
+                                for them.
+            create_first: bool indicating if create_topic and subscribe should
+                          send a create request straight away, treating
+                          "already exists" as success, instead of checking
+                          whether the resource exists first.
+            codec: an optional pubsub.codec.Codec used to encode published
+                   messages. Pulled messages are always decoded with the
+                   codec recorded in their labels, so producers with and
+                   without codecs can share a topic.
+            retry: an optional pubsub.retry.Retrier which retries requests
+                   failing with transient errors. Its policies are looked up
+                   by operation: create_topic, delete_topic, subscribe,
+                   unsubscribe, publish, pull, acknowledge,
+                   modify_ack_deadline and batch.
+            metrics: an optional pubsub.metrics.Metrics which is notified of
+                     the latency and outcome of every request, the number
+                     and size of the messages published, pulled and
+                     acknowledged and the time spent encoding and decoding
+                     them. Without it, nothing is measured.
+            rate_limiter: an optional
+                          pubsub.ratelimit.AdaptiveRateLimiter which paces
+                          publish requests, including their retries, and
+                          adapts its rate to their latency and throttling.
+            owned_credentials: optional credentials with a close method, such
+                               as pubsub.auth.SharedTokenCredentials, which
+                               belong to the client and are closed with it.
+        """
+
         self.pubsub = pubsub_service
         self.project_id = project_id
+        self.http_pool = http_pool
+        self.create_first = create_first
+        self.codec = codec
+        self.retry = retry
+        self.metrics = metrics
+        self.rate_limiter = rate_limiter
+        self.owned_credentials = owned_credentials
+        self.known_resources = None
+        if resource_cache_ttl:
+            self.known_resources = TTLCache(resource_cache_ttl)
+        self.ack_manager = None
+        self.lease_manager = None
+        self.spool = None
+
+    def start_ack_manager(self, **kwargs):
+        """Acknowledge messages asynchronously from now on. Ack ids are queued
+        and sent in batches by an AckManager instead of inline on every pull.
+        See pubsub.ack.AckManager for the accepted arguments.
+
+        Returns:
+            the AckManager.
+        """
+        from pubsub.ack import AckManager
+
+        if not self.ack_manager:
+            self.ack_manager = AckManager(self, **kwargs)
+        return self.ack_manager
+
+    def start_lease_manager(self, **kwargs):
+        """Extend the ack deadlines of messages pulled without being
+        acknowledged from now on, until they are acknowledged or released.
+        See pubsub.lease.LeaseManager for the accepted arguments.
+
+        Returns:
+            the LeaseManager.
+        """
+        from pubsub.lease import LeaseManager
+
+        if not self.lease_manager:
+            self.lease_manager = LeaseManager(self, **kwargs)
+        return self.lease_manager
+
+    def start_spool(self, directory, **kwargs):
+        """Spool published messages to disk from now on. publish,
+        publish_batch and batch publishers return once messages have been
+        appended to a local log, which is drained to the backend in batches
+        by a background thread, so publishing keeps working while the backend
+        is slow or down. See pubsub.spool.Spool for the accepted arguments.
+
+        Args:
+            directory: the directory holding the log. Messages left in it by
+                       a previous process are published.
+
+        Returns:
+            the Spool.
+        """
+        from pubsub.spool import Spool
+
+        if not self.spool:
+            self.spool = Spool(self, directory, **kwargs)
+        return self.spool
+
+    def close(self):
+        """Release any background resources held by the client, sending
+        acknowledgements which are still queued. Spooled messages which
+        haven't been published stay on disk. Credentials owned by the client
+        are closed.
+        """
+
+        if self.lease_manager:
+            self.lease_manager.close()
+            self.lease_manager = None
+        if self.ack_manager:
+            self.ack_manager.close()
+            self.ack_manager = None
+        if self.spool:
+            self.spool.close()
+            self.spool = None
+        if self.owned_credentials:
+            self.owned_credentials.close()
+            self.owned_credentials = None
 
     def create_topic(self, name):
         """Create a topic if it doesn't exist. This is idempotent, meaning if
@@ -78,14 +292,72 @@ class PubSubClient(object):
         """
 
         name = self._full_topic_name(name)
-        try:
-            self.pubsub.topics().get(topic=name).execute()
-        except errors.HttpError as e:
-            if e.resp.status == 404:
-                body = {'name': name}
-                self.pubsub.topics().create(body=body).execute()
-            else:
-                raise
+        if self._is_known(name):
+            return
+
+        if self.create_first:
+            self._create_topic(name)
+        else:
+            try:
+                self._execute(self.pubsub.topics().get(topic=name),
+                              'create_topic')
+            except errors.HttpError as e:
+                if e.resp.status == 404:
+                    self._create_topic(name)
+                else:
+                    raise
+        self._remember(name)
+
+    def ensure_topics(self, names):
+        """Create any of the given topics which don't exist. Topics known to
+        exist are skipped and the others are created with batched create
+        requests, treating "already exists" as success.
+
+        Args:
+            names: an iterable of the names of the topics to create.
+
+        Raises:
+            HttpError if a create failed.
+        """
+
+        results = self._bulk_create(self._topic_items(names),
+                                    self._topic_get, self._topic_create,
+                                    check_first=False)
+        self._raise_first(results)
+
+    def create_topics(self, names):
+        """Create any of the given topics which don't exist, packing the
+        requests into HTTP batch requests. Like create_topic, this is
+        idempotent.
+
+        Args:
+            names: an iterable of the names of the topics to create.
+
+        Returns:
+            a dict mapping each topic name to None if the topic exists or the
+            HttpError raised while creating it.
+        """
+
+        return self._bulk_create(self._topic_items(names), self._topic_get,
+                                 self._topic_create,
+                                 check_first=not self.create_first)
+
+    def delete_topics(self, names):
+        """Delete the given topics, packing the requests into HTTP batch
+        requests. Like delete_topic, this is idempotent.
+
+        Args:
+            names: an iterable of the names of the topics to delete.
+
+        Returns:
+            a dict mapping each topic name to None if the topic no longer
+            exists or the HttpError raised while deleting it.
+        """
+
+        return self._bulk_delete(
+            self._topic_items(names),
+            lambda name, full_name: self.pubsub.topics().delete(
+                topic=full_name))
 
     def delete_topic(self, name):
         """Delete a topic. This is idempotent, meaning if the topic doesn't
@@ -99,8 +371,10 @@ class PubSubClient(object):
         """
 
         name = self._full_topic_name(name)
+        self._forget(name)
         try:
-            self.pubsub.topics().delete(topic=name).execute()
+            self._execute(self.pubsub.topics().delete(topic=name),
+                          'delete_topic')
         except errors.HttpError as e:
             if e.resp.status == 404:
                 return
@@ -122,21 +396,76 @@ class PubSubClient(object):
         """
 
         name = self._full_subscription_name(name)
-        try:
-            self.pubsub.subscriptions().get(
-                subscription=name).execute()
-        except errors.HttpError as e:
-            if e.resp.status == 404:
-                body = {
-                    'name': name,
-                    'topic': self._full_topic_name(topic),
-                    'pushConfig': {
-                        'pushEndpoint': endpoint,
-                    }
-                }
-                self.pubsub.subscriptions().create(body=body).execute()
-            else:
-                raise
+        if self._is_known(name):
+            return
+
+        if self.create_first:
+            self._create_subscription(name, topic, endpoint)
+        else:
+            try:
+                self._execute(self.pubsub.subscriptions().get(
+                    subscription=name), 'subscribe')
+            except errors.HttpError as e:
+                if e.resp.status == 404:
+                    self._create_subscription(name, topic, endpoint)
+                else:
+                    raise
+        self._remember(name)
+
+    def ensure_subscriptions(self, subscriptions):
+        """Create any of the given subscriptions which don't exist.
+        Subscriptions known to exist are skipped and the others are created
+        with batched create requests, treating "already exists" as success.
+
+        Args:
+            subscriptions: an iterable of (name, topic) or (name, topic,
+                           endpoint) tuples describing the subscriptions.
+
+        Raises:
+            HttpError if a create failed.
+        """
+
+        items, create = self._subscription_items(subscriptions)
+        results = self._bulk_create(items, self._subscription_get, create,
+                                    check_first=False)
+        self._raise_first(results)
+
+    def subscribe_many(self, subscriptions):
+        """Create any of the given subscriptions which don't exist, packing
+        the requests into HTTP batch requests. Like subscribe, this is
+        idempotent.
+
+        Args:
+            subscriptions: an iterable of (name, topic) or (name, topic,
+                           endpoint) tuples describing the subscriptions.
+
+        Returns:
+            a dict mapping each subscription name to None if the subscription
+            exists or the HttpError raised while creating it.
+        """
+
+        items, create = self._subscription_items(subscriptions)
+        return self._bulk_create(items, self._subscription_get, create,
+                                 check_first=not self.create_first)
+
+    def unsubscribe_many(self, names):
+        """Delete the given subscriptions, packing the requests into HTTP
+        batch requests. Like unsubscribe, this is idempotent.
+
+        Args:
+            names: an iterable of the names of the subscriptions to delete.
+
+        Returns:
+            a dict mapping each subscription name to None if the subscription
+            no longer exists or the HttpError raised while deleting it.
+        """
+
+        items = [(name, self._full_subscription_name(name))
+                 for name in _unique(names)]
+        return self._bulk_delete(
+            items,
+            lambda name, full_name: self.pubsub.subscriptions().delete(
+                subscription=full_name))
 
     def unsubscribe(self, name):
         """Delete a subscription to a topic if it exists. This is idempotent,
@@ -150,8 +479,11 @@ class PubSubClient(object):
         """
 
         name = self._full_subscription_name(name)
+        self._forget(name)
         try:
-            self.pubsub.subscriptions().delete(subscription=name).execute()
+            self._execute(
+                self.pubsub.subscriptions().delete(subscription=name),
+                'unsubscribe')
         except errors.HttpError as e:
             if e.resp.status == 404:
                 return
@@ -162,23 +494,64 @@ class PubSubClient(object):
 
         Args:
             topic: the name of the topic to publish to.
-            message: the body of the message as a string.
+            message: the body of the message as a string or other bytes-like
+                     object, such as a bytearray or memoryview, or any value
+                     the client's codec can encode.
 
 
         Raises:
-            HttpError if the publish failed.
+            HttpError if the publish failed, or RateLimitExceeded if the
+            client's rate limiter rejected it. If the client has a spool,
+            SpoolFullError if the spool is full instead.
         """
 
+        if self.spool:
+            self.spool.append(topic, self._encode_message(message))
+            return
+
         topic = self._full_topic_name(topic)
         body = {
             'topic': topic,
-            'message': {
-                'data': base64.b64encode(message),
-            }
+            'message': self._encode_message(message),
         }
-        self.pubsub.topics().publish(body=body).execute()
+        self._execute(self.pubsub.topics().publish(body=body), 'publish',
+                      cost=1)
+        if self.metrics is not None:
+            self.metrics.record_messages('publish', 1,
+                                         len(body['message']['data']))
+
+    def publish_batch(self, topic, messages):
+        """Publish several messages to a topic in a single request.
+
+        Args:
+            topic: the name of the topic to publish to.
+            messages: a list of message bodies as strings, or any values the
+                      client's codec can encode.
+
+        Returns:
+            a list of the message ids assigned to the published messages, in
+            the same order as messages. If the client has a spool, the ids
+            aren't known yet and the list is empty.
+
+        Raises:
+            HttpError if the publish failed, or RateLimitExceeded if the
+            client's rate limiter rejected it. If the client has a spool,
+            SpoolFullError if the spool is full instead.
+        """
+
+        return self._publish_encoded(
+            topic, [self._encode_message(message) for message in messages])
 
-    def pull(self, subscription, block=False):
+    def batch_publisher(self, **kwargs):
+        """Return a BatchPublisher which buffers messages published through it
+        and sends them to the backend in batches. See
+        pubsub.publisher.BatchPublisher for the accepted arguments.
+        """
+        from pubsub.publisher import BatchPublisher
+
+        return BatchPublisher(self, **kwargs)
+
+    def pull(self, subscription, block=False, as_memoryview=False):
         """Pull a single message from a topic subscription.
 
         Args:
@@ -186,31 +559,541 @@ class PubSubClient(object):
             block: bool indicating if the pull should block until a message is
                    available or a timeout occurs. If false, pull will return
                    immediately.
+            as_memoryview: bool indicating if raw message data should be
+                           returned as a memoryview over the decoded buffer.
 
         Returns:
             string containing the message data or None if no message was
             retrieved.
 
         Raises:
-            HttpError if the pull failed.
+            HttpError if the pull failed, or the error raised decoding the
+            message, which is then left unacknowledged to be redelivered.
         """
 
         subscription = self._full_subscription_name(subscription)
         body = {'subscription': subscription, 'returnImmediately': not block}
-        resp = self.pubsub.subscriptions().pull(body=body).execute()
+        resp = self._execute(self.pubsub.subscriptions().pull(body=body),
+                             'pull')
         message = resp.get('pubsubEvent').get('message')
 
         if message:
-            ack_id = resp.get('ackId')
-            ack_body = {'subscription': subscription, 'ackId': [ack_id]}
-            self.pubsub.subscriptions().acknowledge(body=ack_body).execute()
-            return base64.b64decode(message.get('data'))
+            if self.metrics is not None:
+                self.metrics.record_messages('pull', 1,
+                                             len(message.get('data') or ''))
+            data = self._decode_message(message, as_memoryview)
+            self._acknowledge(subscription, [resp.get('ackId')])
+            return data
 
         return None
 
+    def pull_many(self, subscription, max_messages=100, block=False,
+                  auto_ack=True, as_memoryview=False):
+        """Pull up to max_messages messages from a topic subscription in a
+        single request.
+
+        Args:
+            subscription: the name of the subscription to pull from.
+            max_messages: the maximum number of messages to return.
+            block: bool indicating if the pull should block until a message is
+                   available or a timeout occurs. If false, pull_many will
+                   return immediately.
+            auto_ack: bool indicating if the received messages should be
+                      acknowledged, with a single request, before returning.
+                      If false, the caller is responsible for acknowledging
+                      the messages once they have been processed, and if
+                      the client has a lease manager, their deadlines are
+                      extended until they are acknowledged or released.
+            as_memoryview: bool indicating if raw message data should be
+                           returned as memoryviews over the decoded buffers.
+
+        Returns:
+            a list of Messages, which is empty if no messages were retrieved.
+            A message whose data couldn't be decoded is still returned, with
+            its decode_error set, so it doesn't hold up the rest.
+
+        Raises:
+            HttpError if the pull or acknowledge failed.
+        """
+
+        name = subscription
+        subscription = self._full_subscription_name(subscription)
+        body = {
+            'subscription': subscription,
+            'returnImmediately': not block,
+            'maxEvents': max_messages,
+        }
+        resp = self._execute(
+            self.pubsub.subscriptions().pullBatch(body=body), 'pull')
+
+        messages = []
+        for pull_resp in resp.get('pullResponses', []):
+            message = pull_resp.get('pubsubEvent', {}).get('message')
+            if not message:
+                continue
+            try:
+                data = self._decode_message(message, as_memoryview)
+                error = None
+            except Exception as e:
+                logger.warning('Failed to decode message %s: %s',
+                               message.get('messageId'), e)
+                data = _raw_data(message)
+                error = e
+            messages.append(Message(name, pull_resp.get('ackId'), data,
+                                    message.get('messageId'),
+                                    len(message.get('data') or ''), error))
+
+        if self.metrics is not None and messages:
+            self.metrics.record_messages('pull', len(messages),
+                                         sum(m.size for m in messages))
+        if auto_ack and messages:
+            self._acknowledge(subscription, [m.ack_id for m in messages])
+        elif self.lease_manager and messages:
+            self.lease_manager.add(subscription, [m.ack_id for m in messages])
+
+        return messages
+
+    def stream(self, subscription, buffer_size=100, batch_size=None,
+               auto_ack=True, max_concurrent_pulls=1):
+        """Return an iterator over the messages of a topic subscription which
+        prefetches messages in the background. See
+        pubsub.subscriber.MessageStream for details.
+
+        Args:
+            subscription: the name of the subscription to pull from.
+            buffer_size: the maximum number of prefetched messages.
+            batch_size: the maximum number of messages fetched per pull.
+            auto_ack: bool indicating if each message should be acknowledged
+                      when it is handed to the caller.
+            max_concurrent_pulls: the maximum number of pulls in flight
+                                  while there is a backlog.
+
+        Returns:
+            a MessageStream yielding Messages.
+        """
+        from pubsub.subscriber import MessageStream
+
+        return MessageStream(self, subscription, buffer_size=buffer_size,
+                             batch_size=batch_size, auto_ack=auto_ack,
+                             max_concurrent_pulls=max_concurrent_pulls)
+
+    def consume(self, subscription, handler, processes=None, key=None,
+                **kwargs):
+        """Start handling the messages of a topic subscription on a pool of
+        worker threads or, for CPU-bound handlers, worker processes. See
+        pubsub.subscriber.Subscriber, pubsub.process.ProcessSubscriber and
+        pubsub.ordering.OrderedSubscriber for the accepted arguments.
+
+        Args:
+            subscription: the name of the subscription to pull from.
+            handler: a callable invoked with each Message. The message is
+                     acknowledged once the handler returns.
+            processes: if provided, the handler runs in this many worker
+                       processes instead of threads.
+            key: if provided, a callable returning the ordering key of a
+                 Message. Messages with the same key are handled one at a
+                 time in the order they were pulled.
+
+        Returns:
+            the started Subscriber, ProcessSubscriber or OrderedSubscriber.
+            Call its stop method to shut it down.
+
+        Raises:
+            ValueError if both processes and key are provided.
+        """
+        if processes and key is not None:
+            raise ValueError('Ordered handling in worker processes is not '
+                             'supported')
+        if key is not None:
+            from pubsub.ordering import OrderedSubscriber
+
+            subscriber = OrderedSubscriber(self, subscription, handler, key,
+                                           **kwargs)
+            subscriber.start()
+            return subscriber
+
+        if processes:
+            from pubsub.process import ProcessSubscriber
+
+            subscriber = ProcessSubscriber(self, subscription, handler,
+                                           processes=processes, **kwargs)
+            subscriber.start()
+            return subscriber
+
+        from pubsub.subscriber import Subscriber
+
+        subscriber = Subscriber(self, subscription, handler, **kwargs)
+        subscriber.start()
+        return subscriber
+
+    def acknowledge(self, subscription, ack_ids):
+        """Acknowledge messages pulled from a topic subscription with a single
+        request.
+
+        Args:
+            subscription: the name of the subscription the messages were
+                          pulled from.
+            ack_ids: a list of ack ids of the messages to acknowledge.
+
+        Raises:
+            HttpError if the acknowledge failed. If the client has an ack
+            manager, acknowledgements are queued and failures are counted by
+            the manager instead.
+        """
+
+        if not ack_ids:
+            return
+
+        subscription = self._full_subscription_name(subscription)
+        if self.lease_manager:
+            self.lease_manager.remove(subscription, ack_ids)
+        self._acknowledge(subscription, list(ack_ids))
+
+    def release(self, subscription, ack_ids):
+        """Stop extending the ack deadlines of pulled messages which won't
+        be acknowledged, such as those whose handler failed, so they are
+        redelivered once their current deadline passes. This does nothing if
+        the client has no lease manager.
+
+        Args:
+            subscription: the name of the subscription the messages were
+                          pulled from.
+            ack_ids: a list of ack ids of the messages.
+        """
+
+        if self.lease_manager and ack_ids:
+            self.lease_manager.remove(
+                self._full_subscription_name(subscription), ack_ids,
+                handled=False)
+
+    def modify_ack_deadline(self, subscription, ack_ids, seconds):
+        """Set the ack deadlines of pulled messages to seconds from now with
+        a single request. A deadline of 0 makes them available for
+        redelivery straight away.
+
+        Args:
+            subscription: the name of the subscription the messages were
+                          pulled from.
+            ack_ids: a list of ack ids of the messages.
+            seconds: the new ack deadline in seconds.
+
+        Raises:
+            HttpError if the request failed.
+        """
+
+        if not ack_ids:
+            return
+
+        self._send_modify_ack_deadline(
+            self._full_subscription_name(subscription), list(ack_ids),
+            seconds)
+
+    def _acknowledge(self, subscription, ack_ids):
+        if self.ack_manager:
+            self.ack_manager.add(subscription, ack_ids)
+        else:
+            self._send_acknowledge(subscription, ack_ids)
+
+    def _send_acknowledge(self, subscription, ack_ids):
+        body = {'subscription': subscription, 'ackId': ack_ids}
+        self._execute(self.pubsub.subscriptions().acknowledge(body=body),
+                      'acknowledge')
+        if self.metrics is not None:
+            self.metrics.record_messages('acknowledge', len(ack_ids), 0)
+
+    def _send_modify_ack_deadline(self, subscription, ack_ids, seconds):
+        body = {
+            'subscription': subscription,
+            'ackIds': ack_ids,
+            'ackDeadlineSeconds': seconds,
+        }
+        self._execute(
+            self.pubsub.subscriptions().modifyAckDeadline(body=body),
+            'modify_ack_deadline')
+
+    def _encode_message(self, message):
+        if self.metrics is None:
+            return self._encode(message)
+        start = clock()
+        encoded = self._encode(message)
+        self.metrics.record_codec('encode', clock() - start)
+        return encoded
+
+    def _decode_message(self, message, as_memoryview=False):
+        if self.metrics is None:
+            return self._decode(message, as_memoryview)
+        start = clock()
+        data = self._decode(message, as_memoryview)
+        self.metrics.record_codec('decode', clock() - start)
+        return data
+
+    def _encode(self, message):
+        if self.codec is None:
+            return {'data': _b64encode(message)}
+
+        name, data = self.codec.encode(message)
+        encoded = {'data': _b64encode(data)}
+        labels = _codec.encode_labels(name)
+        if labels:
+            encoded['label'] = labels
+        return encoded
+
+    def _decode(self, message, as_memoryview):
+        return _decode_data(message, as_memoryview)
+
+    def _publish_encoded(self, topic, messages):
+        # Spooled messages are published later, so they have no ids yet.
+        if self.spool:
+            for message in messages:
+                self.spool.append(topic, message)
+            return []
+        return self._send_encoded(topic, messages)
+
+    def _send_encoded(self, topic, messages):
+        if not messages:
+            return []
+
+        body = {
+            'topic': self._full_topic_name(topic),
+            'messages': messages,
+        }
+        resp = self._execute(self.pubsub.topics().publishBatch(body=body),
+                             'publish', cost=len(messages))
+        if self.metrics is not None:
+            self.metrics.record_messages(
+                'publish', len(messages),
+                sum(len(message['data']) for message in messages))
+        return resp.get('messageIds', [])
+
+    def _create_topic(self, name):
+        # Creating a topic which already exists is treated as success.
+        body = {'name': name}
+        try:
+            self._execute(self.pubsub.topics().create(body=body),
+                          'create_topic')
+        except errors.HttpError as e:
+            if e.resp.status != 409:
+                raise
+
+    def _create_subscription(self, name, topic, endpoint):
+        # Creating a subscription which already exists is treated as success.
+        body = {
+            'name': name,
+            'topic': self._full_topic_name(topic),
+            'pushConfig': {
+                'pushEndpoint': endpoint,
+            }
+        }
+        try:
+            self._execute(self.pubsub.subscriptions().create(body=body),
+                          'subscribe')
+        except errors.HttpError as e:
+            if e.resp.status != 409:
+                raise
+
+    def _topic_items(self, names):
+        return [(name, self._full_topic_name(name)) for name in _unique(names)]
+
+    def _topic_get(self, name, full_name):
+        return self.pubsub.topics().get(topic=full_name)
+
+    def _topic_create(self, name, full_name):
+        return self.pubsub.topics().create(body={'name': full_name})
+
+    def _subscription_items(self, subscriptions):
+        subscriptions = list(subscriptions)
+        specs = {}
+        for subscription in subscriptions:
+            name, topic, endpoint = (tuple(subscription) + (None,))[:3]
+            specs[name] = (topic, endpoint)
+        items = [(name, self._full_subscription_name(name))
+                 for name in _unique(s[0] for s in subscriptions)]
+
+        def create(name, full_name):
+            topic, endpoint = specs[name]
+            body = {
+                'name': full_name,
+                'topic': self._full_topic_name(topic),
+                'pushConfig': {
+                    'pushEndpoint': endpoint,
+                }
+            }
+            return self.pubsub.subscriptions().create(body=body)
+
+        return items, create
+
+    def _subscription_get(self, name, full_name):
+        return self.pubsub.subscriptions().get(subscription=full_name)
+
+    def _bulk_create(self, items, get, create, check_first=True):
+        results = dict((name, None) for name, _ in items)
+        items = [(name, full_name) for name, full_name in items
+                 if not self._is_known(full_name)]
+
+        if check_first:
+            errs = self._execute_batch(
+                [(name, get(name, full_name)) for name, full_name in items])
+            missing = []
+            for name, full_name in items:
+                error = errs[name]
+                if error is None:
+                    self._remember(full_name)
+                elif _status(error) == 404:
+                    missing.append((name, full_name))
+                else:
+                    results[name] = error
+            items = missing
+
+        errs = self._execute_batch(
+            [(name, create(name, full_name)) for name, full_name in items])
+        for name, full_name in items:
+            error = errs[name]
+            if error is None or _status(error) == 409:
+                self._remember(full_name)
+            else:
+                results[name] = error
+
+        return results
+
+    def _bulk_delete(self, items, delete):
+        for _, full_name in items:
+            self._forget(full_name)
+
+        errs = self._execute_batch(
+            [(name, delete(name, full_name)) for name, full_name in items])
+        results = {}
+        for name, _ in items:
+            error = errs[name]
+            if error is not None and _status(error) == 404:
+                error = None
+            results[name] = error
+        return results
+
+    def _execute_batch(self, requests):
+        """Execute (key, request) pairs using HTTP batch requests of up to
+        BATCH_SIZE calls and return a dict mapping each key to None or the
+        exception raised by its call.
+        """
+
+        results = {}
+        for i in range(0, len(requests), BATCH_SIZE):
+            chunk = requests[i:i + BATCH_SIZE]
+
+            def callback(request_id, response, exception, chunk=chunk):
+                results[chunk[int(request_id)][0]] = exception
+
+            batch = self.pubsub.new_batch_http_request(callback=callback)
+            for j, (_, request) in enumerate(chunk):
+                batch.add(request, request_id=str(j))
+            self._execute(batch, 'batch')
+
+        return results
+
+    def _raise_first(self, results):
+        for error in results.values():
+            if error is not None:
+                raise error
+
+    def _is_known(self, name):
+        return self.known_resources is not None and \
+            name in self.known_resources
+
+    def _remember(self, name):
+        if self.known_resources is not None:
+            self.known_resources.add(name)
+
+    def _forget(self, name):
+        if self.known_resources is not None:
+            self.known_resources.discard(name)
+
+    def _execute(self, request, operation, cost=None):
+        # cost is the number of messages a publish request sends.
+        if self.metrics is None:
+            return self._execute_retrying(request, operation, cost)
+
+        start = clock()
+        try:
+            resp = self._execute_retrying(request, operation, cost)
+        except Exception as e:
+            self.metrics.record_request(operation, clock() - start,
+                                        _status(e) or type(e).__name__)
+            raise
+        self.metrics.record_request(operation, clock() - start)
+        return resp
+
+    def _execute_retrying(self, request, operation, cost=None):
+        if cost is not None and self.rate_limiter is not None:
+            def attempt():
+                return self.rate_limiter.call(
+                    cost, lambda: self._execute_once(request))
+        else:
+            def attempt():
+                return self._execute_once(request)
+
+        if self.retry:
+            return self.retry.call(operation, attempt)
+        return attempt()
+
+    def _execute_once(self, request):
+        if self.http_pool:
+            with self.http_pool.connection() as http:
+                return request.execute(http=http)
+        return request.execute()
+
     def _full_topic_name(self, name):
         return '/topics/%s/%s' % (self.project_id, name)
 
     def _full_subscription_name(self, name):
         return '/subscriptions/%s/%s' % (self.project_id, name)
 
+
+def _b64encode(data):
+    """Base64 encode a bytes-like object. bytes, bytearray and memoryview
+    are encoded in place, without first being copied into a new string, and
+    the trailing newline is omitted rather than sliced off a copy where
+    binascii supports it.
+    """
+
+    if _B64_NEWLINE_ARG:
+        encoded = binascii.b2a_base64(data, newline=False)
+    else:
+        encoded = binascii.b2a_base64(data)[:-1]
+    if not isinstance(encoded, str):
+        # The JSON body needs text on Python 3.
+        encoded = encoded.decode('ascii')
+    return encoded
+
+
+def _decode_data(message, as_memoryview=False):
+    """Decode the data of a message received from the API, by pull or
+    push, with the codec recorded in its labels.
+    """
+
+    data = binascii.a2b_base64(message.get('data') or '')
+    data = _codec.decode(data, message.get('label'))
+    if as_memoryview and isinstance(data, bytes):
+        data = memoryview(data)
+    return data
+
+
+def _raw_data(message):
+    # The data of a message which couldn't be decoded, without its codec.
+    try:
+        return binascii.a2b_base64(message.get('data') or '')
+    except (binascii.Error, TypeError, ValueError):
+        return None
+
+
+def _unique(names):
+    seen = set()
+    unique = []
+    for name in names:
+        if name not in seen:
+            seen.add(name)
+            unique.append(name)
+    return unique
+
+
+def _status(error):
+    resp = getattr(error, 'resp', None)
+    return getattr(resp, 'status', None)
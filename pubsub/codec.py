@@ -0,0 +1,189 @@
+import json
+import zlib
+
+
+# The message label recording which codec encoded a message's data.
+# Messages without it were published raw.
+CODEC_LABEL = 'pubsub-python-codec'
+
+_codecs = {}
+
+try:
+    _buffer = buffer
+except NameError:
+    _buffer = None
+
+
+class Codec(object):
+    """Converts message values to and from the bytes sent on the wire.
+    Subclasses set a unique name and implement encode and decode. Codecs
+    need to be registered with register_codec on the consuming side so
+    messages they encoded can be decoded.
+    """
+
+    name = None
+
+    def encode(self, value):
+        """Encode a value.
+
+        Returns:
+            a tuple of the name to record in the message's codec label and
+            the encoded bytes.
+        """
+
+        raise NotImplementedError
+
+    def decode(self, data):
+        """Decode bytes encoded by this codec."""
+
+        raise NotImplementedError
+
+
+class RawCodec(Codec):
+    """Sends strings and other bytes-like objects as they are, without
+    copying them.
+    """
+
+    name = 'raw'
+
+    def encode(self, value):
+        return self.name, value
+
+    def decode(self, data):
+        return data
+
+
+class JsonCodec(Codec):
+    """Serializes values as JSON."""
+
+    name = 'json'
+
+    def encode(self, value):
+        return self.name, json.dumps(value, separators=(',', ':')).encode(
+            'utf-8')
+
+    def decode(self, data):
+        return json.loads(data.decode('utf-8'))
+
+
+class ZlibCodec(Codec):
+    """Encodes values with an inner codec and compresses the result with
+    zlib if it is at least threshold bytes long. The codec label records
+    both stages, e.g. "zlib+json", so decode only decompresses and the inner
+    codec is applied afterwards.
+    """
+
+    name = 'zlib'
+
+    def __init__(self, inner=None, threshold=1024, level=6,
+                 max_size=64 * 1024 * 1024):
+        """Args:
+            inner: the codec applied before compressing, defaults to
+                   RawCodec.
+            threshold: the minimum encoded size in bytes which is compressed.
+            level: the zlib compression level.
+            max_size: the maximum size in bytes of decompressed data. Larger
+                      data is rejected, so a small message can't expand to
+                      exhaust memory.
+        """
+
+        self.inner = inner or RawCodec()
+        self.threshold = threshold
+        self.level = level
+        self.max_size = max_size
+
+    def encode(self, value):
+        name, data = self.inner.encode(value)
+        if len(data) < self.threshold:
+            return name, data
+
+        compressed = zlib.compress(_readable(data), self.level)
+        if len(compressed) >= len(data):
+            return name, data
+        if name == RawCodec.name:
+            return self.name, compressed
+        return '%s+%s' % (self.name, name), compressed
+
+    def decode(self, data):
+        decompressor = zlib.decompressobj()
+        decoded = decompressor.decompress(_readable(data), self.max_size)
+        # Python 2 decompressors don't report whether the stream ended.
+        if decompressor.unconsumed_tail or \
+                not getattr(decompressor, 'eof', True):
+            raise ValueError('Compressed data is truncated or decompresses '
+                             'to more than %d bytes' % self.max_size)
+        return decoded
+
+
+def _readable(data):
+    # zlib on Python 2 only accepts strings and read-only buffers.
+    if _buffer is None:
+        return data
+    if isinstance(data, bytearray):
+        return _buffer(data)
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return data
+
+
+def register_codec(codec):
+    """Register a codec so messages labelled with its name can be
+    decoded.
+    """
+
+    if not codec.name:
+        raise ValueError('Codecs must have a name')
+    _codecs[codec.name] = codec
+
+
+def get_codec(name):
+    """Return the registered codec with the given name.
+
+    Raises:
+        ValueError if no codec with that name is registered.
+    """
+
+    try:
+        return _codecs[name]
+    except KeyError:
+        raise ValueError('Unknown codec %r' % name)
+
+
+def encode_labels(name):
+    """Return the message labels recording the codec name, which is empty
+    for raw messages so they look like those of producers without codecs.
+    """
+
+    if name == RawCodec.name:
+        return []
+    return [{'key': CODEC_LABEL, 'strValue': name}]
+
+
+def decode(data, labels=None):
+    """Decode message data using the codecs recorded in its labels. Data
+    without a codec label is returned as it is.
+
+    Args:
+        data: the message data after base64 decoding.
+        labels: the message's labels.
+
+    Returns:
+        the decoded value.
+    """
+
+    name = None
+    for label in labels or ():
+        if label.get('key') == CODEC_LABEL:
+            name = label.get('strValue')
+            break
+    if not name:
+        return data
+
+    for stage in name.split('+'):
+        data = get_codec(stage).decode(data)
+    return data
+
+
+register_codec(RawCodec())
+register_codec(JsonCodec())
+register_codec(ZlibCodec())
@@ -0,0 +1,241 @@
+"""Drops messages redelivered by the at-least-once delivery of
+subscriptions before they reach handlers.
+"""
+
+import collections
+import hashlib
+import json
+import logging
+import math
+import struct
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def message_key(message):
+    """Return the key identifying a message for deduplication: its message
+    id, or a hash of its content if it doesn't have one.
+    """
+
+    if message.message_id:
+        return message.message_id
+    return content_key(message)
+
+
+def content_key(message):
+    """Return a hash of a message's data, so messages published more than
+    once with the same content are treated as duplicates.
+    """
+
+    data = message.data
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    elif isinstance(data, bytearray):
+        data = bytes(data)
+    elif not isinstance(data, bytes):
+        data = json.dumps(data, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
+
+
+class BloomFilter(object):
+    """A set of keys which answers membership with no false negatives and
+    a false-positive rate of about error_rate while it holds at most
+    capacity keys.
+    """
+
+    def __init__(self, capacity, error_rate):
+        if capacity < 1:
+            raise ValueError('capacity must be at least 1')
+        if not 0 < error_rate < 1:
+            raise ValueError('error_rate must be between 0 and 1')
+
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = int(math.ceil(-capacity * math.log(error_rate) /
+                                  math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / float(capacity) *
+                                       math.log(2))))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def __contains__(self, key):
+        bits = self._bits
+        for index in self._indexes(key):
+            if not bits[index >> 3] & (1 << (index & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+    def add(self, key):
+        for index in self._indexes(key):
+            self._bits[index >> 3] |= 1 << (index & 7)
+        self.count += 1
+
+    def _indexes(self, key):
+        # Double hashing derives all the indexes from one digest.
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        h2 |= 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+
+class Deduplicator(object):
+    """Remembers the keys of handled messages in bounded memory so
+    redelivered messages can be dropped. The most recent max_keys keys are
+    held exactly in an LRU; older keys are found in a pair of Bloom filters
+    covering the last window to 2 * window seconds. The current filter is
+    rotated out when it is window seconds old or full, so the
+    false-positive rate stays around error_rate. A false positive drops a
+    message which wasn't a duplicate, so error_rate should be small.
+
+    Keys are recorded with add once a message has been handled, so a
+    message whose handler failed is handled again when it is redelivered.
+    """
+
+    def __init__(self, max_keys=100000, window=600, error_rate=0.0001,
+                 bloom_capacity=1000000, key=message_key):
+        """Args:
+            max_keys: the maximum number of keys held exactly.
+            window: the minimum number of seconds a key is remembered by the
+                    Bloom filters.
+            error_rate: the false-positive rate of the Bloom filters.
+            bloom_capacity: the number of keys a Bloom filter holds before
+                            it is rotated out early.
+            key: a callable returning the key of a message.
+        """
+
+        self.max_keys = max_keys
+        self.window = window
+        self.error_rate = error_rate
+        self.bloom_capacity = bloom_capacity
+        self.key = key
+
+        self.exact_hits = 0
+        self.bloom_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.rotations = 0
+
+        self._lock = threading.Lock()
+        self._recent = collections.OrderedDict()
+        self._current = BloomFilter(bloom_capacity, error_rate)
+        self._previous = None
+        self._rotated_at = time.time()
+
+    def __contains__(self, key):
+        with self._lock:
+            self._rotate()
+            return self._contains(key)
+
+    def add(self, key):
+        """Record that the message with this key has been handled."""
+
+        with self._lock:
+            self._rotate()
+            if key in self._recent:
+                # Move the key to the most recent end.
+                del self._recent[key]
+                self._recent[key] = True
+                return
+            self._recent[key] = True
+            if len(self._recent) > self.max_keys:
+                self._recent.popitem(last=False)
+                self.evictions += 1
+            self._current.add(key)
+
+    def filter(self, messages):
+        """Split messages into those which haven't been handled yet,
+        duplicates of handled messages and repeats of a new message earlier
+        in messages. A repeat isn't a duplicate yet: the first copy may
+        still fail to be handled.
+
+        Returns:
+            a tuple of the list of new messages, the list of duplicates and
+            the list of repeats.
+        """
+
+        fresh = []
+        duplicates = []
+        repeats = []
+        batch = set()
+        with self._lock:
+            self._rotate()
+            for message in messages:
+                key = self.key(message)
+                if key in batch:
+                    repeats.append(message)
+                elif self._contains(key):
+                    duplicates.append(message)
+                else:
+                    batch.add(key)
+                    fresh.append(message)
+                    self.misses += 1
+        return fresh, duplicates, repeats
+
+    def stats(self):
+        """Return a dict of the exact and Bloom filter hits, the misses, the
+        keys evicted from the LRU and the Bloom filter rotations.
+        """
+
+        with self._lock:
+            return {
+                'exact_hits': self.exact_hits,
+                'bloom_hits': self.bloom_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'rotations': self.rotations,
+                'keys': len(self._recent),
+            }
+
+    def _contains(self, key):
+        # Must be called with self._lock held.
+        if key in self._recent:
+            self.exact_hits += 1
+            return True
+        if key in self._current or \
+                (self._previous is not None and key in self._previous):
+            self.bloom_hits += 1
+            return True
+        return False
+
+    def _rotate(self):
+        # Must be called with self._lock held.
+        now = time.time()
+        if now - self._rotated_at < self.window and \
+                len(self._current) < self.bloom_capacity:
+            return
+        if now - self._rotated_at >= 2 * self.window:
+            # Nothing in either filter is within the window any more.
+            self._previous = None
+        else:
+            self._previous = self._current
+        self._current = BloomFilter(self.bloom_capacity, self.error_rate)
+        self._rotated_at = now
+        self.rotations += 1
+
+
+def drop_duplicates(client, subscription, deduplicator, messages):
+    """Acknowledge and drop the messages a deduplicator has seen before.
+    Repeats of a message earlier in messages are released instead, so they
+    are redelivered, and acknowledged as duplicates then if the first copy
+    was handled.
+
+    Returns:
+        the list of messages which haven't been handled yet.
+    """
+
+    fresh, duplicates, repeats = deduplicator.filter(messages)
+    client.release(subscription, [message.ack_id for message in repeats])
+    if duplicates:
+        try:
+            client.acknowledge(subscription,
+                               [message.ack_id for message in duplicates])
+        except Exception:
+            logger.exception('Failed to acknowledge %d duplicate messages',
+                             len(duplicates))
+    return fresh
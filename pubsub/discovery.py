@@ -0,0 +1,142 @@
+import json
+import os
+import tempfile
+import time
+
+API_NAME = 'pubsub'
+API_VERSION = 'v1beta1'
+DISCOVERY_URI = ('https://www.googleapis.com/discovery/v1/apis/%s/%s/rest' %
+                 (API_NAME, API_VERSION))
+
+# Bump when the layout of cache files changes so stale files are ignored.
+CACHE_FORMAT = 1
+DEFAULT_MAX_AGE = 24 * 60 * 60
+
+_documents = {}
+
+
+def build_service(http, cache_dir=None, max_age=DEFAULT_MAX_AGE):
+    """Build a Pub/Sub service object from a cached discovery document,
+    fetching the document only if there is no fresh copy in the cache.
+
+    Args:
+        http: the authorized httplib2.Http the service uses.
+        cache_dir: the directory the discovery document is cached in,
+                   defaults to default_cache_dir().
+        max_age: the number of seconds a cached document is used before it is
+                 fetched again, or None to never refetch it.
+
+    Returns:
+        the Pub/Sub service object.
+    """
+    from googleapiclient.discovery import build_from_document
+
+    document = get_document(http, cache_dir=cache_dir, max_age=max_age)
+    return build_from_document(document, http=http)
+
+
+def get_document(http, cache_dir=None, max_age=DEFAULT_MAX_AGE):
+    """Return the Pub/Sub discovery document. Documents are cached in
+    memory and on disk. A stale cached document is still used if fetching a
+    new one fails, so clients can be built offline.
+
+    Args:
+        http: the httplib2.Http used to fetch the document.
+        cache_dir: the directory the discovery document is cached in,
+                   defaults to default_cache_dir().
+        max_age: the number of seconds a cached document is used before it is
+                 fetched again, or None to never refetch it.
+
+    Returns:
+        the discovery document as a dict.
+
+    Raises:
+        HttpError if the document isn't cached and fetching it failed.
+    """
+
+    path = _cache_path(cache_dir or default_cache_dir())
+    cached = _documents.get(path) or _read_cache(path)
+    if cached and (max_age is None or
+                   time.time() - cached['cached_at'] < max_age):
+        _documents[path] = cached
+        return cached['document']
+
+    try:
+        document = _fetch(http)
+    except Exception:
+        if cached:
+            return cached['document']
+        raise
+
+    _documents[path] = _write_cache(path, document)
+    return document
+
+
+def default_cache_dir():
+    """Return the directory discovery documents are cached in. This is
+    $PUBSUB_DISCOVERY_CACHE_DIR if set, otherwise ~/.cache/pubsub-python.
+    """
+
+    return os.environ.get('PUBSUB_DISCOVERY_CACHE_DIR') or os.path.join(
+        os.path.expanduser('~'), '.cache', 'pubsub-python')
+
+
+def _cache_path(cache_dir):
+    return os.path.join(cache_dir, '%s-%s.json' % (API_NAME, API_VERSION))
+
+
+def _fetch(http):
+    from googleapiclient import errors
+
+    resp, content = http.request(DISCOVERY_URI)
+    if resp.status >= 400:
+        raise errors.HttpError(resp, content, uri=DISCOVERY_URI)
+    if isinstance(content, bytes):
+        content = content.decode('utf-8')
+    return json.loads(content)
+
+
+def _read_cache(path):
+    try:
+        with open(path) as f:
+            cached = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+    if not isinstance(cached, dict) or \
+            cached.get('format') != CACHE_FORMAT:
+        return None
+    document = cached.get('document')
+    if not isinstance(document, dict) or \
+            document.get('name') != API_NAME or \
+            document.get('version') != API_VERSION:
+        return None
+    return cached
+
+
+def _write_cache(path, document):
+    cached = {
+        'format': CACHE_FORMAT,
+        'cached_at': time.time(),
+        'document': document,
+    }
+
+    # Write to a temporary file and rename it into place so concurrent
+    # processes never read a partially written document. Failing to write
+    # the cache isn't fatal.
+    try:
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(cached, f)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        pass
+
+    return cached
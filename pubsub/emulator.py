@@ -0,0 +1,566 @@
+"""An in-memory Pub/Sub backend for tests and load tests. Emulator can be
+passed to PubSubClient in place of the discovery service, so requests
+never leave the process, or served over local HTTP with EmulatorServer for
+clients which speak the REST API, such as pubsub.aio.AsyncPubSubClient.
+
+Topics fan messages out to all of their subscriptions, pulls can block
+until messages are published and messages which aren't acknowledged within
+their subscription's ack deadline are redelivered. Push endpoints are
+recorded but messages are only delivered by pulls.
+"""
+
+import argparse
+import collections
+import heapq
+import itertools
+import json
+import threading
+import time
+from wsgiref import simple_server
+
+from googleapiclient import errors
+import httplib2
+
+try:
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from SocketServer import ThreadingMixIn
+
+API_PATH = '/pubsub/v1beta1/'
+
+# The default ack deadline of subscriptions created without one, as used
+# by the real service.
+DEFAULT_ACK_DEADLINE = 10
+
+
+def _error(status, message):
+    content = json.dumps({'error': {'code': status, 'message': message}})
+    return errors.HttpError(httplib2.Response({'status': status}),
+                            content.encode('utf-8'))
+
+
+class _Subscription(object):
+
+    def __init__(self, name, topic, ack_deadline, push_config):
+        self.name = name
+        self.topic = topic
+        self.ack_deadline = ack_deadline
+        self.push_config = push_config
+        # Messages waiting to be delivered, oldest first.
+        self.pending = collections.deque()
+        # Delivered messages by ack id, with their current deadline.
+        self.outstanding = {}
+        # A heap of (deadline, ack id) pairs. Entries for messages which
+        # were acknowledged or had their deadline modified are skipped when
+        # they are popped.
+        self.deadlines = []
+
+    def expire(self, now):
+        """Move messages whose ack deadline has passed back to pending, in
+        front of messages which were never delivered.
+        """
+
+        expired = []
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, ack_id = heapq.heappop(self.deadlines)
+            entry = self.outstanding.get(ack_id)
+            if entry is not None and entry[1] == deadline:
+                del self.outstanding[ack_id]
+                expired.append(entry[0])
+        self.pending.extendleft(reversed(expired))
+
+    def next_deadline(self):
+        while self.deadlines:
+            deadline, ack_id = self.deadlines[0]
+            entry = self.outstanding.get(ack_id)
+            if entry is not None and entry[1] == deadline:
+                return deadline
+            heapq.heappop(self.deadlines)
+        return None
+
+
+class Emulator(object):
+    """An in-memory Pub/Sub backend which implements the topics and
+    subscriptions resources used by PubSubClient. It is thread-safe.
+    """
+
+    def __init__(self, ack_deadline=DEFAULT_ACK_DEADLINE, pull_timeout=30):
+        """Args:
+            ack_deadline: the ack deadline in seconds of subscriptions
+                          created without one.
+            pull_timeout: the maximum number of seconds a blocking pull
+                          waits for messages before returning none.
+        """
+
+        self.ack_deadline = ack_deadline
+        self.pull_timeout = pull_timeout
+        self._cond = threading.Condition()
+        self._topics = {}
+        self._subscriptions = {}
+        self._message_ids = itertools.count(1)
+        self._deliveries = itertools.count(1)
+
+    # The service object interface used by PubSubClient.
+
+    def topics(self):
+        return _Topics(self)
+
+    def subscriptions(self):
+        return _Subscriptions(self)
+
+    def new_batch_http_request(self, callback=None):
+        return _BatchRequest(callback)
+
+    # Operations.
+
+    def get_topic(self, name):
+        with self._cond:
+            if name not in self._topics:
+                raise _error(404, 'Topic %s not found' % name)
+            return {'name': name}
+
+    def create_topic(self, name):
+        with self._cond:
+            if name in self._topics:
+                raise _error(409, 'Topic %s already exists' % name)
+            self._topics[name] = set()
+            return {'name': name}
+
+    def delete_topic(self, name):
+        """Delete a topic. Its subscriptions are kept but no longer receive
+        messages.
+        """
+
+        with self._cond:
+            if self._topics.pop(name, None) is None:
+                raise _error(404, 'Topic %s not found' % name)
+            return {}
+
+    def publish(self, topic, messages):
+        """Publish messages to every subscription of a topic.
+
+        Returns:
+            a list of the ids assigned to the messages.
+        """
+
+        with self._cond:
+            subscriptions = self._topics.get(topic)
+            if subscriptions is None:
+                raise _error(404, 'Topic %s not found' % topic)
+
+            ids = []
+            for message in messages:
+                message = dict(message)
+                message['messageId'] = str(next(self._message_ids))
+                ids.append(message['messageId'])
+                for name in subscriptions:
+                    self._subscriptions[name].pending.append(message)
+            if ids and subscriptions:
+                self._cond.notify_all()
+            return ids
+
+    def get_subscription(self, name):
+        with self._cond:
+            subscription = self._subscription(name)
+            return {
+                'name': name,
+                'topic': subscription.topic,
+                'pushConfig': subscription.push_config,
+                'ackDeadlineSeconds': subscription.ack_deadline,
+            }
+
+    def create_subscription(self, name, topic, push_config=None,
+                            ack_deadline=None):
+        with self._cond:
+            if name in self._subscriptions:
+                raise _error(409, 'Subscription %s already exists' % name)
+            if topic not in self._topics:
+                raise _error(404, 'Topic %s not found' % topic)
+            self._subscriptions[name] = _Subscription(
+                name, topic, ack_deadline or self.ack_deadline,
+                push_config or {})
+            self._topics[topic].add(name)
+            return {'name': name, 'topic': topic}
+
+    def delete_subscription(self, name):
+        with self._cond:
+            subscription = self._subscription(name)
+            del self._subscriptions[name]
+            self._topics.get(subscription.topic, set()).discard(name)
+            # Wake blocked pulls so they fail instead of waiting out their
+            # timeout.
+            self._cond.notify_all()
+            return {}
+
+    def pull(self, subscription, max_events=1, block=False):
+        """Deliver up to max_events messages from a subscription, including
+        previously delivered messages whose ack deadline has passed.
+
+        Args:
+            subscription: the name of the subscription.
+            max_events: the maximum number of messages to deliver.
+            block: bool indicating if the pull should wait until a message
+                   is available or pull_timeout elapses.
+
+        Returns:
+            a list of pull responses, each with an ackId and a pubsubEvent.
+        """
+
+        give_up = time.time() + self.pull_timeout
+        with self._cond:
+            while True:
+                now = time.time()
+                sub = self._subscription(subscription)
+                sub.expire(now)
+                if sub.pending or not block or now >= give_up:
+                    break
+
+                timeout = give_up - now
+                deadline = sub.next_deadline()
+                if deadline is not None:
+                    timeout = min(timeout, max(deadline - now, 0.001))
+                self._cond.wait(timeout)
+
+            responses = []
+            deadline = now + sub.ack_deadline
+            while sub.pending and len(responses) < max_events:
+                message = sub.pending.popleft()
+                # Ack ids are unique per delivery, so acknowledging a stale
+                # delivery doesn't acknowledge the redelivered message.
+                ack_id = '%s-%d' % (message['messageId'],
+                                    next(self._deliveries))
+                sub.outstanding[ack_id] = (message, deadline)
+                heapq.heappush(sub.deadlines, (deadline, ack_id))
+                responses.append({
+                    'ackId': ack_id,
+                    'pubsubEvent': {
+                        'subscription': subscription,
+                        'message': message,
+                    },
+                })
+            return responses
+
+    def acknowledge(self, subscription, ack_ids):
+        """Acknowledge delivered messages. Unknown or expired ack ids are
+        ignored.
+        """
+
+        with self._cond:
+            sub = self._subscription(subscription)
+            for ack_id in ack_ids:
+                sub.outstanding.pop(ack_id, None)
+            return {}
+
+    def modify_ack_deadline(self, subscription, ack_ids, seconds):
+        """Set the ack deadline of delivered messages to seconds from now. A
+        deadline of 0 makes them available for redelivery immediately.
+        """
+
+        with self._cond:
+            sub = self._subscription(subscription)
+            deadline = time.time() + seconds
+            for ack_id in ack_ids:
+                entry = sub.outstanding.get(ack_id)
+                if entry is not None:
+                    sub.outstanding[ack_id] = (entry[0], deadline)
+                    heapq.heappush(sub.deadlines, (deadline, ack_id))
+            if seconds <= 0:
+                sub.expire(deadline)
+                self._cond.notify_all()
+            return {}
+
+    def stats(self):
+        """Return a dict mapping each subscription to its number of pending
+        and outstanding messages.
+        """
+
+        with self._cond:
+            return dict(
+                (name, {'pending': len(sub.pending),
+                        'outstanding': len(sub.outstanding)})
+                for name, sub in self._subscriptions.items())
+
+    def _subscription(self, name):
+        # Must be called with self._cond held.
+        subscription = self._subscriptions.get(name)
+        if subscription is None:
+            raise _error(404, 'Subscription %s not found' % name)
+        return subscription
+
+    # The REST API.
+
+    def handle(self, method, path, body=None):
+        """Handle a REST API request.
+
+        Args:
+            method: the HTTP method.
+            path: the request path relative to the API root, e.g.
+                  "topics/publish".
+            body: the decoded JSON body, if any.
+
+        Returns:
+            the JSON response as a dict.
+
+        Raises:
+            HttpError if the request failed or doesn't match an API method.
+        """
+
+        collection, _, rest = path.partition('/')
+        body = body or {}
+
+        if collection == 'topics':
+            if method == 'POST' and not rest:
+                return self.create_topic(body['name'])
+            if method == 'POST' and rest == 'publish':
+                return {'messageId': self.publish(body['topic'],
+                                                  [body['message']])[0]}
+            if method == 'POST' and rest == 'publishBatch':
+                return {'messageIds': self.publish(body['topic'],
+                                                   body['messages'])}
+            if method == 'GET' and rest:
+                return self.get_topic(rest)
+            if method == 'DELETE' and rest:
+                return self.delete_topic(rest)
+
+        elif collection == 'subscriptions':
+            if method == 'POST' and not rest:
+                return self.create_subscription(
+                    body['name'], body['topic'], body.get('pushConfig'),
+                    body.get('ackDeadlineSeconds'))
+            if method == 'POST' and rest == 'pull':
+                responses = self.pull(body['subscription'], 1,
+                                      not body.get('returnImmediately'))
+                return responses[0] if responses else {'pubsubEvent': {}}
+            if method == 'POST' and rest == 'pullBatch':
+                return {'pullResponses': self.pull(
+                    body['subscription'], body.get('maxEvents', 1),
+                    not body.get('returnImmediately'))}
+            if method == 'POST' and rest == 'acknowledge':
+                return self.acknowledge(body['subscription'],
+                                        _ack_ids(body))
+            if method == 'POST' and rest == 'modifyAckDeadline':
+                return self.modify_ack_deadline(
+                    body['subscription'], _ack_ids(body),
+                    body.get('ackDeadlineSeconds', 0))
+            if method == 'GET' and rest:
+                return self.get_subscription(rest)
+            if method == 'DELETE' and rest:
+                return self.delete_subscription(rest)
+
+        raise _error(404, 'No method %s %s' % (method, path))
+
+    def wsgi_app(self, environ, start_response):
+        """A WSGI application serving the REST API under API_PATH."""
+
+        path = environ.get('PATH_INFO', '')
+        try:
+            if not path.startswith(API_PATH):
+                raise _error(404, 'Not found')
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+            body = None
+            if length:
+                body = json.loads(
+                    environ['wsgi.input'].read(length).decode('utf-8'))
+            status = 200
+            content = json.dumps(self.handle(environ['REQUEST_METHOD'],
+                                             path[len(API_PATH):], body))
+        except errors.HttpError as e:
+            status = e.resp.status
+            content = e.content.decode('utf-8')
+        except (ValueError, KeyError, TypeError) as e:
+            status = 400
+            content = json.dumps({'error': {'code': 400,
+                                            'message': str(e)}})
+
+        content = content.encode('utf-8')
+        start_response('%d %s' % (status, _REASONS.get(status, 'Error')),
+                       [('Content-Type', 'application/json'),
+                        ('Content-Length', str(len(content)))])
+        return [content]
+
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+            409: 'Conflict'}
+
+
+def _ack_ids(body):
+    ack_ids = body.get('ackIds') or body.get('ackId') or []
+    if not isinstance(ack_ids, list):
+        ack_ids = [ack_ids]
+    return ack_ids
+
+
+class _Request(object):
+    """A request built by the emulator's resources. Like the requests of a
+    discovery service, it is only sent when executed.
+    """
+
+    def __init__(self, fn, *args):
+        self.fn = fn
+        self.args = args
+
+    def execute(self, http=None):
+        # Bodies and responses are round-tripped through JSON as they would
+        # be on the wire, so callers can't share state with the emulator.
+        args = json.loads(json.dumps(self.args))
+        return json.loads(json.dumps(self.fn(*args)))
+
+
+class _Topics(object):
+
+    def __init__(self, emulator):
+        self._emulator = emulator
+
+    def get(self, topic):
+        return _Request(self._emulator.get_topic, topic)
+
+    def create(self, body):
+        return _Request(self._emulator.create_topic, body['name'])
+
+    def delete(self, topic):
+        return _Request(self._emulator.delete_topic, topic)
+
+    def publish(self, body):
+        return _Request(lambda body: self._emulator.handle(
+            'POST', 'topics/publish', body), body)
+
+    def publishBatch(self, body):
+        return _Request(lambda body: self._emulator.handle(
+            'POST', 'topics/publishBatch', body), body)
+
+
+class _Subscriptions(object):
+
+    def __init__(self, emulator):
+        self._emulator = emulator
+
+    def get(self, subscription):
+        return _Request(self._emulator.get_subscription, subscription)
+
+    def create(self, body):
+        return self._post('', body)
+
+    def delete(self, subscription):
+        return _Request(self._emulator.delete_subscription, subscription)
+
+    def pull(self, body):
+        return self._post('pull', body)
+
+    def pullBatch(self, body):
+        return self._post('pullBatch', body)
+
+    def acknowledge(self, body):
+        return self._post('acknowledge', body)
+
+    def modifyAckDeadline(self, body):
+        return self._post('modifyAckDeadline', body)
+
+    def _post(self, method, body):
+        path = 'subscriptions/%s' % method if method else 'subscriptions'
+        return _Request(lambda body: self._emulator.handle('POST', path,
+                                                           body), body)
+
+
+class _BatchRequest(object):
+    """Executes the requests added to it one by one, reporting each result
+    to the callback like an HTTP batch request.
+    """
+
+    def __init__(self, callback):
+        self._callback = callback
+        self._requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        if request_id is None:
+            request_id = str(len(self._requests))
+        self._requests.append((request_id, request, callback))
+
+    def execute(self, http=None):
+        for request_id, request, callback in self._requests:
+            try:
+                response, exception = request.execute(), None
+            except errors.HttpError as e:
+                response, exception = None, e
+            callback = callback or self._callback
+            if callback:
+                callback(request_id, response, exception)
+
+
+class _ThreadingWSGIServer(ThreadingMixIn, simple_server.WSGIServer):
+    daemon_threads = True
+
+
+class _QuietHandler(simple_server.WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+class EmulatorServer(object):
+    """Serves an Emulator's REST API over local HTTP from a background
+    thread. Each request is handled on its own thread so blocking pulls
+    don't hold up other requests.
+    """
+
+    def __init__(self, emulator=None, host='127.0.0.1', port=0):
+        """Args:
+            emulator: the Emulator to serve, defaults to a new one.
+            host: the interface to listen on.
+            port: the port to listen on, 0 picks a free one.
+        """
+
+        self.emulator = emulator or Emulator()
+        self._server = simple_server.make_server(
+            host, port, self.emulator.wsgi_app,
+            server_class=_ThreadingWSGIServer, handler_class=_QuietHandler)
+        self.host = host
+        self.port = self._server.server_port
+        self._thread = None
+
+    @property
+    def url(self):
+        """The API root to send requests to."""
+
+        return 'http://%s:%d%s' % (self.host, self.port, API_PATH)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='pubsub-emulator')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        """Serve requests on the calling thread until stop is called."""
+
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m pubsub.emulator',
+                                     description='Serve an in-memory Pub/Sub '
+                                     'backend over HTTP.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8085)
+    parser.add_argument('--ack-deadline', type=int,
+                        default=DEFAULT_ACK_DEADLINE)
+    args = parser.parse_args(argv)
+
+    server = EmulatorServer(Emulator(ack_deadline=args.ack_deadline),
+                            args.host, args.port)
+    print('Serving the Pub/Sub API at %s' % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+import collections
+import logging
+import math
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class LeaseManager(object):
+    """Extends the ack deadlines of pulled messages until they are
+    acknowledged or released, so a handler which runs longer than the
+    subscription's ack deadline doesn't have its message redelivered to
+    another worker. A background thread sends one modifyAckDeadline request
+    for all the messages of a subscription whose deadlines are due to expire
+    within lead_time seconds.
+
+    Each extension lasts for the given percentile of the recent time
+    messages took from being pulled to being acknowledged, bounded by
+    min_extension and max_extension, so leases track how long handlers
+    actually take. Leases aren't extended past max_lease seconds after the
+    pull, so a stuck handler's message is eventually redelivered.
+    """
+
+    def __init__(self, client, ack_deadline=10, min_extension=10,
+                 max_extension=600, max_lease=3600, percentile=99,
+                 lead_time=2, max_batch=1000, window=1000):
+        """Args:
+            client: the PubSubClient used to send the extensions.
+            ack_deadline: the ack deadline in seconds of the subscriptions,
+                          which is how long a pulled message is leased for
+                          before its first extension.
+            min_extension: the minimum number of seconds an extension lasts.
+            max_extension: the maximum number of seconds an extension lasts.
+            max_lease: the maximum number of seconds a message is leased for
+                       after it was pulled.
+            percentile: the percentile of the recent handling times an
+                        extension lasts for.
+            lead_time: the number of seconds before a deadline expires that
+                       it is extended.
+            max_batch: the maximum number of ack ids sent in one request.
+            window: the number of recent handling times the percentile is
+                    taken over.
+        """
+
+        self.client = client
+        self.ack_deadline = ack_deadline
+        self.min_extension = min_extension
+        self.max_extension = max_extension
+        self.max_lease = max_lease
+        self.percentile = percentile
+        self.lead_time = lead_time
+        self.max_batch = max_batch
+
+        self.extended = 0
+        self.requests = 0
+        self.expired = 0
+        self.failed = 0
+
+        self._cond = threading.Condition()
+        # Leases by subscription and ack id, as lists of the time the message
+        # was pulled and its current deadline.
+        self._leases = {}
+        self._durations = collections.deque(maxlen=window)
+        self._closed = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='pubsub-lease-manager')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, subscription, ack_ids):
+        """Start leasing pulled messages.
+
+        Args:
+            subscription: the full name of the subscription the messages were
+                          pulled from.
+            ack_ids: a list of ack ids of the messages.
+        """
+
+        if not ack_ids:
+            return
+
+        now = time.time()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('LeaseManager has been closed')
+            leases = self._leases.setdefault(subscription, {})
+            for ack_id in ack_ids:
+                leases[ack_id] = [now, now + self.ack_deadline]
+            self._cond.notify_all()
+
+    def remove(self, subscription, ack_ids, handled=True):
+        """Stop leasing messages.
+
+        Args:
+            subscription: the full name of the subscription the messages were
+                          pulled from.
+            ack_ids: a list of ack ids of the messages.
+            handled: bool indicating if the messages were handled, so their
+                     handling times should inform future extensions.
+        """
+
+        now = time.time()
+        with self._cond:
+            leases = self._leases.get(subscription)
+            if not leases:
+                return
+            for ack_id in ack_ids:
+                lease = leases.pop(ack_id, None)
+                if lease is not None and handled:
+                    self._durations.append(now - lease[0])
+            if not leases:
+                del self._leases[subscription]
+
+    def extension(self):
+        """Return the number of seconds the next extension will last."""
+
+        with self._cond:
+            return self._extension()
+
+    def close(self):
+        """Stop extending leases."""
+
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def stats(self):
+        """Return a dict of the number of leased messages, the number of
+        extensions and extension requests sent, the number of leases which
+        reached max_lease, the number of extensions which failed and the
+        current extension length.
+        """
+
+        with self._cond:
+            return {
+                'leased': sum(len(leases) for leases in
+                              self._leases.values()),
+                'extended': self.extended,
+                'requests': self.requests,
+                'expired': self.expired,
+                'failed': self.failed,
+                'extension': self._extension(),
+            }
+
+    def _extension(self):
+        # Must be called with self._cond held.
+        if not self._durations:
+            return self.min_extension
+        durations = sorted(self._durations)
+        index = int(math.ceil(self.percentile / 100.0 * len(durations))) - 1
+        seconds = int(math.ceil(durations[max(index, 0)]))
+        return max(self.min_extension, min(self.max_extension, seconds))
+
+    def _take_due(self, now):
+        # Must be called with self._cond held. Returns the extensions to send
+        # as (subscription, seconds, ack_ids, previous deadlines) tuples,
+        # having moved the leases' deadlines forward, and the time the next
+        # lease is due.
+        extension = self._extension()
+        # Leases due a little later are extended along with those due now,
+        # so extensions go out in fewer, larger requests.
+        horizon = now + self.lead_time * 1.5
+        groups = {}
+        next_due = None
+        for subscription, leases in list(self._leases.items()):
+            for ack_id, lease in list(leases.items()):
+                pulled_at, deadline = lease
+                if deadline > horizon:
+                    due = deadline - self.lead_time
+                    next_due = due if next_due is None else min(next_due, due)
+                    continue
+                remaining = pulled_at + self.max_lease - now
+                seconds = int(min(extension, remaining))
+                if seconds < 1:
+                    # The lease has run out; the message is left to be
+                    # redelivered once its deadline passes.
+                    del leases[ack_id]
+                    self.expired += 1
+                    continue
+                group = groups.setdefault((subscription, seconds), ([], []))
+                group[0].append(ack_id)
+                group[1].append(deadline)
+                lease[1] = now + seconds
+                due = lease[1] - self.lead_time
+                next_due = due if next_due is None else min(next_due, due)
+            if not leases:
+                del self._leases[subscription]
+
+        extensions = []
+        for (subscription, seconds), (ack_ids, deadlines) in groups.items():
+            for i in range(0, len(ack_ids), self.max_batch):
+                extensions.append((subscription, seconds,
+                                   ack_ids[i:i + self.max_batch],
+                                   deadlines[i:i + self.max_batch]))
+        return extensions, next_due
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._closed:
+                    return
+                extensions, next_due = self._take_due(time.time())
+                if not extensions:
+                    if next_due is None:
+                        self._cond.wait()
+                    else:
+                        self._cond.wait(max(next_due - time.time(), 0.01))
+                    continue
+
+            failed = False
+            for subscription, seconds, ack_ids, deadlines in extensions:
+                if not self._send(subscription, seconds, ack_ids, deadlines):
+                    failed = True
+            if failed:
+                # Failed extensions are due again straight away, so pause
+                # before retrying them.
+                with self._cond:
+                    if not self._closed:
+                        self._cond.wait(min(1, self.lead_time / 4.0))
+
+    def _send(self, subscription, seconds, ack_ids, deadlines):
+        # Returns True if the extension was sent.
+        try:
+            self.client._send_modify_ack_deadline(subscription, ack_ids,
+                                                  seconds)
+        except Exception:
+            logger.exception('Failed to extend %d leases', len(ack_ids))
+            with self._cond:
+                self.failed += len(ack_ids)
+                # The leases keep their previous deadlines, so the
+                # extension is retried while there is still time.
+                leases = self._leases.get(subscription, {})
+                for ack_id, deadline in zip(ack_ids, deadlines):
+                    if ack_id in leases:
+                        leases[ack_id][1] = deadline
+            return False
+
+        with self._cond:
+            self.extended += len(ack_ids)
+            self.requests += 1
+        return True
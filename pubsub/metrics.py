@@ -0,0 +1,164 @@
+import bisect
+import threading
+import time
+
+# The most precise clock available, used to time operations.
+clock = getattr(time, 'perf_counter', time.time)
+
+# The upper bounds in seconds of the latency histogram buckets, from 100
+# microseconds doubling up to about 105 seconds.
+DEFAULT_BUCKETS = tuple(0.0001 * 2 ** i for i in range(21))
+
+
+class Metrics(object):
+    """Receives instrumentation events from a PubSubClient. Subclasses
+    override the hooks they are interested in, the default implementations
+    do nothing. Hooks are called from every thread using the client, so
+    they need to be thread-safe and cheap.
+    """
+
+    def record_request(self, operation, duration, status=None):
+        """Called once a request has completed, including any retries.
+
+        Args:
+            operation: the name of the operation, e.g. "publish" or "pull".
+            duration: the time the request took in seconds.
+            status: None if the request succeeded, otherwise the HTTP status
+                    of the error or, for other errors, its class name.
+        """
+
+    def record_messages(self, operation, count, size):
+        """Called when messages have been published, pulled or acknowledged.
+
+        Args:
+            operation: "publish", "pull" or "acknowledge".
+            count: the number of messages.
+            size: the total size of the messages' base64 encoded data.
+        """
+
+    def record_codec(self, direction, duration):
+        """Called after a message has been encoded or decoded.
+
+        Args:
+            direction: "encode" or "decode".
+            duration: the time encoding or decoding took in seconds.
+        """
+
+
+class Histogram(object):
+    """Counts observations in fixed buckets. Percentiles are estimated as
+    the upper bound of the bucket they fall in, capped at the largest
+    observation. Not thread-safe.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """Return an estimate of the given percentile, or None if nothing
+        was observed.
+        """
+
+        if not self.count:
+            return None
+
+        rank = self.count * percent / 100.0
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                if i == len(self.buckets):
+                    return self.max
+                return min(self.buckets[i], self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+        }
+
+
+class InMemoryMetrics(Metrics):
+    """Aggregates instrumentation events in memory: latency histograms per
+    operation, error counts per operation and status, message and byte
+    counters per operation and encode and decode time histograms.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.reset()
+
+    def record_request(self, operation, duration, status=None):
+        with self._lock:
+            self._histogram(self._latency, operation).observe(duration)
+            if status is not None:
+                errors = self._errors.setdefault(operation, {})
+                errors[status] = errors.get(status, 0) + 1
+
+    def record_messages(self, operation, count, size):
+        with self._lock:
+            self._messages[operation] = \
+                self._messages.get(operation, 0) + count
+            self._bytes[operation] = self._bytes.get(operation, 0) + size
+
+    def record_codec(self, direction, duration):
+        with self._lock:
+            self._histogram(self._codec, direction).observe(duration)
+
+    def snapshot(self):
+        """Return a dict of the metrics recorded so far, made of plain
+        dicts and numbers so it can be serialized as JSON.
+        """
+
+        with self._lock:
+            return {
+                'latency': dict((operation, histogram.summary())
+                                for operation, histogram
+                                in self._latency.items()),
+                'errors': dict((operation, dict(errors))
+                               for operation, errors
+                               in self._errors.items()),
+                'messages': dict(self._messages),
+                'bytes': dict(self._bytes),
+                'codec': dict((direction, histogram.summary())
+                              for direction, histogram
+                              in self._codec.items()),
+            }
+
+    def reset(self):
+        """Forget everything recorded so far."""
+
+        with self._lock:
+            self._latency = {}
+            self._errors = {}
+            self._messages = {}
+            self._bytes = {}
+            self._codec = {}
+
+    def _histogram(self, histograms, key):
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram(self.buckets)
+        return histogram
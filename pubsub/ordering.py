@@ -0,0 +1,394 @@
+"""A subscriber which handles messages with the same key one at a time, in
+the order they were pulled, while messages with different keys are handled
+in parallel.
+"""
+
+import collections
+import logging
+import threading
+import time
+
+from pubsub.dedup import drop_duplicates
+from pubsub.dedup import message_key
+from pubsub.pulling import PullEngine
+
+logger = logging.getLogger(__name__)
+
+# What the puller does with a message whose key already has max_key_messages
+# queued.
+BLOCK = 'block'
+DEFER = 'defer'
+
+
+class OrderedSubscriber(object):
+    """Pulls messages from a subscription and routes each one by the key
+    returned by a key function to a serial queue for that key. Worker
+    threads take turns on the keys with queued messages, handling one
+    message of a key at a time, so messages with the same key are handled
+    in the order they were pulled and a hot key occupies at most one worker.
+    Messages for which the key function returns None aren't ordered.
+
+    A message is acknowledged once the handler returns. If the handler
+    raises, the message and the messages queued behind it for the same key
+    are left unacknowledged for redelivery.
+
+    Flow control bounds the number and total size of messages pulled but not
+    yet handled, as for Subscriber, and each key's queue holds at most
+    max_key_messages. When a key's queue is full, the puller either waits for
+    it to drain, which keeps strict ordering but slows other keys down to
+    the hot key's pace, or, with overflow set to DEFER, leaves the message
+    unacknowledged for redelivery, which keeps other keys flowing.
+
+    Once a key has messages left for redelivery, the key is held: its later
+    messages are left for redelivery too, and its messages are only handled
+    again as the earliest one left comes back, so none of them overtake it.
+    Messages are matched by message id, or by content if they have none.
+    The earliest message is nacked with a zero ack deadline so it comes back
+    straight away rather than once its deadline passes. A hold is dropped
+    if the message it waits for hasn't come back within max_hold seconds,
+    for instance because another subscriber handled it.
+    """
+
+    def __init__(self, client, subscription, handler, key, workers=4,
+                 max_outstanding_messages=1000,
+                 max_outstanding_bytes=10 * 1024 * 1024, max_key_messages=100,
+                 overflow=BLOCK, batch_size=None, max_hold=600,
+                 deduplicator=None):
+        """Args:
+            client: the PubSubClient used to pull and acknowledge messages.
+            subscription: the name of the subscription to pull from.
+            handler: a callable invoked with each Message.
+            key: a callable returning the ordering key of a Message.
+            workers: the number of worker threads running the handler.
+            max_outstanding_messages: the maximum number of messages pulled
+                                      but not yet handled.
+            max_outstanding_bytes: the maximum total size in bytes of the
+                                   messages pulled but not yet handled.
+            max_key_messages: the maximum number of messages queued for one
+                              key.
+            overflow: BLOCK or DEFER, what to do with a message whose key's
+                      queue is full.
+            batch_size: the maximum number of messages fetched per pull,
+                        defaults to the smaller of max_outstanding_messages
+                        and 1000.
+            max_hold: the maximum number of seconds a key is held waiting
+                      for a message left for redelivery to come back.
+            deduplicator: if provided, a pubsub.dedup.Deduplicator used to
+                          acknowledge and drop messages which have already
+                          been handled.
+        """
+
+        if workers < 1:
+            raise ValueError('workers must be at least 1')
+        if max_outstanding_messages < 1:
+            raise ValueError('max_outstanding_messages must be at least 1')
+        if max_key_messages < 1:
+            raise ValueError('max_key_messages must be at least 1')
+        if overflow not in (BLOCK, DEFER):
+            raise ValueError('overflow must be %r or %r' % (BLOCK, DEFER))
+
+        self.client = client
+        self.subscription = subscription
+        self.handler = handler
+        self.key = key
+        self.workers = workers
+        self.max_outstanding_messages = max_outstanding_messages
+        self.max_outstanding_bytes = max_outstanding_bytes
+        self.max_key_messages = max_key_messages
+        self.overflow = overflow
+        self.batch_size = min(batch_size or 1000, max_outstanding_messages)
+        self.max_hold = max_hold
+        self.deduplicator = deduplicator
+
+        self.outstanding_messages = 0
+        self.outstanding_bytes = 0
+        self.processed = 0
+        self.failed = 0
+        self.deferred = 0
+        self.duplicates = 0
+
+        self._cond = threading.Condition()
+        # The queued messages of each key with messages being handled or
+        # waiting, as tuples of their identity and the message, and the keys
+        # with waiting messages which no worker holds, in the order workers
+        # take them.
+        self._queues = {}
+        self._ready = collections.deque()
+        # The keys with messages left for redelivery.
+        self._holds = {}
+        self._engine = None
+        self._threads = []
+        self._running = False
+        self._stopping = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        """Start pulling and handling messages."""
+
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+            self._stopping = False
+
+        # A single pull at a time keeps the messages in the order they
+        # were pulled.
+        self._engine = PullEngine(
+            self.client, self.subscription, self._cond, self._capacity,
+            self._deliver, batch_size=self.batch_size,
+            name='pubsub-ordered-subscriber-%s-puller' % self.subscription)
+        self._threads = [
+            threading.Thread(
+                target=self._work_loop,
+                name='pubsub-ordered-subscriber-%s-%d' % (self.subscription,
+                                                          i))
+            for i in range(self.workers)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+        self._engine.start()
+
+    def stop(self, timeout=None):
+        """Stop pulling messages and wait for the workers to finish handling
+        the messages which have already been pulled.
+
+        Args:
+            timeout: the maximum number of seconds to wait for each thread,
+                     or None to wait indefinitely.
+        """
+
+        with self._cond:
+            if not self._running:
+                return
+            self._stopping = True
+            self._cond.notify_all()
+
+        # The puller may be blocked in a long-poll pull, which isn't waited
+        # for; any messages it receives are released for redelivery.
+        self._engine.stop()
+
+        for thread in self._threads:
+            thread.join(timeout)
+
+        with self._cond:
+            self._running = False
+
+    def stats(self):
+        """Return a dict of the outstanding, processed, failed, deferred and
+        duplicate message counts, the outstanding bytes, the number of keys
+        with queued messages, the length of the longest key queue and the
+        number of held keys.
+        """
+
+        with self._cond:
+            return {
+                'outstanding_messages': self.outstanding_messages,
+                'outstanding_bytes': self.outstanding_bytes,
+                'processed': self.processed,
+                'failed': self.failed,
+                'deferred': self.deferred,
+                'duplicates': self.duplicates,
+                'keys': len(self._queues),
+                'max_key_depth': max([len(queue) for queue in
+                                      self._queues.values()] or [0]),
+                'held_keys': len(self._holds),
+            }
+
+    def _capacity(self):
+        # Called with self._cond held.
+        if self._stopping:
+            return None
+        if self.outstanding_bytes >= self.max_outstanding_bytes:
+            return 0
+        return self.max_outstanding_messages - self.outstanding_messages
+
+    def _deliver(self, messages):
+        pulled = len(messages)
+        if self.deduplicator is not None:
+            messages = drop_duplicates(self.client, self.subscription,
+                                       self.deduplicator, messages)
+
+        with self._cond:
+            self.duplicates += pulled - len(messages)
+            self._expire_holds()
+        left = []
+        for message in messages:
+            try:
+                key = self.key(message)
+            except Exception:
+                logger.exception('Failed to get the key of %r', message)
+                with self._cond:
+                    self.failed += 1
+                left.append(message)
+                continue
+            if key is None:
+                # A key of its own puts no constraint on the message.
+                key = object()
+            if not self._enqueue(key, message_key(message), message):
+                left.append(message)
+
+        # Messages which weren't queued are left to be redelivered.
+        self.client.release(self.subscription,
+                            [message.ack_id for message in left])
+        self._nack_heads()
+
+    def _enqueue(self, key, identity, message):
+        # Returns False if the message was deferred or the subscriber is
+        # stopping.
+        with self._cond:
+            queue = self._queues.get(key)
+            full = queue is not None and len(queue) >= self.max_key_messages
+            hold = self._holds.get(key)
+            if hold is not None:
+                if hold.head() != identity or \
+                        (full and self.overflow == DEFER):
+                    hold.add(identity, message.ack_id)
+                    self.deferred += 1
+                    return False
+                # The earliest message left for redelivery has come back.
+                hold.pop()
+                if not hold.identities:
+                    del self._holds[key]
+            elif full and self.overflow == DEFER:
+                self._holds[key] = _Hold([(identity, message.ack_id)])
+                self.deferred += 1
+                return False
+
+            if self.overflow == BLOCK:
+                while not self._stopping and queue and \
+                        len(queue) >= self.max_key_messages:
+                    self._cond.wait()
+                    queue = self._queues.get(key)
+            if self._stopping:
+                return False
+
+            if queue is None:
+                queue = self._queues[key] = collections.deque()
+                self._ready.append(key)
+            queue.append((identity, message))
+            self.outstanding_messages += 1
+            self.outstanding_bytes += message.size
+            self._cond.notify_all()
+            return True
+
+    def _expire_holds(self):
+        # Must be called with self._cond held.
+        now = time.time()
+        for key, hold in list(self._holds.items()):
+            if now - hold.since > self.max_hold:
+                logger.warning('Gave up waiting for %d messages left for '
+                               'redelivery', len(hold.identities))
+                del self._holds[key]
+
+    def _nack_heads(self):
+        # Makes the earliest messages the holds wait for available for
+        # redelivery straight away. Each is nacked once, as a message only
+        # becomes the head of its hold while it is left for redelivery.
+        with self._cond:
+            ack_ids = [hold.nack() for hold in self._holds.values()
+                       if not hold.nacked]
+        if not ack_ids:
+            return
+        try:
+            self.client.modify_ack_deadline(self.subscription, ack_ids, 0)
+        except Exception:
+            logger.exception('Failed to nack %d messages held keys wait for',
+                             len(ack_ids))
+
+    def _work_loop(self):
+        while True:
+            with self._cond:
+                while not self._ready and not self._stopping:
+                    self._cond.wait()
+                if not self._ready:
+                    return
+                # The key's queue stays in self._queues while its message is
+                # handled, so the puller appends rather than making it ready
+                # again.
+                key = self._ready.popleft()
+                message = self._queues[key][0][1]
+
+            try:
+                self.handler(message)
+            except Exception:
+                logger.exception('Handler failed for %r', message)
+                succeeded = False
+            else:
+                succeeded = True
+
+            if succeeded:
+                if self.deduplicator is not None:
+                    self.deduplicator.add(self.deduplicator.key(message))
+                try:
+                    self.client.acknowledge(message.subscription,
+                                            [message.ack_id])
+                except Exception:
+                    logger.exception('Failed to acknowledge %r', message)
+
+            with self._cond:
+                queue = self._queues[key]
+                released = [queue.popleft()]
+                if succeeded:
+                    self.processed += 1
+                else:
+                    self.failed += 1
+                    self.deferred += len(queue)
+                    released.extend(queue)
+                    queue.clear()
+                    # The key is held until the messages come back, ahead
+                    # of those already left for redelivery.
+                    hold = self._holds.get(key)
+                    self._holds[key] = _Hold(
+                        [(identity, released_message.ack_id)
+                         for identity, released_message in released] +
+                        (list(hold.identities.items()) if hold else []))
+                released = [released_message
+                            for _, released_message in released]
+                for released_message in released:
+                    self.outstanding_messages -= 1
+                    self.outstanding_bytes -= released_message.size
+                if queue:
+                    self._ready.append(key)
+                else:
+                    del self._queues[key]
+                self._cond.notify_all()
+
+            if not succeeded:
+                self.client.release(self.subscription,
+                                    [released_message.ack_id
+                                     for released_message in released])
+                self._nack_heads()
+
+
+class _Hold(object):
+    # The identities of a key's messages left for redelivery, in the order
+    # they were pulled, with the ack id of their latest delivery.
+
+    def __init__(self, identities):
+        self.identities = collections.OrderedDict(identities)
+        self.since = time.time()
+        # Whether the head has been nacked.
+        self.nacked = False
+
+    def head(self):
+        return next(iter(self.identities))
+
+    def add(self, identity, ack_id):
+        # Assigning an existing identity keeps its position.
+        self.identities[identity] = ack_id
+
+    def pop(self):
+        self.identities.popitem(last=False)
+        self.since = time.time()
+        self.nacked = False
+
+    def nack(self):
+        # Returns the ack id of the head, which is to be nacked.
+        self.nacked = True
+        return self.identities[self.head()]
@@ -0,0 +1,436 @@
+"""A subscriber which runs handlers in worker processes, so CPU-bound
+handlers aren't serialized by the GIL.
+"""
+
+import itertools
+import logging
+import multiprocessing
+import pickle
+import signal
+import threading
+
+from pubsub.client import Message
+from pubsub.codec import _readable
+from pubsub.dedup import drop_duplicates
+from pubsub.pulling import PullEngine
+
+logger = logging.getLogger(__name__)
+
+# How the data of a message is sent to a worker: bytes-like data is sent
+# as it is, other values decoded by a codec are pickled.
+_RAW = 0
+_PICKLED = 1
+
+# An empty frame tells a worker to exit once it has handled everything it
+# was sent.
+_STOP = b''
+
+
+def _send_batch(conn, batch_id, messages):
+    # A small pickled header describing the batch is followed by one frame
+    # per message. send_bytes writes buffers straight to the pipe, so large
+    # payloads are never pickled or copied into a bigger frame.
+    header = []
+    payloads = []
+    for message in messages:
+        data = message.data
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            kind = _RAW
+        else:
+            kind = _PICKLED
+            data = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        header.append((message.subscription, message.ack_id,
+                       message.message_id, message.size, kind))
+        payloads.append(data)
+
+    conn.send_bytes(pickle.dumps((batch_id, header),
+                                 pickle.HIGHEST_PROTOCOL))
+    for data in payloads:
+        conn.send_bytes(_readable(data))
+
+
+def _recv_batch(conn):
+    frame = conn.recv_bytes()
+    if frame == _STOP:
+        return None
+
+    batch_id, header = pickle.loads(frame)
+    messages = []
+    for subscription, ack_id, message_id, size, kind in header:
+        data = conn.recv_bytes()
+        if kind == _PICKLED:
+            data = pickle.loads(data)
+        messages.append(Message(subscription, ack_id, data, message_id,
+                                size))
+    return batch_id, messages
+
+
+def _worker_main(conn, handler):
+    # The parent decides when workers stop, so Ctrl-C isn't handled here.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    while True:
+        try:
+            batch = _recv_batch(conn)
+        except EOFError:
+            return
+        if batch is None:
+            conn.close()
+            return
+
+        batch_id, messages = batch
+        acked = []
+        failed = 0
+        for message in messages:
+            try:
+                handler(message)
+            except Exception:
+                logger.exception('Handler failed for %r', message)
+                failed += 1
+            else:
+                acked.append(message.ack_id)
+        conn.send((batch_id, acked, failed))
+
+
+class _Worker(object):
+
+    def __init__(self, index, handler):
+        self.index = index
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=_worker_main, args=(child_conn, handler),
+            name='pubsub-worker-%d' % index)
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+
+        # Batches assigned to the worker which it hasn't reported on yet, by
+        # batch id, and the ids of those which were sent in the order they
+        # were written to the pipe. The worker handles batches in that
+        # order, so if it dies, the first of them is the one it was
+        # handling.
+        self.in_flight = {}
+        self.sent = []
+        self.outstanding = 0
+        self.alive = True
+        self.send_lock = threading.Lock()
+        self.receiver = None
+
+
+class ProcessSubscriber(object):
+    """Pulls messages from a subscription in the calling process and
+    dispatches them in batches to a pool of worker processes which run a
+    handler. Workers report the messages they handled successfully once per
+    batch, and those are acknowledged together, so the parent sends one
+    acknowledge request per batch rather than per message.
+
+    Message data which is bytes-like is written to the workers' pipes as it
+    is; only values decoded by a codec are pickled. The handler has to be
+    picklable on platforms which don't fork, and it runs in a separate
+    process, so it can't share state with the caller.
+
+    Flow control bounds the number and total size of messages which have
+    been pulled but not yet handled, as for Subscriber. A worker which dies
+    is replaced, and the messages it held are redelivered by the backend.
+    """
+
+    def __init__(self, client, subscription, handler, processes=None,
+                 max_outstanding_messages=1000,
+                 max_outstanding_bytes=100 * 1024 * 1024, batch_size=None,
+                 worker_batch_size=None, deduplicator=None,
+                 max_concurrent_pulls=1):
+        """Args:
+            client: the PubSubClient used to pull and acknowledge messages.
+            subscription: the name of the subscription to pull from.
+            handler: a callable invoked with each Message in a worker
+                     process.
+            processes: the number of worker processes, defaults to the
+                       number of CPUs.
+            max_outstanding_messages: the maximum number of messages pulled
+                                      but not yet handled.
+            max_outstanding_bytes: the maximum total size in bytes of the
+                                   messages pulled but not yet handled.
+            batch_size: the maximum number of messages fetched per pull,
+                        defaults to the smaller of max_outstanding_messages
+                        and 1000.
+            worker_batch_size: the maximum number of messages sent to a
+                               worker at once, defaults to spreading each
+                               pull evenly over the workers.
+            deduplicator: if provided, a pubsub.dedup.Deduplicator used to
+                          acknowledge and drop messages which have already
+                          been handled.
+            max_concurrent_pulls: the maximum number of pulls in flight
+                                  while there is a backlog. See
+                                  pubsub.pulling.PullEngine.
+        """
+
+        processes = processes or multiprocessing.cpu_count()
+        if processes < 1:
+            raise ValueError('processes must be at least 1')
+        if max_outstanding_messages < 1:
+            raise ValueError('max_outstanding_messages must be at least 1')
+
+        self.client = client
+        self.subscription = subscription
+        self.handler = handler
+        self.processes = processes
+        self.max_outstanding_messages = max_outstanding_messages
+        self.max_outstanding_bytes = max_outstanding_bytes
+        self.batch_size = min(batch_size or 1000, max_outstanding_messages)
+        self.worker_batch_size = worker_batch_size
+        self.deduplicator = deduplicator
+        self.max_concurrent_pulls = max_concurrent_pulls
+
+        self.outstanding_messages = 0
+        self.outstanding_bytes = 0
+        self.processed = 0
+        self.failed = 0
+        self.duplicates = 0
+        self.restarts = 0
+
+        self._cond = threading.Condition()
+        self._batch_ids = itertools.count()
+        self._workers = []
+        self._engine = None
+        self._running = False
+        self._stopping = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        """Start the worker processes and begin pulling messages."""
+
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+            self._stopping = False
+            self._workers = [self._start_worker(i)
+                             for i in range(self.processes)]
+
+        self._engine = PullEngine(
+            self.client, self.subscription, self._cond, self._capacity,
+            self._deliver, max_concurrency=self.max_concurrent_pulls,
+            batch_size=self.batch_size,
+            name='pubsub-process-subscriber-%s-puller' % self.subscription)
+        self._engine.start()
+
+    def stop(self, timeout=None):
+        """Stop pulling messages and wait for the workers to finish handling
+        the messages they have already been sent.
+
+        Args:
+            timeout: the maximum number of seconds to wait for each thread
+                     and process, or None to wait indefinitely.
+        """
+
+        with self._cond:
+            if not self._running:
+                return
+            self._stopping = True
+            self._cond.notify_all()
+            workers = list(self._workers)
+
+        # The pullers may be blocked in long-poll pulls, which aren't waited
+        # for; any messages they receive are released for redelivery.
+        self._engine.stop()
+
+        for worker in workers:
+            with worker.send_lock:
+                if worker.alive:
+                    try:
+                        worker.conn.send_bytes(_STOP)
+                    except (IOError, OSError):
+                        pass
+        for worker in workers:
+            worker.receiver.join(timeout)
+            worker.process.join(timeout)
+            if worker.process.is_alive():
+                worker.process.terminate()
+            worker.conn.close()
+
+        with self._cond:
+            self._workers = []
+            self._running = False
+
+    def stats(self):
+        """Return a dict of the outstanding, processed, failed and duplicate
+        message counts, the outstanding bytes, the number of workers
+        restarted and the current number of concurrent pulls.
+        """
+
+        with self._cond:
+            return {
+                'outstanding_messages': self.outstanding_messages,
+                'outstanding_bytes': self.outstanding_bytes,
+                'processed': self.processed,
+                'failed': self.failed,
+                'duplicates': self.duplicates,
+                'restarts': self.restarts,
+                'pull_concurrency':
+                    self._engine.concurrency if self._engine else 0,
+            }
+
+    def _start_worker(self, index):
+        # Must be called with self._cond held.
+        worker = _Worker(index, self.handler)
+        worker.receiver = threading.Thread(
+            target=self._receive, args=(worker,),
+            name='pubsub-process-subscriber-%s-%d' % (self.subscription,
+                                                      index))
+        worker.receiver.daemon = True
+        worker.receiver.start()
+        return worker
+
+    def _capacity(self):
+        # Called with self._cond held.
+        if self._stopping:
+            return None
+        if self.outstanding_bytes >= self.max_outstanding_bytes:
+            return 0
+        return self.max_outstanding_messages - self.outstanding_messages
+
+    def _deliver(self, messages):
+        pulled = len(messages)
+        if self.deduplicator is not None:
+            messages = drop_duplicates(self.client, self.subscription,
+                                       self.deduplicator, messages)
+            with self._cond:
+                self.duplicates += pulled - len(messages)
+
+        if messages:
+            self._dispatch(messages)
+
+    def _dispatch(self, messages):
+        with self._cond:
+            workers = [worker for worker in self._workers if worker.alive]
+            if self._stopping or not workers:
+                assignments = None
+            else:
+                size = self.worker_batch_size or \
+                    -(-len(messages) // len(workers))
+                for message in messages:
+                    self.outstanding_messages += 1
+                    self.outstanding_bytes += message.size
+                assignments = self._assign(
+                    workers, [messages[i:i + size]
+                              for i in range(0, len(messages), size)])
+
+        if assignments is None:
+            # The messages are left to be redelivered.
+            self.client.release(self.subscription,
+                                [message.ack_id for message in messages])
+            return
+        self._send(assignments)
+
+    def _assign(self, workers, batches):
+        # Must be called with self._cond held. The least loaded worker gets
+        # the next batch.
+        assignments = []
+        for batch in batches:
+            worker = min(workers, key=lambda w: w.outstanding)
+            batch_id = next(self._batch_ids)
+            worker.outstanding += len(batch)
+            worker.in_flight[batch_id] = batch
+            assignments.append((worker, batch_id, batch))
+        return assignments
+
+    def _send(self, assignments):
+        for worker, batch_id, batch in assignments:
+            with worker.send_lock:
+                if not worker.alive:
+                    # The batch is reassigned when the worker's exit is
+                    # handled.
+                    continue
+                worker.sent.append(batch_id)
+                try:
+                    _send_batch(worker.conn, batch_id, batch)
+                except (IOError, OSError):
+                    logger.exception('Failed to send messages to worker %d',
+                                     worker.index)
+
+    def _receive(self, worker):
+        while True:
+            try:
+                batch_id, acked, failed = worker.conn.recv()
+            except (EOFError, IOError, OSError):
+                self._worker_exited(worker)
+                return
+
+            if acked:
+                try:
+                    self.client.acknowledge(self.subscription, acked)
+                except Exception:
+                    logger.exception('Failed to acknowledge %d messages',
+                                     len(acked))
+
+            with self._cond:
+                batch = worker.in_flight.pop(batch_id)
+                worker.sent.remove(batch_id)
+                handled = set(acked)
+                if self.deduplicator is not None and acked:
+                    for message in batch:
+                        if message.ack_id in handled:
+                            self.deduplicator.add(
+                                self.deduplicator.key(message))
+                self._release(worker, batch)
+                self.processed += len(acked)
+                self.failed += failed
+                self._cond.notify_all()
+
+            if failed:
+                self.client.release(self.subscription,
+                                    [message.ack_id for message in batch
+                                     if message.ack_id not in handled])
+
+    def _worker_exited(self, worker):
+        worker.process.join(1)
+        with worker.send_lock:
+            worker.alive = False
+
+        with self._cond:
+            in_flight, worker.in_flight = worker.in_flight, {}
+            # The batch the worker was handling is left for the backend to
+            # redeliver, in case one of its messages killed the worker. The
+            # batches it hadn't started are handed to its replacement.
+            crashed = []
+            if worker.sent:
+                crashed = in_flight.pop(worker.sent[0])
+                self._release(worker, crashed)
+            batches = [in_flight[batch_id] for batch_id in sorted(in_flight)]
+            for batch in batches:
+                self._release(worker, batch)
+            worker.conn.close()
+            self._cond.notify_all()
+
+            if self._stopping:
+                crashed = crashed + [message for batch in batches
+                                     for message in batch]
+                assignments = []
+            else:
+                logger.error('Worker %d exited unexpectedly with code %s, '
+                             'restarting it', worker.index,
+                             worker.process.exitcode)
+                self.restarts += 1
+                replacement = self._start_worker(worker.index)
+                self._workers[self._workers.index(worker)] = replacement
+                for batch in batches:
+                    for message in batch:
+                        self.outstanding_messages += 1
+                        self.outstanding_bytes += message.size
+                assignments = self._assign([replacement], batches)
+
+        self.client.release(self.subscription,
+                            [message.ack_id for message in crashed])
+        self._send(assignments)
+
+    def _release(self, worker, batch):
+        # Must be called with self._cond held.
+        worker.outstanding -= len(batch)
+        self.outstanding_messages -= len(batch)
+        self.outstanding_bytes -= sum(message.size for message in batch)
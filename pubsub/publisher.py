@@ -0,0 +1,271 @@
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+# The publishBatch API accepts at most this many messages per request.
+MAX_BATCH_MESSAGES = 1000
+
+
+class PublisherClosedError(Exception):
+    """Raised when publishing through a BatchPublisher which has been
+    closed.
+    """
+
+
+class PublishFuture(object):
+    """The pending result of a message published through a BatchPublisher.
+    Resolves to the message id assigned by the backend once the batch
+    containing the message has been sent.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._exception = None
+
+    def done(self):
+        """Return True if the message has been sent or failed."""
+
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """Return the message id, blocking until the message has been sent.
+
+        Args:
+            timeout: the maximum number of seconds to wait, or None to wait
+                     indefinitely.
+
+        Returns:
+            the id of the published message.
+
+        Raises:
+            the exception which caused the publish to fail, or RuntimeError if
+            the timeout elapsed.
+        """
+
+        if not self._event.wait(timeout):
+            raise RuntimeError('Timed out waiting for publish result')
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        """Return the exception which caused the publish to fail or None if
+        it succeeded, blocking until the message has been sent.
+        """
+
+        if not self._event.wait(timeout):
+            raise RuntimeError('Timed out waiting for publish result')
+        return self._exception
+
+    def add_done_callback(self, fn):
+        """Call fn with this future once it is done. If the future is already
+        done, fn is called immediately.
+        """
+
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        self._invoke(fn)
+
+    def set_result(self, result):
+        self._resolve(result, None)
+
+    def set_exception(self, exception):
+        self._resolve(None, exception)
+
+    def _resolve(self, result, exception):
+        with self._lock:
+            self._result = result
+            self._exception = exception
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            self._invoke(fn)
+
+    def _invoke(self, fn):
+        # Callbacks run on the flusher thread, which must survive them.
+        try:
+            fn(self)
+        except Exception:
+            logger.exception('Publish callback %r failed', fn)
+
+
+class _Batch(object):
+
+    def __init__(self, topic):
+        self.topic = topic
+        self.created = time.time()
+        self.messages = []
+        self.futures = []
+        self.size = 0
+
+
+class BatchPublisher(object):
+    """Buffers messages per topic and publishes them in multi-message
+    requests. A batch is sent when it reaches max_messages or max_bytes, or
+    when its oldest message has been buffered for max_latency seconds.
+    Batches are sent from a background thread so publish never blocks on the
+    network. If the client has a spool, batches are appended to it instead
+    and their futures resolve to None, as the message ids aren't known until
+    the spool publishes them.
+    """
+
+    def __init__(self, client, max_messages=100, max_bytes=1024 * 1024,
+                 max_latency=0.05):
+        """Args:
+            client: the PubSubClient used to send batches.
+            max_messages: the maximum number of messages in a batch.
+            max_bytes: the maximum encoded size of a batch in bytes.
+            max_latency: the maximum number of seconds a message is buffered
+                         before its batch is sent.
+        """
+
+        if not 0 < max_messages <= MAX_BATCH_MESSAGES:
+            raise ValueError('max_messages must be between 1 and %d' %
+                             MAX_BATCH_MESSAGES)
+
+        self.client = client
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.max_latency = max_latency
+
+        self._cond = threading.Condition()
+        self._batches = {}
+        self._ready = []
+        self._in_flight = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='pubsub-batch-publisher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def publish(self, topic, message):
+        """Buffer a message to be published to a topic.
+
+        Args:
+            topic: the name of the topic to publish to.
+            message: the body of the message as a string, or any value the
+                     client's codec can encode.
+
+        Returns:
+            a PublishFuture which resolves to the message id.
+
+        Raises:
+            PublisherClosedError if the publisher has been closed.
+        """
+
+        future = PublishFuture()
+        # Messages are encoded on the calling thread so the batch size
+        # reflects what is sent on the wire.
+        encoded = self.client._encode_message(message)
+        size = len(encoded['data'])
+
+        with self._cond:
+            if self._closed:
+                raise PublisherClosedError('Publisher has been closed')
+
+            batch = self._batches.get(topic)
+            if batch and batch.messages and \
+                    batch.size + size > self.max_bytes:
+                self._seal(batch)
+                batch = None
+            if not batch:
+                batch = self._batches[topic] = _Batch(topic)
+                self._cond.notify()
+
+            batch.messages.append(encoded)
+            batch.futures.append(future)
+            batch.size += size
+
+            if len(batch.messages) >= self.max_messages or \
+                    batch.size >= self.max_bytes:
+                self._seal(batch)
+
+        return future
+
+    def flush(self):
+        """Send all buffered messages and block until every batch has been
+        sent.
+        """
+
+        with self._cond:
+            for batch in list(self._batches.values()):
+                self._seal(batch)
+            while self._ready or self._in_flight:
+                self._cond.wait()
+
+    def close(self):
+        """Send all buffered messages and stop the background thread. Any
+        subsequent publish raises PublisherClosedError.
+        """
+
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            for batch in list(self._batches.values()):
+                self._seal(batch)
+            self._cond.notify_all()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _seal(self, batch):
+        # Must be called with self._cond held.
+        if self._batches.get(batch.topic) is batch:
+            del self._batches[batch.topic]
+        self._ready.append(batch)
+        self._cond.notify_all()
+
+    def _next_batch(self):
+        with self._cond:
+            while True:
+                if self._ready:
+                    self._in_flight += 1
+                    return self._ready.pop(0)
+                if self._closed:
+                    return None
+
+                timeout = None
+                now = time.time()
+                for batch in list(self._batches.values()):
+                    remaining = batch.created + self.max_latency - now
+                    if remaining <= 0:
+                        self._seal(batch)
+                    elif timeout is None or remaining < timeout:
+                        timeout = remaining
+                if not self._ready:
+                    self._cond.wait(timeout)
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+
+            try:
+                ids = self.client._publish_encoded(batch.topic,
+                                                   batch.messages)
+            except Exception as e:
+                for future in batch.futures:
+                    future.set_exception(e)
+            else:
+                ids = list(ids) + [None] * (len(batch.futures) - len(ids))
+                for future, message_id in zip(batch.futures, ids):
+                    future.set_result(message_id)
+            finally:
+                with self._cond:
+                    self._in_flight -= 1
+                    self._cond.notify_all()
@@ -0,0 +1,168 @@
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class PullEngine(object):
+    """Keeps between one and max_concurrency long-poll pull requests
+    outstanding for a subscription, so throughput under load isn't capped
+    at one response per round trip. The number of concurrent pulls adapts
+    to the backlog: a pull which returns a full batch adds another, up to
+    max_concurrency; a partial batch, meaning the backlog is draining,
+    removes one; and a pull which returns nothing goes back to a single
+    long-poll, so an idle subscription has only one request waiting on it.
+
+    The engine does flow control for its owner, a subscriber, whose
+    condition it shares: pulls only ask for as many messages as the owner
+    has capacity for, less the messages already requested by pulls in
+    flight.
+    """
+
+    def __init__(self, client, subscription, cond, capacity, deliver,
+                 max_concurrency=1, batch_size=100, on_error=None,
+                 name='pubsub-puller'):
+        """Args:
+            client: the PubSubClient used to pull messages.
+            subscription: the name of the subscription to pull from.
+            cond: the owner's threading.Condition, which is held when
+                  capacity is called and must be notified when capacity may
+                  have grown.
+            capacity: a callable returning the number of messages which may
+                      be pulled, or None once the owner is stopping.
+            deliver: a callable invoked with the list of messages returned
+                     by each pull, without cond held.
+            max_concurrency: the maximum number of pulls in flight.
+            batch_size: the maximum number of messages fetched per pull.
+            on_error: a callable invoked with the exception when a pull
+                      fails. Defaults to logging it and waiting a second
+                      before pulling again.
+            name: the prefix of the names of the pulling threads.
+        """
+
+        if max_concurrency < 1:
+            raise ValueError('max_concurrency must be at least 1')
+
+        self.client = client
+        self.subscription = subscription
+        self.max_concurrency = max_concurrency
+        self.batch_size = batch_size
+        self.concurrency = 1
+        self.in_flight = 0
+        self.requested = 0
+        self.pulls = 0
+        self.empty_pulls = 0
+
+        self._cond = cond
+        self._stopped = False
+        self._capacity = capacity
+        self._deliver = deliver
+        self._on_error = on_error
+        self._threads = [
+            threading.Thread(target=self._run, args=(i,),
+                             name='%s-%d' % (name, i))
+            for i in range(max_concurrency)]
+
+    def start(self):
+        """Start the pulling threads."""
+
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        """Stop pulling without waiting for the pulls in flight. The
+        messages they return are released for redelivery, and their threads
+        exit when they return.
+        """
+
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def join(self, timeout=None):
+        """Wait for the pulling threads to exit once the owner is stopping.
+        A thread blocked in a long-poll exits when the pull returns.
+        """
+
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def stats(self):
+        """Return a dict of the current target number of concurrent pulls,
+        the number in flight, and the number of pulls made and of those
+        which returned nothing.
+        """
+
+        with self._cond:
+            return {
+                'concurrency': self.concurrency,
+                'in_flight': self.in_flight,
+                'pulls': self.pulls,
+                'empty_pulls': self.empty_pulls,
+            }
+
+    def _run(self, index):
+        while True:
+            with self._cond:
+                while True:
+                    capacity = None if self._stopped else self._capacity()
+                    if capacity is None:
+                        return
+                    if index < self.concurrency and \
+                            capacity - self.requested > 0:
+                        break
+                    self._cond.wait()
+                count = min(self.batch_size, capacity - self.requested)
+                self.requested += count
+                self.in_flight += 1
+
+            try:
+                messages = self.client.pull_many(
+                    self.subscription, max_messages=count, block=True,
+                    auto_ack=False)
+            except Exception as e:
+                with self._cond:
+                    self.requested -= count
+                    self.in_flight -= 1
+                    self._cond.notify_all()
+                if self._on_error is not None:
+                    self._on_error(e)
+                else:
+                    logger.exception('Failed to pull from %s',
+                                     self.subscription)
+                    time.sleep(1)
+                continue
+
+            with self._cond:
+                stopped = self._stopped
+                if stopped:
+                    self.requested -= count
+                    self.in_flight -= 1
+            if stopped:
+                # The owner may have been restarted with another engine, so
+                # the messages aren't delivered to it.
+                self.client.release(self.subscription,
+                                    [message.ack_id for message in messages])
+                return
+
+            # The messages count against the owner's capacity once they're
+            # delivered, so they stay requested until then.
+            if messages:
+                self._deliver(messages)
+
+            with self._cond:
+                self.requested -= count
+                self.in_flight -= 1
+                self.pulls += 1
+                if not messages:
+                    self.empty_pulls += 1
+                    self.concurrency = 1
+                elif len(messages) >= count:
+                    self.concurrency = min(self.concurrency + 1,
+                                           self.max_concurrency)
+                else:
+                    self.concurrency = max(self.concurrency - 1, 1)
+                self._cond.notify_all()
@@ -0,0 +1,225 @@
+"""Receives messages pushed to a subscription's endpoint. PushApp is a WSGI
+application which can be served by any WSGI server; for asyncio, see
+pubsub.aio.AsyncPushServer.
+"""
+
+import binascii
+import hmac
+import json
+import logging
+import threading
+import time
+import zlib
+
+try:
+    from urllib.parse import parse_qs
+except ImportError:
+    from urlparse import parse_qs
+
+from pubsub.client import _decode_data
+from pubsub.client import Message
+
+logger = logging.getLogger(__name__)
+
+# The default maximum size in bytes of a push request body.
+MAX_BODY_SIZE = 10 * 1024 * 1024
+
+# The statuses returned to the push system. Any status other than a success
+# makes it redeliver the message later.
+_STATUSES = {
+    204: '204 No Content',
+    400: '400 Bad Request',
+    403: '403 Forbidden',
+    405: '405 Method Not Allowed',
+    413: '413 Payload Too Large',
+    429: '429 Too Many Requests',
+    500: '500 Internal Server Error',
+}
+
+
+def decode_push(body, as_memoryview=False):
+    """Decode the body of a push request into a Message, decoding its data
+    the same way pull does.
+
+    Args:
+        body: the request body as bytes.
+        as_memoryview: bool indicating if raw message data should be
+                       returned as a memoryview over the decoded buffer.
+
+    Returns:
+        a Message without an ack id, since pushed messages are acknowledged
+        by the response status.
+
+    Raises:
+        ValueError if the body isn't a push envelope.
+    """
+
+    try:
+        envelope = json.loads(body.decode('utf-8'))
+        message = envelope['message']
+        data = _decode_data(message, as_memoryview)
+    except (KeyError, TypeError, AttributeError, UnicodeDecodeError,
+            binascii.Error, zlib.error) as e:
+        raise ValueError('Invalid push request: %s' % e)
+
+    return Message(envelope.get('subscription'), None, data,
+                   message.get('messageId'), len(message.get('data') or ''))
+
+
+def _token_matches(token, query_string):
+    """Return True if a request's query string carries the token, comparing
+    them in constant time so the token can't be guessed from response
+    times.
+    """
+
+    supplied = parse_qs(query_string).get('token', [''])[0]
+    return hmac.compare_digest(_utf8(supplied), _utf8(token))
+
+
+def _utf8(value):
+    if isinstance(value, bytes):
+        return value
+    return value.encode('utf-8')
+
+
+class Limiter(object):
+    """Bounds the number of messages handled at once. Up to max_pending
+    further requests wait up to pending_timeout seconds for a slot and any
+    others are rejected straight away, so an overloaded receiver sheds load
+    instead of queueing requests until the push system times them out.
+    """
+
+    def __init__(self, max_concurrency=16, max_pending=0, pending_timeout=1):
+        self.max_concurrency = max_concurrency
+        self.max_pending = max_pending
+        self.pending_timeout = pending_timeout
+        self.active = 0
+        self.pending = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """Take a slot, returning False if the request should be
+        rejected.
+        """
+
+        with self._cond:
+            if self.active < self.max_concurrency:
+                self.active += 1
+                return True
+            if self.pending >= self.max_pending:
+                return False
+
+            self.pending += 1
+            try:
+                deadline = time.time() + self.pending_timeout
+                while self.active >= self.max_concurrency:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+                self.active += 1
+                return True
+            finally:
+                self.pending -= 1
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+
+class PushApp(object):
+    """A WSGI application which decodes pushed messages and calls a handler
+    with each one. The message is acknowledged by returning 204 once the
+    handler returns; if the handler raises, 500 is returned so the message
+    is redelivered. While max_concurrency messages are being handled,
+    further requests get 429, which makes the push system back off. The
+    limit is checked before the body is read and decoded, so rejecting a
+    request is cheap, and bodies larger than max_body_size get 413.
+    """
+
+    def __init__(self, handler, max_concurrency=16, max_pending=0,
+                 pending_timeout=1, token=None, as_memoryview=False,
+                 max_body_size=MAX_BODY_SIZE):
+        """Args:
+            handler: a callable invoked with each Message.
+            max_concurrency: the maximum number of messages handled at once.
+            max_pending: the maximum number of requests waiting for one of
+                         the max_concurrency slots.
+            pending_timeout: the maximum number of seconds a request waits
+                             for a slot before being rejected.
+            token: if provided, requests must carry it in a token query
+                   parameter, as set in the subscription's push endpoint,
+                   or they get 403.
+            as_memoryview: bool indicating if raw message data should be
+                           passed to the handler as memoryviews.
+            max_body_size: the maximum size in bytes of a request body.
+        """
+
+        self.handler = handler
+        self.token = token
+        self.as_memoryview = as_memoryview
+        self.max_body_size = max_body_size
+        self.limiter = Limiter(max_concurrency, max_pending, pending_timeout)
+
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        status = self._handle(environ)
+        start_response(_STATUSES[status], [('Content-Length', '0')])
+        return []
+
+    def stats(self):
+        """Return a dict of the number of messages processed, failed and
+        rejected and the number being handled.
+        """
+
+        with self._lock:
+            return {
+                'processed': self.processed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'active': self.limiter.active,
+            }
+
+    def _handle(self, environ):
+        if environ.get('REQUEST_METHOD') != 'POST':
+            return 405
+        query = environ.get('QUERY_STRING', '')
+        if self.token is not None and not _token_matches(self.token, query):
+            return 403
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return 400
+        if length > self.max_body_size:
+            return 413
+
+        if not self.limiter.acquire():
+            with self._lock:
+                self.rejected += 1
+            return 429
+        try:
+            try:
+                message = decode_push(environ['wsgi.input'].read(length),
+                                      self.as_memoryview)
+            except ValueError:
+                logger.exception('Rejecting invalid push request')
+                return 400
+
+            try:
+                self.handler(message)
+            except Exception:
+                logger.exception('Handler failed for %r', message)
+                with self._lock:
+                    self.failed += 1
+                return 500
+        finally:
+            self.limiter.release()
+
+        with self._lock:
+            self.processed += 1
+        return 204
@@ -0,0 +1,215 @@
+import threading
+
+from googleapiclient import errors
+
+from pubsub.metrics import clock
+
+# What the limiter does when there aren't enough tokens for a publish.
+BLOCK = 'block'
+REJECT = 'reject'
+
+
+class RateLimitExceeded(Exception):
+    """Raised without sending a request when a publish is over the rate
+    limit and the limiter rejects rather than waits, or the wait timed out.
+    """
+
+
+class AdaptiveRateLimiter(object):
+    """A token bucket limiting the rate of published messages, whose rate
+    adapts to the backend AIMD-style. While publishes succeed within
+    target_latency the rate grows by increase messages per second every
+    second; when a publish is throttled with a 429 or is slower than
+    target_latency the rate is multiplied by decrease, at most once per
+    cooldown seconds so the failures of a burst of concurrent requests only
+    count once. Retries of a failed publish take tokens too, so they are
+    paced by the reduced rate.
+
+    A publish takes a token per message. A batch larger than the bucket
+    waits for a full bucket and leaves it in debt, so the rate still holds
+    on average.
+    """
+
+    def __init__(self, initial_rate=1000, min_rate=10, max_rate=100000,
+                 burst=None, increase=None, decrease=0.5, target_latency=1,
+                 cooldown=1, mode=BLOCK, timeout=None):
+        """Args:
+            initial_rate: the starting rate in messages per second.
+            min_rate: the rate never falls below this.
+            max_rate: the rate never grows above this.
+            burst: the capacity of the bucket in messages, defaults to one
+                   second's worth at the current rate.
+            increase: the number of messages per second the rate grows by
+                      every second without congestion, defaults to 5% of
+                      initial_rate.
+            decrease: the factor the rate is multiplied by on congestion.
+            target_latency: publishes slower than this many seconds count
+                            as congestion.
+            cooldown: the minimum number of seconds between decreases.
+            mode: BLOCK to wait for tokens or REJECT to raise
+                  RateLimitExceeded straight away.
+            timeout: in BLOCK mode, the maximum number of seconds to wait
+                     for tokens before raising RateLimitExceeded, or None to
+                     wait indefinitely.
+        """
+
+        if not 0 < min_rate <= initial_rate <= max_rate:
+            raise ValueError('Rates must satisfy 0 < min_rate <= '
+                             'initial_rate <= max_rate')
+        if not 0 < decrease < 1:
+            raise ValueError('decrease must be between 0 and 1')
+        if mode not in (BLOCK, REJECT):
+            raise ValueError('mode must be %r or %r' % (BLOCK, REJECT))
+
+        self.min_rate = float(min_rate)
+        self.max_rate = float(max_rate)
+        self.burst = burst
+        self.increase = increase if increase is not None else \
+            initial_rate * 0.05
+        self.decrease = decrease
+        self.target_latency = target_latency
+        self.cooldown = cooldown
+        self.mode = mode
+        self.timeout = timeout
+
+        self.rate = float(initial_rate)
+        self.waiting = 0
+        self.rejected = 0
+        self.throttled = 0
+        self.decreases = 0
+
+        self._cond = threading.Condition()
+        self._tokens = float(self._capacity())
+        self._refilled_at = clock()
+        self._adjusted_at = self._refilled_at
+        self._decreased_at = None
+
+    def call(self, cost, fn):
+        """Take cost tokens, then call fn and adapt the rate to its outcome.
+
+        Returns:
+            the return value of fn.
+
+        Raises:
+            RateLimitExceeded if the tokens couldn't be taken, or the
+            exception raised by fn.
+        """
+
+        self.acquire(cost)
+        start = clock()
+        try:
+            result = fn()
+        except errors.HttpError as e:
+            self.record(clock() - start, _status(e) == 429)
+            raise
+        self.record(clock() - start)
+        return result
+
+    def acquire(self, cost=1):
+        """Take cost tokens, waiting for them in BLOCK mode.
+
+        Raises:
+            RateLimitExceeded if the tokens couldn't be taken.
+        """
+
+        with self._cond:
+            self._refill()
+            # New callers don't overtake those already waiting, so a large
+            # batch isn't starved by a stream of small ones.
+            if self.waiting == 0 and self._available(cost):
+                self._tokens -= cost
+                return
+            if self.mode == REJECT:
+                self.rejected += 1
+                raise RateLimitExceeded(
+                    'Publishing %d messages would exceed %.1f messages per '
+                    'second' % (cost, self.rate))
+
+            deadline = None if self.timeout is None else \
+                clock() + self.timeout
+            self.waiting += 1
+            try:
+                while True:
+                    self._refill()
+                    if self._available(cost):
+                        self._tokens -= cost
+                        return
+                    wait = (min(cost, self._capacity()) - self._tokens) / \
+                        self.rate
+                    if deadline is not None:
+                        remaining = deadline - clock()
+                        if remaining <= 0:
+                            self.rejected += 1
+                            raise RateLimitExceeded(
+                                'Timed out waiting to publish %d messages'
+                                % cost)
+                        wait = min(wait, remaining)
+                    self._cond.wait(max(wait, 0.001))
+            finally:
+                self.waiting -= 1
+                self._cond.notify_all()
+
+    def record(self, latency, throttled=False):
+        """Adapt the rate to the outcome of a publish.
+
+        Args:
+            latency: the number of seconds the publish took.
+            throttled: bool indicating if the backend throttled it.
+        """
+
+        with self._cond:
+            # Tokens accrued so far are added at the old rate.
+            self._refill()
+            now = clock()
+            if throttled:
+                self.throttled += 1
+            if throttled or latency > self.target_latency:
+                if self._decreased_at is None or \
+                        now - self._decreased_at >= self.cooldown:
+                    self.rate = max(self.min_rate, self.rate * self.decrease)
+                    self._tokens = min(self._tokens, self._capacity())
+                    self._decreased_at = now
+                    self.decreases += 1
+            else:
+                self.rate = min(self.max_rate, self.rate + self.increase *
+                                min(now - self._adjusted_at, 1))
+            self._adjusted_at = now
+
+    def stats(self):
+        """Return a dict of the current rate in messages per second, the
+        tokens in the bucket, the number of publishes waiting for tokens and
+        the number rejected, throttled by the backend and the number of rate
+        decreases.
+        """
+
+        with self._cond:
+            self._refill()
+            return {
+                'rate': self.rate,
+                'tokens': self._tokens,
+                'waiting': self.waiting,
+                'rejected': self.rejected,
+                'throttled': self.throttled,
+                'decreases': self.decreases,
+            }
+
+    def _capacity(self):
+        return self.burst if self.burst is not None else max(self.rate, 1)
+
+    def _available(self, cost):
+        # Must be called with self._cond held.
+        return self._tokens >= min(cost, self._capacity())
+
+    def _refill(self):
+        # Must be called with self._cond held.
+        now = clock()
+        self._tokens = min(self._capacity(), self._tokens +
+                           (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+
+def _status(error):
+    try:
+        return int(error.resp.status)
+    except (AttributeError, TypeError, ValueError):
+        return None
@@ -0,0 +1,219 @@
+import random
+import socket
+import threading
+import time
+
+from googleapiclient import errors
+
+
+# HTTP statuses which indicate a transient failure worth retrying.
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+
+class CircuitOpenError(Exception):
+    """Raised without sending a request while the circuit breaker is open
+    because the backend has been failing.
+    """
+
+
+class RetryPolicy(object):
+    """Decides whether a failed request is retried and how long to wait
+    before each retry. Backoff grows exponentially and uses full jitter, so
+    clients which failed together don't retry together.
+    """
+
+    def __init__(self, max_attempts=5, initial_backoff=0.1, max_backoff=10,
+                 multiplier=2, retryable_statuses=RETRYABLE_STATUSES):
+        """Args:
+            max_attempts: the maximum number of attempts, including the first
+                          one. 1 disables retries.
+            initial_backoff: the upper bound in seconds of the first backoff.
+            max_backoff: the upper bound in seconds of any backoff.
+            multiplier: the factor the backoff bound grows by per attempt.
+            retryable_statuses: the HTTP statuses which are retried.
+        """
+
+        self.max_attempts = max_attempts
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.multiplier = multiplier
+        self.retryable_statuses = retryable_statuses
+
+    def is_retryable(self, error):
+        """Return True if error is a transient HTTP or socket error."""
+
+        if isinstance(error, errors.HttpError):
+            try:
+                return int(error.resp.status) in self.retryable_statuses
+            except (AttributeError, TypeError, ValueError):
+                return False
+        return isinstance(error, socket.error)
+
+    def backoff(self, attempt):
+        """Return the number of seconds to wait after the given attempt,
+        counting from 0.
+        """
+
+        bound = min(self.max_backoff,
+                    self.initial_backoff * self.multiplier ** attempt)
+        return random.uniform(0, bound)
+
+
+class RetryBudget(object):
+    """Limits retries to a fraction of requests so retries can't multiply
+    the load on a struggling backend. Every call deposits ratio tokens and
+    every retry withdraws one. The balance is capped at max_tokens and starts
+    there.
+    """
+
+    def __init__(self, ratio=0.1, max_tokens=10):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self._lock = threading.Lock()
+        self._tokens = float(max_tokens)
+
+    @property
+    def tokens(self):
+        return self._tokens
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self):
+        """Take a token for a retry, returning False if none are left."""
+
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class CircuitBreaker(object):
+    """Fails fast while the backend is unhealthy. After failure_threshold
+    consecutive retryable failures the circuit opens and requests are
+    rejected for reset_timeout seconds. Then a single trial request is let
+    through: if it succeeds the circuit closes, otherwise it opens again.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0
+        self._trial_in_flight = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == self.OPEN and \
+                    time.time() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def allow(self):
+        """Return True if a request may be sent."""
+
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN:
+                if time.time() - self._opened_at < self.reset_timeout:
+                    return False
+                self._state = self.HALF_OPEN
+                self._trial_in_flight = False
+            if self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or \
+                    self._failures >= self.failure_threshold:
+                self._state = self.OPEN
+                self._opened_at = time.time()
+                self._trial_in_flight = False
+
+
+class Retrier(object):
+    """Executes requests with retries according to a RetryPolicy, which can
+    be overridden per operation, while honouring a shared RetryBudget and
+    CircuitBreaker. Non-retryable errors are raised immediately.
+    """
+
+    def __init__(self, policy=None, policies=None, budget=None, breaker=None,
+                 sleep=time.sleep):
+        """Args:
+            policy: the default RetryPolicy.
+            policies: a dict mapping operation names, such as "publish" or
+                      "pull", to the RetryPolicy used for them.
+            budget: an optional RetryBudget shared by all operations.
+            breaker: an optional CircuitBreaker shared by all operations.
+            sleep: the function used to wait between attempts.
+        """
+
+        self.policy = policy or RetryPolicy()
+        self.policies = policies or {}
+        self.budget = budget
+        self.breaker = breaker
+        self.sleep = sleep
+
+    def call(self, operation, fn):
+        """Call fn, retrying it on retryable errors.
+
+        Args:
+            operation: the name of the operation, used to pick the policy.
+            fn: a callable making the request.
+
+        Returns:
+            the result of fn.
+
+        Raises:
+            CircuitOpenError if the circuit breaker is open, otherwise the
+            last error raised by fn if it wasn't retryable or no retries were
+            left.
+        """
+
+        policy = self.policies.get(operation, self.policy)
+        if self.budget:
+            self.budget.deposit()
+
+        attempt = 0
+        while True:
+            if self.breaker and not self.breaker.allow():
+                raise CircuitOpenError('Circuit breaker is open, not sending '
+                                       '%s request' % operation)
+            try:
+                result = fn()
+            except Exception as e:
+                retryable = policy.is_retryable(e)
+                if self.breaker:
+                    if retryable:
+                        self.breaker.record_failure()
+                    else:
+                        # The error isn't a sign of an unhealthy backend.
+                        self.breaker.record_success()
+                attempt += 1
+                if not retryable or attempt >= policy.max_attempts or \
+                        (self.budget and not self.budget.withdraw()):
+                    raise
+                self.sleep(policy.backoff(attempt - 1))
+            else:
+                if self.breaker:
+                    self.breaker.record_success()
+                return result
@@ -0,0 +1,441 @@
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+from googleapiclient import errors
+
+from pubsub.publisher import MAX_BATCH_MESSAGES
+from pubsub.retry import RetryPolicy
+
+logger = logging.getLogger(__name__)
+
+# Each record is its body's length and CRC32 followed by the body, a JSON
+# array of the topic and the encoded message. Segments are preallocated
+# with zeros, so a zero length marks the end of a segment's records.
+_HEADER = struct.Struct('<II')
+
+_SEGMENT_NAME = 'segment-%020d.log'
+_SEGMENT_RE = re.compile(r'^segment-(\d{20})\.log$')
+_CHECKPOINT = 'checkpoint'
+
+
+class SpoolFullError(Exception):
+    """Raised when appending to a spool which has reached its maximum
+    size.
+    """
+
+
+class _Segment(object):
+
+    def __init__(self, path, seq, size, create=False):
+        self.path = path
+        self.seq = seq
+        if create:
+            with open(path, 'wb') as f:
+                f.truncate(size)
+        self._file = open(path, 'r+b')
+        self.size = os.fstat(self._file.fileno()).st_size
+        self.map = mmap.mmap(self._file.fileno(), self.size)
+        # The offset after the last valid record.
+        self.end = self._scan()
+
+    def _scan(self):
+        offset = 0
+        while True:
+            record = self.read(offset)
+            if record is None:
+                return offset
+            offset = record[1]
+
+    def read(self, offset):
+        """Return a tuple of the body of the record at offset and the offset
+        of the next record, or None if there is no valid record there.
+        """
+
+        if offset + _HEADER.size > self.size:
+            return None
+        length, crc = _HEADER.unpack_from(self.map, offset)
+        start = offset + _HEADER.size
+        if not length or start + length > self.size:
+            return None
+        body = self.map[start:start + length]
+        if zlib.crc32(body) & 0xffffffff != crc:
+            # A record torn by a crash ends the segment.
+            return None
+        return body, start + length
+
+    def append(self, body):
+        start = self.end + _HEADER.size
+        self.map[start:start + len(body)] = body
+        # The header is written last, so a record is only visible once it
+        # is complete.
+        self.map[self.end:start] = _HEADER.pack(
+            len(body), zlib.crc32(body) & 0xffffffff)
+        self.end = start + len(body)
+
+    def fits(self, body):
+        return self.end + _HEADER.size + len(body) <= self.size
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        self.map.close()
+        self._file.close()
+
+
+class Spool(object):
+    """A disk-backed buffer for published messages. Messages are appended to
+    an append-only log of memory-mapped, fixed-size segment files, so an
+    append is a memory copy, and a background thread drains the log by
+    publishing the messages in batches of consecutive messages for the same
+    topic. When a publish fails the drainer backs off and retries the same
+    batch, so messages keep being accepted while the backend is down and
+    are replayed once it recovers. If the backend rejects a batch with a
+    4xx status other than 429, the batch is split in halves which are
+    published separately, and only a single rejected message is dropped.
+
+    The position of the drainer is checkpointed to disk after every batch,
+    and drained segments are deleted. Opening a spool on a directory left
+    by a crashed process recovers its undrained messages, ignoring a record
+    torn by the crash. Messages are delivered at least once: a batch which
+    was published just before a crash, or whose checkpoint couldn't be
+    written, is published again.
+
+    Appends survive the process crashing but, unless sync is set, not the
+    machine crashing before the operating system writes them back.
+    """
+
+    def __init__(self, client, directory, segment_size=16 * 1024 * 1024,
+                 max_bytes=1024 * 1024 * 1024, batch_size=MAX_BATCH_MESSAGES,
+                 batch_bytes=1024 * 1024, sync=False, initial_backoff=0.5,
+                 max_backoff=30):
+        """Args:
+            client: the PubSubClient used to publish drained messages.
+            directory: the directory holding the log, created if missing.
+                       It must only be used by one spool at a time.
+            segment_size: the size in bytes of each segment file. Encoded
+                          messages larger than this can't be spooled.
+            max_bytes: the maximum disk space in bytes used by segments.
+            batch_size: the maximum number of messages published per
+                        request.
+            batch_bytes: the maximum encoded size in bytes of the messages
+                         published per request. A message larger than this
+                         is published on its own.
+            sync: bool indicating if every append should be flushed to disk
+                  before returning.
+            initial_backoff: the number of seconds to wait before retrying
+                             after the first failed publish.
+            max_backoff: the maximum number of seconds to wait between
+                         retries.
+        """
+
+        if max_bytes < segment_size:
+            raise ValueError('max_bytes must be at least segment_size')
+
+        self.client = client
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.batch_size = min(batch_size, MAX_BATCH_MESSAGES)
+        self.batch_bytes = batch_bytes
+        self.sync = sync
+        self.policy = RetryPolicy(initial_backoff=initial_backoff,
+                                  max_backoff=max_backoff)
+
+        self.appended = 0
+        self.drained = 0
+        self.dropped = 0
+        self.failures = 0
+
+        self._cond = threading.Condition()
+        self._closed = False
+        self._segments = []
+        self._open()
+
+        self._thread = threading.Thread(target=self._run,
+                                        name='pubsub-spool-drainer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def append(self, topic, message):
+        """Append an encoded message to the log.
+
+        Args:
+            topic: the name of the topic to publish to.
+            message: the encoded message, as built by the client.
+
+        Raises:
+            SpoolFullError if the spool has reached max_bytes.
+            ValueError if the message is larger than a segment.
+        """
+
+        body = json.dumps([topic, message],
+                          separators=(',', ':')).encode('utf-8')
+        if _HEADER.size + len(body) > self.segment_size:
+            raise ValueError('Message of %d bytes is larger than the spool '
+                             'segment size' % len(body))
+
+        with self._cond:
+            segment = self._segments[-1]
+            if not segment.fits(body):
+                if (len(self._segments) + 1) * self.segment_size > \
+                        self.max_bytes:
+                    raise SpoolFullError('Spool %s is full' % self.directory)
+                segment = self._new_segment(segment.seq + 1)
+            segment.append(body)
+            if self.sync:
+                segment.flush()
+            self.appended += 1
+            self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """Block until every appended message has been drained.
+
+        Returns:
+            True if the spool was drained, False if the timeout elapsed.
+        """
+
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while not self._drained():
+                if deadline is None:
+                    self._cond.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def close(self, timeout=None):
+        """Stop the drainer and close the log. Messages which haven't been
+        drained stay on disk and are drained by the next spool opened on
+        the directory.
+        """
+
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+        with self._cond:
+            for segment in self._segments:
+                segment.flush()
+                segment.close()
+            self._segments = []
+
+    def stats(self):
+        """Return a dict of the number of messages appended, drained and
+        dropped because the backend rejected them, the number of failed
+        attempts to publish or to prepare a batch and the number of segments
+        on disk.
+        """
+
+        with self._cond:
+            return {
+                'appended': self.appended,
+                'drained': self.drained,
+                'dropped': self.dropped,
+                'failures': self.failures,
+                'segments': len(self._segments),
+            }
+
+    def _open(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        seqs = sorted(int(match.group(1)) for match in
+                      (_SEGMENT_RE.match(name)
+                       for name in os.listdir(self.directory)) if match)
+        checkpoint_seq, self._offset = self._read_checkpoint()
+        for seq in seqs:
+            path = os.path.join(self.directory, _SEGMENT_NAME % seq)
+            if seq < checkpoint_seq:
+                os.remove(path)
+            else:
+                self._segments.append(_Segment(path, seq, self.segment_size))
+
+        if not self._segments:
+            self._new_segment(checkpoint_seq)
+        if self._segments[0].seq != checkpoint_seq or \
+                self._offset > self._segments[0].end:
+            self._offset = 0
+
+    def _new_segment(self, seq):
+        # Must be called with self._cond held, except when opening.
+        segment = _Segment(os.path.join(self.directory, _SEGMENT_NAME % seq),
+                           seq, self.segment_size, create=True)
+        self._segments.append(segment)
+        return segment
+
+    def _read_checkpoint(self):
+        try:
+            with open(os.path.join(self.directory, _CHECKPOINT)) as f:
+                checkpoint = json.load(f)
+            return int(checkpoint['segment']), int(checkpoint['offset'])
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return 0, 0
+
+    def _write_checkpoint(self, seq, offset):
+        # The checkpoint only saves publishing drained messages again after
+        # a restart, so failing to write it, for example because the disk
+        # is full, doesn't stop the drainer.
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        except (IOError, OSError):
+            logger.exception('Failed to write spool checkpoint in %s',
+                             self.directory)
+            return
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'segment': seq, 'offset': offset}, f)
+            os.rename(tmp_path, os.path.join(self.directory, _CHECKPOINT))
+        except (IOError, OSError):
+            logger.exception('Failed to write spool checkpoint in %s',
+                             self.directory)
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def _drained(self):
+        # Must be called with self._cond held.
+        return len(self._segments) == 1 and \
+            self._offset >= self._segments[0].end
+
+    def _next_batch(self, limit):
+        # Must be called with self._cond held. Returns the topic, messages
+        # and end offset of the next batch of at most limit messages, or
+        # None if there is none.
+        while True:
+            segment = self._segments[0]
+            if self._offset < segment.end:
+                break
+            if len(self._segments) == 1:
+                return None
+            # The drainer is past the end of a full segment.
+            self._segments.pop(0)
+            segment.close()
+            try:
+                os.remove(segment.path)
+            except OSError:
+                logger.exception('Failed to remove drained spool segment %s',
+                                 segment.path)
+            self._offset = 0
+            self._write_checkpoint(self._segments[0].seq, 0)
+
+        topic = None
+        messages = []
+        size = 0
+        offset = self._offset
+        while offset < segment.end and len(messages) < limit:
+            body, next_offset = segment.read(offset)
+            record_topic, message = json.loads(body.decode('utf-8'))
+            if topic is None:
+                topic = record_topic
+            elif record_topic != topic:
+                break
+            size += len(message.get('data') or '')
+            if messages and size > self.batch_bytes:
+                break
+            messages.append(message)
+            offset = next_offset
+        return topic, messages, offset
+
+    def _run(self):
+        attempt = 0
+        # While the halves of a rejected batch are published, batches are
+        # limited to split_limit messages until the drainer reaches
+        # split_end, the end of the rejected batch in its segment.
+        split_limit = None
+        split_end = None
+        while True:
+            try:
+                with self._cond:
+                    while not self._closed and self._drained():
+                        self._cond.wait()
+                    if self._closed:
+                        return
+                    topic, messages, offset = \
+                        self._next_batch(split_limit or self.batch_size) or \
+                        (None, [], None)
+                    seq = self._segments[0].seq
+            except Exception as e:
+                attempt = self._backoff(attempt, 'Failed to read the next '
+                                        'spooled batch', e)
+                continue
+            if not messages:
+                continue
+
+            try:
+                self.client._send_encoded(topic, messages)
+            except Exception as e:
+                if not _rejected(e):
+                    attempt = self._backoff(
+                        attempt, 'Failed to publish %d spooled messages' %
+                        len(messages), e)
+                    continue
+                if len(messages) > 1:
+                    logger.warning('%d spooled messages for %s were '
+                                   'rejected, publishing them in halves: %s',
+                                   len(messages), topic, e)
+                    split_limit = len(messages) // 2
+                    if split_end is None:
+                        split_end = offset
+                    continue
+                logger.exception('Dropping a spooled message for %s', topic)
+                dropped = True
+            else:
+                dropped = False
+            attempt = 0
+
+            with self._cond:
+                if self._closed and not self._segments:
+                    return
+                self._offset = offset
+                if split_end is not None and offset >= split_end:
+                    split_limit = split_end = None
+                self._write_checkpoint(seq, offset)
+                if dropped:
+                    self.dropped += len(messages)
+                else:
+                    self.drained += len(messages)
+                self._cond.notify_all()
+
+    def _backoff(self, attempt, action, error):
+        # Waits before the drainer's next attempt and returns the number of
+        # the attempt after it.
+        delay = self.policy.backoff(min(attempt, 30))
+        logger.warning('%s, retrying in %.1f seconds: %s', action, delay,
+                       error)
+        with self._cond:
+            self.failures += 1
+            # Appends notify the condition too, so only closing cuts the
+            # backoff short.
+            retry_at = time.time() + delay
+            while not self._closed and time.time() < retry_at:
+                self._cond.wait(retry_at - time.time())
+        return attempt + 1
+
+
+def _rejected(error):
+    # Only batches the backend rejected outright are dropped. Anything else,
+    # such as a server or network error, an open circuit breaker or a rate
+    # limit, is expected to clear once the backend recovers.
+    if not isinstance(error, errors.HttpError):
+        return False
+    try:
+        status = int(error.resp.status)
+    except (AttributeError, TypeError, ValueError):
+        return False
+    return 400 <= status < 500 and status != 429
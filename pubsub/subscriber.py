@@ -0,0 +1,348 @@
+import collections
+import logging
+import threading
+import time
+
+from pubsub.dedup import drop_duplicates
+from pubsub.pulling import PullEngine
+
+logger = logging.getLogger(__name__)
+
+
+class MessageStream(object):
+    """Iterates over the messages of a subscription. Background threads
+    keep a buffer of up to buffer_size messages filled with pulls, so a
+    message is usually ready as soon as the consumer asks for one. The
+    buffer limit bounds memory use: pulling stops while the buffer is full.
+    """
+
+    def __init__(self, client, subscription, buffer_size=100, batch_size=None,
+                 auto_ack=True, max_concurrent_pulls=1):
+        """Args:
+            client: the PubSubClient used to pull messages.
+            subscription: the name of the subscription to pull from.
+            buffer_size: the maximum number of prefetched messages.
+            batch_size: the maximum number of messages fetched per pull,
+                        defaults to buffer_size.
+            auto_ack: bool indicating if each message should be acknowledged
+                      when it is handed to the consumer. If false, the
+                      consumer is responsible for acknowledging messages.
+            max_concurrent_pulls: the maximum number of pulls in flight
+                                  while there is a backlog. See
+                                  pubsub.pulling.PullEngine.
+        """
+
+        if buffer_size < 1:
+            raise ValueError('buffer_size must be at least 1')
+
+        self.client = client
+        self.subscription = subscription
+        self.buffer_size = buffer_size
+        self.batch_size = min(batch_size or buffer_size, buffer_size)
+        self.auto_ack = auto_ack
+
+        self._cond = threading.Condition()
+        self._buffer = collections.deque()
+        self._error = None
+        self._closed = False
+        self._engine = PullEngine(
+            client, subscription, self._cond, self._capacity, self._deliver,
+            max_concurrency=max_concurrent_pulls, batch_size=self.batch_size,
+            on_error=self._pull_failed,
+            name='pubsub-stream-%s' % subscription)
+        self._engine.start()
+
+    def __iter__(self):
+        while True:
+            message = self.get()
+            if message is None:
+                return
+            yield message
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get(self, timeout=None):
+        """Return the next message, blocking until one is available.
+
+        Args:
+            timeout: the maximum number of seconds to wait, or None to wait
+                     until a message arrives or the stream is closed.
+
+        Returns:
+            the next Message, or None if the stream was closed or the timeout
+            elapsed.
+
+        Raises:
+            the exception raised by the background puller if a pull failed.
+        """
+
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while not self._buffer and not self._closed and not self._error:
+                if deadline is None:
+                    self._cond.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            if self._buffer:
+                message = self._buffer.popleft()
+                self._cond.notify_all()
+            elif self._error:
+                error, self._error = self._error, None
+                self._cond.notify_all()
+                raise error
+            else:
+                return None
+
+        if self.auto_ack:
+            self.client.acknowledge(message.subscription, [message.ack_id])
+        return message
+
+    def buffered(self):
+        """Return the number of prefetched messages waiting in the buffer."""
+
+        with self._cond:
+            return len(self._buffer)
+
+    def close(self):
+        """Stop prefetching. Messages still in the buffer are discarded
+        without being acknowledged, so they will be redelivered.
+        """
+
+        with self._cond:
+            self._closed = True
+            buffered = list(self._buffer)
+            self._buffer.clear()
+            self._cond.notify_all()
+        self.client.release(self.subscription,
+                            [message.ack_id for message in buffered])
+
+    def _capacity(self):
+        # Called with self._cond held. Pulling pauses while an error is
+        # waiting to be raised to the consumer.
+        if self._closed:
+            return None
+        if self._error:
+            return 0
+        return self.buffer_size - len(self._buffer)
+
+    def _deliver(self, messages):
+        with self._cond:
+            if not self._closed:
+                self._buffer.extend(messages)
+                self._cond.notify_all()
+                return
+        self.client.release(self.subscription,
+                            [message.ack_id for message in messages])
+
+    def _pull_failed(self, error):
+        with self._cond:
+            self._error = error
+            self._cond.notify_all()
+
+
+class Subscriber(object):
+    """Pulls messages from a subscription and dispatches them to a pool of
+    worker threads which run a handler. A message is acknowledged once the
+    handler returns; if the handler raises, the message is left
+    unacknowledged so it will be redelivered.
+
+    Flow control bounds the number and total size of messages which have
+    been pulled but not yet handled: pulling stops while either
+    max_outstanding_messages or max_outstanding_bytes is reached.
+    """
+
+    def __init__(self, client, subscription, handler, workers=4,
+                 max_outstanding_messages=100,
+                 max_outstanding_bytes=10 * 1024 * 1024, batch_size=None,
+                 deduplicator=None, max_concurrent_pulls=1):
+        """Args:
+            client: the PubSubClient used to pull and acknowledge messages.
+            subscription: the name of the subscription to pull from.
+            handler: a callable invoked with each Message.
+            workers: the number of worker threads running the handler.
+            max_outstanding_messages: the maximum number of messages pulled
+                                      but not yet handled.
+            max_outstanding_bytes: the maximum total size in bytes of the
+                                   messages pulled but not yet handled.
+            batch_size: the maximum number of messages fetched per pull,
+                        defaults to max_outstanding_messages.
+            deduplicator: if provided, a pubsub.dedup.Deduplicator used to
+                          acknowledge and drop messages which have already
+                          been handled.
+            max_concurrent_pulls: the maximum number of pulls in flight
+                                  while there is a backlog. See
+                                  pubsub.pulling.PullEngine.
+        """
+
+        if workers < 1:
+            raise ValueError('workers must be at least 1')
+        if max_outstanding_messages < 1:
+            raise ValueError('max_outstanding_messages must be at least 1')
+
+        self.client = client
+        self.subscription = subscription
+        self.handler = handler
+        self.workers = workers
+        self.max_outstanding_messages = max_outstanding_messages
+        self.max_outstanding_bytes = max_outstanding_bytes
+        self.batch_size = min(batch_size or max_outstanding_messages,
+                              max_outstanding_messages)
+        self.deduplicator = deduplicator
+        self.max_concurrent_pulls = max_concurrent_pulls
+
+        self.outstanding_messages = 0
+        self.outstanding_bytes = 0
+        self.processed = 0
+        self.failed = 0
+        self.duplicates = 0
+
+        self._cond = threading.Condition()
+        self._work = collections.deque()
+        self._engine = None
+        self._threads = []
+        self._running = False
+        self._stopping = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        """Start pulling and handling messages."""
+
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+            self._stopping = False
+
+        self._engine = PullEngine(
+            self.client, self.subscription, self._cond, self._capacity,
+            self._deliver, max_concurrency=self.max_concurrent_pulls,
+            batch_size=self.batch_size,
+            name='pubsub-subscriber-%s-puller' % self.subscription)
+        self._threads = [
+            threading.Thread(
+                target=self._work_loop,
+                name='pubsub-subscriber-%s-%d' % (self.subscription, i))
+            for i in range(self.workers)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+        self._engine.start()
+
+    def stop(self, timeout=None):
+        """Stop pulling messages and wait for the workers to finish handling
+        the messages which have already been pulled.
+
+        Args:
+            timeout: the maximum number of seconds to wait for each thread,
+                     or None to wait indefinitely.
+        """
+
+        with self._cond:
+            if not self._running:
+                return
+            self._stopping = True
+            self._cond.notify_all()
+        # The pullers may be blocked in long-poll pulls, which aren't waited
+        # for; any messages they receive are released for redelivery.
+        self._engine.stop()
+
+        for thread in self._threads:
+            thread.join(timeout)
+
+        with self._cond:
+            self._running = False
+
+    def stats(self):
+        """Return a dict of the outstanding, processed, failed and duplicate
+        message counts, the outstanding bytes and the current number of
+        concurrent pulls.
+        """
+
+        with self._cond:
+            return {
+                'outstanding_messages': self.outstanding_messages,
+                'outstanding_bytes': self.outstanding_bytes,
+                'processed': self.processed,
+                'failed': self.failed,
+                'duplicates': self.duplicates,
+                'pull_concurrency':
+                    self._engine.concurrency if self._engine else 0,
+            }
+
+    def _capacity(self):
+        # Called with self._cond held.
+        if self._stopping:
+            return None
+        if self.outstanding_bytes >= self.max_outstanding_bytes:
+            return 0
+        return self.max_outstanding_messages - self.outstanding_messages
+
+    def _deliver(self, messages):
+        pulled = len(messages)
+        if self.deduplicator is not None:
+            messages = drop_duplicates(self.client, self.subscription,
+                                       self.deduplicator, messages)
+
+        with self._cond:
+            if not self._stopping:
+                self.duplicates += pulled - len(messages)
+                for message in messages:
+                    self.outstanding_messages += 1
+                    self.outstanding_bytes += message.size
+                    self._work.append(message)
+                self._cond.notify_all()
+                return
+        # Messages received after stopping are left to be redelivered.
+        self.client.release(self.subscription,
+                            [message.ack_id for message in messages])
+
+    def _work_loop(self):
+        while True:
+            with self._cond:
+                while not self._work and not self._stopping:
+                    self._cond.wait()
+                if not self._work:
+                    return
+                message = self._work.popleft()
+
+            try:
+                self.handler(message)
+            except Exception:
+                logger.exception('Handler failed for %r', message)
+                succeeded = False
+            else:
+                succeeded = True
+
+            if succeeded:
+                if self.deduplicator is not None:
+                    self.deduplicator.add(self.deduplicator.key(message))
+                try:
+                    self.client.acknowledge(message.subscription,
+                                            [message.ack_id])
+                except Exception:
+                    logger.exception('Failed to acknowledge %r', message)
+            else:
+                self.client.release(message.subscription, [message.ack_id])
+
+            with self._cond:
+                self.outstanding_messages -= 1
+                self.outstanding_bytes -= message.size
+                if succeeded:
+                    self.processed += 1
+                else:
+                    self.failed += 1
+                self._cond.notify_all()
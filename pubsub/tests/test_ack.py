@@ -0,0 +1,89 @@
+import threading
+import unittest
+
+import mock
+
+from pubsub import ack
+
+
+class TestAckManager(unittest.TestCase):
+
+    def setUp(self):
+        self.mock_client = mock.Mock()
+
+    def test_flush_on_max_batch(self):
+        """Ensure that queued acks are sent once max_batch is reached."""
+
+        sent = threading.Event()
+        self.mock_client._send_acknowledge.side_effect = \
+            lambda subscription, ack_ids: sent.set()
+        manager = ack.AckManager(self.mock_client, max_batch=2, interval=60)
+
+        manager.add('/subscriptions/project/foo', ['a'])
+        manager.add('/subscriptions/project/foo', ['b'])
+
+        self.assertTrue(sent.wait(5))
+        self.mock_client._send_acknowledge.assert_called_once_with(
+            '/subscriptions/project/foo', ['a', 'b'])
+        manager.close()
+
+    def test_flush_on_interval(self):
+        """Ensure that queued acks are sent once the interval elapses."""
+
+        sent = threading.Event()
+        self.mock_client._send_acknowledge.side_effect = \
+            lambda subscription, ack_ids: sent.set()
+        manager = ack.AckManager(self.mock_client, interval=0.01)
+
+        manager.add('/subscriptions/project/foo', ['a'])
+
+        self.assertTrue(sent.wait(5))
+        manager.close()
+
+    def test_coalesces_per_subscription(self):
+        """Ensure that acks are coalesced per subscription and split into
+        requests of at most max_batch ack ids.
+        """
+
+        manager = ack.AckManager(self.mock_client, max_batch=2, interval=60)
+        with manager._cond:
+            manager.add('/subscriptions/project/foo', ['a', 'b', 'c'])
+            manager.add('/subscriptions/project/bar', ['d'])
+
+        manager.flush()
+
+        calls = self.mock_client._send_acknowledge.call_args_list
+        self.assertEqual(3, len(calls))
+        self.assertIn(mock.call('/subscriptions/project/foo', ['a', 'b']),
+                      calls)
+        self.assertIn(mock.call('/subscriptions/project/foo', ['c']), calls)
+        self.assertIn(mock.call('/subscriptions/project/bar', ['d']), calls)
+        self.assertEqual({'pending': 0, 'flushed': 4, 'failed': 0},
+                         manager.stats())
+        manager.close()
+
+    def test_failed_acks(self):
+        """Ensure that acks which fail to send are counted."""
+
+        self.mock_client._send_acknowledge.side_effect = Exception('error')
+        manager = ack.AckManager(self.mock_client, interval=60)
+
+        manager.add('/subscriptions/project/foo', ['a', 'b'])
+        manager.flush()
+
+        self.assertEqual({'pending': 0, 'flushed': 0, 'failed': 2},
+                         manager.stats())
+        manager.close()
+
+    def test_close_drains(self):
+        """Ensure that close sends queued acks and rejects further adds."""
+
+        manager = ack.AckManager(self.mock_client, interval=60)
+        manager.add('/subscriptions/project/foo', ['a'])
+
+        manager.close()
+
+        self.mock_client._send_acknowledge.assert_called_once_with(
+            '/subscriptions/project/foo', ['a'])
+        self.assertRaises(RuntimeError, manager.add,
+                          '/subscriptions/project/foo', ['b'])
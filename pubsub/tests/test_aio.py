@@ -0,0 +1,330 @@
+import base64
+import json
+import socket
+import unittest
+
+from apiclient import errors
+import mock
+
+from pubsub import codec
+
+try:
+    import asyncio
+    from pubsub import aio
+except (ImportError, SyntaxError):
+    aio = None
+
+
+class FakeTransport(object):
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def request(self, method, url, headers, body=None):
+        self.requests.append((method, url, json.loads(body) if body else None))
+        status, content = self.responses.pop(0)
+        future = asyncio.get_event_loop().create_future()
+        future.set_result((status, json.dumps(content).encode('utf-8')))
+        return future
+
+
+@unittest.skipIf(aio is None, 'asyncio is not available')
+class TestAsyncPubSubClient(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.credentials = mock.Mock(access_token='token',
+                                     access_token_expired=False)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def _client(self, *responses):
+        self.transport = FakeTransport(responses)
+        return aio.AsyncPubSubClient(self.credentials, 'project',
+                                     transport=self.transport)
+
+    def _run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_create_topic_exists(self):
+        """Ensure that nothing happens if the topic already exists."""
+
+        client = self._client((200, {'name': '/topics/project/foo'}))
+
+        self._run(client.create_topic('foo'))
+
+        self.assertEqual([('GET', aio.API_ROOT + 'topics//topics/project/foo',
+                           None)], self.transport.requests)
+
+    def test_create_topic_doesnt_exist(self):
+        """Ensure that the topic is created if it doesn't exist."""
+
+        client = self._client((404, {}), (200, {}))
+
+        self._run(client.create_topic('foo'))
+
+        self.assertEqual(('POST', aio.API_ROOT + 'topics',
+                          {'name': '/topics/project/foo'}),
+                         self.transport.requests[1])
+
+    def test_create_topic_error(self):
+        """Ensure that if the topic create fails, an exception is raised."""
+
+        client = self._client((400, {}))
+
+        self.assertRaises(errors.HttpError, self._run,
+                          client.create_topic('foo'))
+
+    def test_delete_topic_doesnt_exist(self):
+        """Ensure that nothing happens if the topic doesn't exist."""
+
+        client = self._client((404, {}))
+
+        self._run(client.delete_topic('foo'))
+
+        self.assertEqual('DELETE', self.transport.requests[0][0])
+
+    def test_subscribe(self):
+        """Ensure that the subscription is created if it doesn't exist."""
+
+        client = self._client((404, {}), (200, {}))
+
+        self._run(client.subscribe('foo', 'bar', 'https://baz.com'))
+
+        self.assertEqual(('POST', aio.API_ROOT + 'subscriptions', {
+            'name': '/subscriptions/project/foo',
+            'topic': '/topics/project/bar',
+            'pushConfig': {
+                'pushEndpoint': 'https://baz.com',
+            }
+        }), self.transport.requests[1])
+
+    def test_unsubscribe_error(self):
+        """Ensure that if the subscription deletion fails, an exception is
+        raised.
+        """
+
+        client = self._client((500, {}))
+
+        self.assertRaises(errors.HttpError, self._run,
+                          client.unsubscribe('foo'))
+
+    def test_publish(self):
+        """Ensure that publish sends the encoded message to the topic."""
+
+        client = self._client((200, {'messageId': '1'}))
+
+        self._run(client.publish('foo', b'bar'))
+
+        self.assertEqual(('POST', aio.API_ROOT + 'topics/publish', {
+            'topic': '/topics/project/foo',
+            'message': {'data': base64.b64encode(b'bar').decode('ascii')},
+        }), self.transport.requests[0])
+
+    def test_pull(self):
+        """Ensure that pull returns the decoded message and acks it."""
+
+        client = self._client((200, {
+            'pubsubEvent': {
+                'message': {'data': base64.b64encode(b'hello').decode()},
+            },
+            'ackId': 'abc',
+        }), (200, {}))
+
+        message = self._run(client.pull('foo', block=True))
+
+        self.assertEqual(b'hello', message)
+        self.assertEqual(('POST', aio.API_ROOT + 'subscriptions/pull', {
+            'subscription': '/subscriptions/project/foo',
+            'returnImmediately': False,
+        }), self.transport.requests[0])
+        self.assertEqual(('POST', aio.API_ROOT + 'subscriptions/acknowledge', {
+            'subscription': '/subscriptions/project/foo',
+            'ackId': ['abc'],
+        }), self.transport.requests[1])
+
+    def test_pull_codec(self):
+        """Ensure that pull decodes messages with the codec recorded in
+        their labels.
+        """
+
+        client = self._client((200, {
+            'pubsubEvent': {
+                'message': {
+                    'data': base64.b64encode(b'{"a":1}').decode('ascii'),
+                    'label': codec.encode_labels('json'),
+                },
+            },
+            'ackId': 'abc',
+        }), (200, {}))
+
+        self.assertEqual({'a': 1}, self._run(client.pull('foo')))
+
+    def test_pull_decode_error(self):
+        """Ensure that a message which can't be decoded isn't
+        acknowledged.
+        """
+
+        client = self._client((200, {
+            'pubsubEvent': {
+                'message': {
+                    'data': base64.b64encode(b'foo').decode('ascii'),
+                    'label': [{'key': codec.CODEC_LABEL,
+                               'strValue': 'unknown'}],
+                },
+            },
+            'ackId': 'abc',
+        }))
+
+        self.assertRaises(ValueError, self._run, client.pull('foo'))
+        self.assertEqual(1, len(self.transport.requests))
+
+    def test_pull_no_message(self):
+        """Ensure that pull returns None if there is no message."""
+
+        client = self._client((200, {'pubsubEvent': {}}))
+
+        self.assertIsNone(self._run(client.pull('foo')))
+        self.assertEqual(1, len(self.transport.requests))
+
+    def test_refresh_token(self):
+        """Ensure that an expired access token is refreshed before the
+        request is sent.
+        """
+
+        self.credentials.access_token_expired = True
+        client = self._client((200, {}))
+
+        self._run(client.delete_topic('foo'))
+
+        self.assertEqual(1, self.credentials.refresh.call_count)
+
+
+
+@unittest.skipIf(aio is None, 'asyncio is not available')
+class TestAsyncPushServer(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.handled = []
+        self.server = None
+
+    def tearDown(self):
+        if self.server:
+            self.loop.run_until_complete(self.server.close())
+        self.loop.close()
+
+    def _start(self, handler=None, **kwargs):
+        self.server = aio.AsyncPushServer(
+            handler or (lambda message: self.handled.append(message.data)),
+            host='127.0.0.1', port=0, **kwargs)
+        self.loop.run_until_complete(self.server.start())
+
+    def _post(self, bodies, path='/'):
+        # The requests are sent from another thread while the loop runs the
+        # server.
+        return self.loop.run_in_executor(None, self._post_blocking, bodies,
+                                         path)
+
+    def _post_blocking(self, bodies, path):
+        sock = socket.create_connection(('127.0.0.1', self.server.port))
+        reader = sock.makefile('rb')
+        statuses = []
+        for body in bodies:
+            sock.sendall(('POST %s HTTP/1.1\r\nHost: localhost\r\n'
+                          'Content-Length: %d\r\n\r\n' %
+                          (path, len(body))).encode('latin-1') + body)
+            statuses.append(int(reader.readline().split()[1]))
+            while reader.readline() != b'\r\n':
+                pass
+        reader.close()
+        sock.close()
+        return statuses
+
+    def _body(self, data):
+        return json.dumps({
+            'subscription': '/subscriptions/project/foo',
+            'message': {'data': base64.b64encode(data).decode('ascii')},
+        }).encode('utf-8')
+
+    def test_handle(self):
+        """Ensure that pushed messages are decoded and handled over a
+        keep-alive connection.
+        """
+
+        self._start()
+
+        statuses = self.loop.run_until_complete(
+            self._post([self._body(b'foo'), self._body(b'bar'), b'{}']))
+
+        self.assertEqual([204, 204, 400], statuses)
+        self.assertEqual([b'foo', b'bar'], self.handled)
+        self.assertEqual(2, self.server.stats()['processed'])
+
+    def test_limits(self):
+        """Ensure that corrupt compressed data gets 400 and oversized bodies
+        get 413 without being read.
+        """
+
+        self._start(max_body_size=1000)
+        corrupt = json.dumps({
+            'message': {'data': base64.b64encode(b'garbage').decode('ascii'),
+                        'label': codec.encode_labels('zlib')},
+        }).encode('utf-8')
+
+        statuses = self.loop.run_until_complete(self._post([corrupt]))
+        oversized = self.loop.run_until_complete(self.loop.run_in_executor(
+            None, self._post_oversized))
+
+        self.assertEqual([400], statuses)
+        self.assertEqual(413, oversized)
+        self.assertEqual([], self.handled)
+
+    def _post_oversized(self):
+        sock = socket.create_connection(('127.0.0.1', self.server.port))
+        sock.sendall(b'POST / HTTP/1.1\r\nContent-Length: 1001\r\n\r\n')
+        reader = sock.makefile('rb')
+        status = int(reader.readline().split()[1])
+        reader.close()
+        sock.close()
+        return status
+
+    def test_token(self):
+        """Ensure that requests without the token are forbidden."""
+
+        self._start(token='secret')
+
+        statuses = self.loop.run_until_complete(
+            self._post([self._body(b'foo')], path='/?token=wrong'))
+
+        self.assertEqual([403], statuses)
+
+    def test_overloaded(self):
+        """Ensure that requests beyond max_concurrency get 429 and failed
+        handlers get 500.
+        """
+
+        release = self.loop.create_future()
+
+        def handler(message):
+            if message.data == b'fail':
+                raise ValueError('failed')
+            return release
+
+        self._start(handler, max_concurrency=1)
+
+        slow = self._post([self._body(b'slow')])
+        while not self.server.active:
+            self.loop.run_until_complete(asyncio.sleep(0.001))
+        rejected = self.loop.run_until_complete(
+            self._post([self._body(b'foo')]))
+        release.set_result(None)
+
+        self.assertEqual([204], self.loop.run_until_complete(slow))
+        self.assertEqual([429], rejected)
+        self.assertEqual([500], self.loop.run_until_complete(
+            self._post([self._body(b'fail')])))
+        self.assertEqual({'processed': 1, 'failed': 1, 'rejected': 1,
+                          'active': 0}, self.server.stats())
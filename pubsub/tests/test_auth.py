@@ -0,0 +1,132 @@
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+
+from pubsub import auth
+
+
+class TestSharedTokenCredentials(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'token.json')
+        self.tokens = iter('token-%d' % i for i in range(100))
+        self.mock_credentials = mock.Mock()
+
+        def refresh(http):
+            self.mock_credentials.access_token = next(self.tokens)
+            self.mock_credentials.token_expiry = \
+                datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+
+        self.mock_credentials.refresh.side_effect = refresh
+        self.shared = []
+
+    def tearDown(self):
+        for credentials in self.shared:
+            credentials.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def _shared(self, **kwargs):
+        credentials = auth.SharedTokenCredentials(self.mock_credentials,
+                                                  path=self.path, **kwargs)
+        self.shared.append(credentials)
+        return credentials
+
+    def test_mint_and_store(self):
+        """Ensure that a token is minted and stored when none is cached."""
+
+        credentials = self._shared()
+
+        self.assertEqual('token-0', credentials.get_access_token())
+        self.assertEqual('token-0', credentials.get_access_token())
+        self.assertEqual(1, self.mock_credentials.refresh.call_count)
+        with open(self.path) as f:
+            cached = json.load(f)
+        self.assertEqual('token-0', cached['access_token'])
+        self.assertTrue(cached['expires_at'] > time.time() + 3000)
+
+    def test_shared_between_instances(self):
+        """Ensure that a token minted by one process is reused by another
+        instead of minting a new one.
+        """
+
+        self._shared().get_access_token()
+
+        self.assertEqual('token-0', self._shared().get_access_token())
+        self.assertEqual(1, self.mock_credentials.refresh.call_count)
+
+    def test_expiring_token_refreshed(self):
+        """Ensure that a cached token within the refresh margin is
+        replaced.
+        """
+
+        with open(self.path, 'w') as f:
+            json.dump({'access_token': 'old',
+                       'expires_at': time.time() + 10}, f)
+
+        self.assertEqual('token-0', self._shared().get_access_token())
+
+    def test_refresh_adopts_newer_token(self):
+        """Ensure that a forced refresh uses a newer token stored by another
+        process rather than minting one.
+        """
+
+        credentials = self._shared()
+        credentials.get_access_token()
+        with open(self.path, 'w') as f:
+            json.dump({'access_token': 'other',
+                       'expires_at': time.time() + 3600}, f)
+
+        credentials.refresh()
+
+        self.assertEqual('other', credentials.access_token)
+        self.assertEqual(1, self.mock_credentials.refresh.call_count)
+
+    def test_authorize(self):
+        """Ensure that authorized requests carry the token and are retried
+        once with a new token on 401.
+        """
+
+        credentials = self._shared()
+        mock_http = mock.Mock()
+        request = mock_http.request
+        request.side_effect = [(mock.Mock(status=401), b''),
+                               (mock.Mock(status=200), b'ok')]
+
+        http = credentials.authorize(mock_http)
+        resp, content = http.request('https://example.com', method='POST',
+                                     body='{}')
+
+        self.assertEqual(b'ok', content)
+        self.assertEqual(
+            [mock.call('https://example.com', 'POST', '{}',
+                       {'authorization': 'Bearer token-0'}),
+             mock.call('https://example.com', 'POST', '{}',
+                       {'authorization': 'Bearer token-1'})],
+            request.call_args_list)
+
+    def test_access_token_expired(self):
+        """Ensure that access_token_expired reflects the in-memory token."""
+
+        credentials = self._shared()
+        self.assertTrue(credentials.access_token_expired)
+
+        credentials.get_access_token()
+
+        self.assertFalse(credentials.access_token_expired)
+
+    def test_default_token_path(self):
+        """Ensure that the default path is keyed by the service account."""
+
+        first = auth.default_token_path(mock.Mock(service_account_name='a',
+                                                  scope='s'))
+        second = auth.default_token_path(mock.Mock(service_account_name='b',
+                                                   scope='s'))
+
+        self.assertNotEqual(first, second)
@@ -0,0 +1,67 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from pubsub import bench
+
+
+class TestRun(unittest.TestCase):
+
+    def test_run(self):
+        """Ensure that every workload runs against the emulator and
+        reports all of its messages.
+        """
+
+        results = bench.run(message_sizes=(10,), concurrency_levels=(2,),
+                            batch_sizes=(3,), messages=20,
+                            trace_allocations=False)
+
+        self.assertEqual(list(bench.WORKLOADS),
+                         [result['workload'] for result in results])
+        for result in results:
+            self.assertEqual(20 if result['workload'] != 'publish_batch'
+                             else 21, result['messages'])
+            self.assertTrue(result['msgs_per_sec'] > 0)
+            self.assertTrue(result['latency_p99'] >= result['latency_p50'])
+
+    def test_batch_size_ignored(self):
+        """Ensure that unbatched workloads run once with a batch size of
+        1.
+        """
+
+        results = bench.run(workloads=('publish',), message_sizes=(10,),
+                            concurrency_levels=(1,), batch_sizes=(3, 5),
+                            messages=5, trace_allocations=False)
+
+        self.assertEqual([1], [result['batch_size'] for result in results])
+
+
+class TestMain(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_output(self):
+        """Ensure that results are written as JSON and can be compared
+        against a previous run.
+        """
+
+        first = os.path.join(self.directory, 'first.json')
+        second = os.path.join(self.directory, 'second.json')
+        args = ['--workloads', 'publish,pull', '--sizes', '10',
+                '--concurrency', '1', '--batch-sizes', '5', '--messages',
+                '10', '--no-allocations']
+
+        bench.main(args + ['--output', first])
+        bench.main(args + ['--output', second, '--compare', first])
+
+        with open(second) as f:
+            report = json.load(f)
+        self.assertEqual(['publish', 'pull'],
+                         [result['workload'] for result in report['results']])
+        self.assertEqual(10, report['config']['messages'])
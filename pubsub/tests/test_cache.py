@@ -0,0 +1,71 @@
+import unittest
+
+import mock
+
+from pubsub import cache
+
+
+class TestTTLCache(unittest.TestCase):
+
+    def test_add(self):
+        """Ensure that added keys are contained until they expire."""
+
+        ttl_cache = cache.TTLCache(10)
+
+        ttl_cache.add('foo')
+
+        self.assertIn('foo', ttl_cache)
+        self.assertNotIn('bar', ttl_cache)
+
+    @mock.patch('pubsub.cache.time')
+    def test_expire(self, mock_time):
+        """Ensure that keys are forgotten once the ttl elapses."""
+
+        mock_time.time.return_value = 100
+        ttl_cache = cache.TTLCache(10)
+        ttl_cache.add('foo')
+
+        mock_time.time.return_value = 110
+
+        self.assertNotIn('foo', ttl_cache)
+        self.assertEqual(0, len(ttl_cache))
+
+    def test_discard(self):
+        """Ensure that discarded keys are forgotten."""
+
+        ttl_cache = cache.TTLCache(10)
+        ttl_cache.add('foo')
+
+        ttl_cache.discard('foo')
+        ttl_cache.discard('bar')
+
+        self.assertNotIn('foo', ttl_cache)
+
+    @mock.patch('pubsub.cache.time')
+    def test_max_size(self, mock_time):
+        """Ensure that expired keys are evicted when the cache is full."""
+
+        mock_time.time.return_value = 100
+        ttl_cache = cache.TTLCache(10, max_size=2)
+        ttl_cache.add('foo')
+        mock_time.time.return_value = 105
+        ttl_cache.add('bar')
+
+        mock_time.time.return_value = 111
+        ttl_cache.add('baz')
+
+        self.assertEqual(2, len(ttl_cache))
+        self.assertIn('bar', ttl_cache)
+        self.assertIn('baz', ttl_cache)
+
+    def test_max_size_clears(self):
+        """Ensure that the cache is cleared if it is full of live keys."""
+
+        ttl_cache = cache.TTLCache(10, max_size=2)
+        ttl_cache.add('foo')
+        ttl_cache.add('bar')
+
+        ttl_cache.add('baz')
+
+        self.assertEqual(1, len(ttl_cache))
+        self.assertIn('baz', ttl_cache)
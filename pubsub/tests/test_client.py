@@ -1,10 +1,14 @@
 import base64
 import unittest
+import zlib
 
 from apiclient import errors
 import mock
 
 from pubsub import client
+from pubsub import codec
+from pubsub import ratelimit
+from pubsub import retry
 
 
 class TestGetClient(unittest.TestCase):
@@ -15,7 +19,7 @@ class TestGetClient(unittest.TestCase):
         self.assertRaises(Exception, client.get_client, 'foo', 'bar')
 
     @mock.patch('pubsub.client._credentials')
-    @mock.patch('pubsub.client.build')
+    @mock.patch('pubsub.discovery.build_service')
     def test_initialize(self, mock_build, mock_return_cred):
         """Ensure that a PubSubClient is initialized and returned."""
         from pubsub.client import PUBSUB_SCOPE
@@ -36,11 +40,66 @@ class TestGetClient(unittest.TestCase):
         mock_return_cred.assert_called_once_with()
         mock_cred.assert_called_once_with(service_account, key,
                                           scope=PUBSUB_SCOPE)
-        mock_cred.authorize.assert_called_once()
-        mock_build.assert_called_once_with('pubsub', 'v1beta1', http=mock_http)
+        mock_cred.return_value.authorize.assert_called_once_with(mock.ANY)
+        mock_build.assert_called_once_with(mock_http)
         self.assertEquals(mock_pubsub, pubsub_client.pubsub)
         self.assertEquals(project_id, pubsub_client.project_id)
 
+    @mock.patch('pubsub.discovery.build_service')
+    def test_initialize_pool(self, mock_build):
+        """Ensure that a PubSubClient executing requests on a connection pool
+        is returned when pool_size is provided.
+        """
+
+        mock_cred = mock.Mock()
+
+        pubsub_client = client.get_client('project', credentials=mock_cred,
+                                          pool_size=5, pool_timeout=1)
+
+        self.assertEqual(5, pubsub_client.http_pool.size)
+        self.assertEqual(1, pubsub_client.http_pool.timeout)
+        self.assertEqual(mock_build.return_value, pubsub_client.pubsub)
+        mock_build.assert_called_once_with(mock_cred.authorize.return_value)
+        self.assertEqual(0, pubsub_client.http_pool.stats()['in_use'])
+
+    @mock.patch('pubsub.client._get_pubsub_service')
+    @mock.patch('pubsub.auth.SharedTokenCredentials')
+    def test_close_shared_token_credentials(self, mock_shared,
+                                            mock_get_service):
+        """Ensure that shared token credentials created for the client are
+        closed with it, stopping their background refresher.
+        """
+
+        mock_cred = mock.Mock()
+
+        pubsub_client = client.get_client('project', credentials=mock_cred,
+                                          shared_token_cache=True)
+
+        mock_shared.assert_called_once_with(mock_cred, path=None)
+        mock_get_service.assert_called_once_with(
+            credentials=mock_shared.return_value, service_account=None,
+            private_key=None)
+        self.assertFalse(mock_shared.return_value.close.called)
+
+        pubsub_client.close()
+        pubsub_client.close()
+
+        mock_shared.return_value.close.assert_called_once_with()
+
+    def test_execute_pooled(self):
+        """Ensure that requests are executed on a pooled connection."""
+
+        mock_pool = mock.MagicMock()
+        mock_http = mock_pool.connection.return_value.__enter__.return_value
+        mock_pubsub = mock.Mock()
+        pubsub_client = client.PubSubClient(mock_pubsub, 'project',
+                                            http_pool=mock_pool)
+
+        pubsub_client.delete_topic('foo')
+
+        mock_pubsub.topics.return_value.delete.return_value.execute \
+            .assert_called_once_with(http=mock_http)
+
 
 class TestCreateTopic(unittest.TestCase):
 
@@ -429,3 +488,919 @@ class TestPull(unittest.TestCase):
         })
         mock_pull.execute.assert_called_once_with()
 
+
+
+class TestPublishBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.project_id = 'project'
+        self.mock_pubsub = mock.Mock()
+        self.client = client.PubSubClient(self.mock_pubsub, self.project_id)
+
+    def test_publish_batch(self):
+        """Ensure that publish_batch publishes all messages in one request
+        and returns the message ids.
+        """
+
+        mock_topics = mock.Mock()
+        mock_publish = mock.Mock()
+        mock_publish.execute.return_value = {'messageIds': ['1', '2']}
+        mock_topics.publishBatch.return_value = mock_publish
+        self.mock_pubsub.topics.return_value = mock_topics
+
+        ids = self.client.publish_batch('foo', [b'bar', b'baz'])
+
+        self.assertEqual(['1', '2'], ids)
+        mock_topics.publishBatch.assert_called_once_with(body={
+            'topic': '/topics/project/foo',
+            'messages': [
+                {'data': base64.b64encode(b'bar').decode('ascii')},
+                {'data': base64.b64encode(b'baz').decode('ascii')},
+            ]
+        })
+        mock_publish.execute.assert_called_once_with()
+
+    def test_publish_batch_empty(self):
+        """Ensure that publish_batch makes no request when there are no
+        messages.
+        """
+
+        self.assertEqual([], self.client.publish_batch('foo', []))
+        self.assertFalse(self.mock_pubsub.topics.called)
+
+
+class TestPullMany(unittest.TestCase):
+
+    def setUp(self):
+        self.project_id = 'project'
+        self.mock_pubsub = mock.Mock()
+        self.client = client.PubSubClient(self.mock_pubsub, self.project_id)
+        self.mock_subscriptions = mock.Mock()
+        self.mock_pull = mock.Mock()
+        self.mock_pull.execute.return_value = {
+            'pullResponses': [
+                {
+                    'ackId': 'abc',
+                    'pubsubEvent': {
+                        'message': {
+                            'data': base64.b64encode(b'hello').decode('ascii'),
+                            'messageId': '1',
+                        },
+                    },
+                },
+                {
+                    'ackId': 'def',
+                    'pubsubEvent': {
+                        'message': {
+                            'data': base64.b64encode(b'world').decode('ascii'),
+                            'messageId': '2',
+                        },
+                    },
+                },
+            ]
+        }
+        self.mock_subscriptions.pullBatch.return_value = self.mock_pull
+        self.mock_ack = mock.Mock()
+        self.mock_subscriptions.acknowledge.return_value = self.mock_ack
+        self.mock_pubsub.subscriptions.return_value = self.mock_subscriptions
+
+    def test_pull_many(self):
+        """Ensure that pull_many pulls several messages in one request and
+        acks them all with one request.
+        """
+
+        messages = self.client.pull_many('foo', max_messages=10, block=True)
+
+        self.assertEqual([b'hello', b'world'], [m.data for m in messages])
+        self.assertEqual(['1', '2'], [m.message_id for m in messages])
+        self.assertEqual([8, 8], [m.size for m in messages])
+        self.assertEqual('foo', messages[0].subscription)
+        self.mock_subscriptions.pullBatch.assert_called_once_with(body={
+            'subscription': '/subscriptions/project/foo',
+            'returnImmediately': False,
+            'maxEvents': 10,
+        })
+        self.mock_subscriptions.acknowledge.assert_called_once_with(body={
+            'subscription': '/subscriptions/project/foo',
+            'ackId': ['abc', 'def'],
+        })
+        self.mock_ack.execute.assert_called_once_with()
+
+    def test_pull_many_no_auto_ack(self):
+        """Ensure that pull_many doesn't ack messages when auto_ack is False
+        and that they can be acked explicitly afterwards.
+        """
+
+        messages = self.client.pull_many('foo', auto_ack=False)
+
+        self.assertEqual(['abc', 'def'], [m.ack_id for m in messages])
+        self.assertFalse(self.mock_subscriptions.acknowledge.called)
+
+        self.client.acknowledge('foo', [m.ack_id for m in messages])
+
+        self.mock_subscriptions.acknowledge.assert_called_once_with(body={
+            'subscription': '/subscriptions/project/foo',
+            'ackId': ['abc', 'def'],
+        })
+
+    def test_pull_many_no_messages(self):
+        """Ensure that pull_many returns an empty list and doesn't ack when
+        there are no messages.
+        """
+
+        self.mock_pull.execute.return_value = {}
+
+        self.assertEqual([], self.client.pull_many('foo'))
+        self.assertFalse(self.mock_subscriptions.acknowledge.called)
+
+
+class TestAckManager(unittest.TestCase):
+
+    def setUp(self):
+        self.project_id = 'project'
+        self.mock_pubsub = mock.Mock()
+        self.client = client.PubSubClient(self.mock_pubsub, self.project_id)
+
+    def test_acks_queued(self):
+        """Ensure that acks are queued on the ack manager instead of being
+        sent inline once it has been started.
+        """
+
+        manager = self.client.start_ack_manager(interval=60)
+        self.assertIs(manager, self.client.start_ack_manager())
+
+        self.client.acknowledge('foo', ['abc'])
+
+        self.assertFalse(self.mock_pubsub.subscriptions.called)
+        self.assertEqual(1, manager.stats()['pending'])
+
+        self.client.close()
+
+        self.assertIsNone(self.client.ack_manager)
+        self.mock_pubsub.subscriptions.return_value.acknowledge \
+            .assert_called_once_with(body={
+                'subscription': '/subscriptions/project/foo',
+                'ackId': ['abc'],
+            })
+
+
+class TestStream(unittest.TestCase):
+
+    @mock.patch('pubsub.subscriber.MessageStream')
+    def test_stream(self, mock_stream):
+        """Ensure that stream returns a MessageStream for the
+        subscription.
+        """
+
+        pubsub_client = client.PubSubClient(mock.Mock(), 'project')
+
+        stream = pubsub_client.stream('foo', buffer_size=10)
+
+        self.assertEqual(mock_stream.return_value, stream)
+        mock_stream.assert_called_once_with(
+            pubsub_client, 'foo', buffer_size=10, batch_size=None,
+            auto_ack=True, max_concurrent_pulls=1)
+
+
+class TestConsume(unittest.TestCase):
+
+    @mock.patch('pubsub.subscriber.Subscriber')
+    def test_consume(self, mock_subscriber):
+        """Ensure that consume starts and returns a Subscriber."""
+
+        pubsub_client = client.PubSubClient(mock.Mock(), 'project')
+        handler = mock.Mock()
+
+        sub = pubsub_client.consume('foo', handler, workers=8)
+
+        self.assertEqual(mock_subscriber.return_value, sub)
+        mock_subscriber.assert_called_once_with(pubsub_client, 'foo', handler,
+                                                workers=8)
+        sub.start.assert_called_once_with()
+
+
+class TestKnownResources(unittest.TestCase):
+
+    def setUp(self):
+        self.project_id = 'project'
+        self.mock_pubsub = mock.Mock()
+        self.client = client.PubSubClient(self.mock_pubsub, self.project_id,
+                                          resource_cache_ttl=60)
+
+    def test_create_topic_cached(self):
+        """Ensure that a topic known to exist isn't checked again."""
+
+        self.client.create_topic('foo')
+        self.client.create_topic('foo')
+
+        self.mock_pubsub.topics.return_value.get.assert_called_once_with(
+            topic='/topics/project/foo')
+
+    def test_delete_topic_forgets(self):
+        """Ensure that deleting a topic removes it from the cache."""
+
+        self.client.create_topic('foo')
+        self.client.delete_topic('foo')
+        self.client.create_topic('foo')
+
+        self.assertEqual(2,
+                         self.mock_pubsub.topics.return_value.get.call_count)
+
+    def test_subscribe_cached(self):
+        """Ensure that a subscription known to exist isn't checked again."""
+
+        self.client.subscribe('foo', 'bar')
+        self.client.subscribe('foo', 'bar')
+
+        self.mock_pubsub.subscriptions.return_value.get \
+            .assert_called_once_with(subscription='/subscriptions/project/foo')
+
+    def test_unsubscribe_forgets(self):
+        """Ensure that deleting a subscription removes it from the cache."""
+
+        self.client.subscribe('foo', 'bar')
+        self.client.unsubscribe('foo')
+        self.client.subscribe('foo', 'bar')
+
+        self.assertEqual(
+            2, self.mock_pubsub.subscriptions.return_value.get.call_count)
+
+    def test_not_cached_on_error(self):
+        """Ensure that a topic isn't remembered if creating it failed."""
+
+        mock_topics = self.mock_pubsub.topics.return_value
+        mock_topics.get.return_value.execute.side_effect = errors.HttpError(
+            mock.Mock(status=500), b'error')
+
+        self.assertRaises(errors.HttpError, self.client.create_topic, 'foo')
+        self.assertNotIn('/topics/project/foo', self.client.known_resources)
+
+
+class TestCreateFirst(unittest.TestCase):
+
+    def setUp(self):
+        self.project_id = 'project'
+        self.mock_pubsub = mock.Mock()
+        self.client = client.PubSubClient(self.mock_pubsub, self.project_id,
+                                          create_first=True)
+
+    def test_create_topic(self):
+        """Ensure that create_topic creates the topic without checking
+        whether it exists first.
+        """
+
+        mock_topics = self.mock_pubsub.topics.return_value
+
+        self.client.create_topic('foo')
+
+        self.assertFalse(mock_topics.get.called)
+        mock_topics.create.assert_called_once_with(
+            body={'name': '/topics/project/foo'})
+
+    def test_create_topic_exists(self):
+        """Ensure that create_topic succeeds if the topic already exists."""
+
+        mock_topics = self.mock_pubsub.topics.return_value
+        mock_topics.create.return_value.execute.side_effect = \
+            errors.HttpError(mock.Mock(status=409), b'exists')
+
+        self.client.create_topic('foo')
+
+    def test_create_topic_error(self):
+        """Ensure that other create errors are raised."""
+
+        mock_topics = self.mock_pubsub.topics.return_value
+        mock_topics.create.return_value.execute.side_effect = \
+            errors.HttpError(mock.Mock(status=403), b'forbidden')
+
+        self.assertRaises(errors.HttpError, self.client.create_topic, 'foo')
+
+    def test_subscribe_exists(self):
+        """Ensure that subscribe succeeds if the subscription already
+        exists.
+        """
+
+        mock_subscriptions = self.mock_pubsub.subscriptions.return_value
+        mock_subscriptions.create.return_value.execute.side_effect = \
+            errors.HttpError(mock.Mock(status=409), b'exists')
+
+        self.client.subscribe('foo', 'bar')
+
+        self.assertFalse(mock_subscriptions.get.called)
+
+
+class FakeBatch(object):
+    """Executes the requests added to it one by one, like an HTTP batch
+    request would, and reports each result to the callback.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self, http=None):
+        for request_id, request in self.requests:
+            try:
+                response = request.execute()
+            except errors.HttpError as e:
+                self.callback(request_id, None, e)
+            else:
+                self.callback(request_id, response, None)
+
+
+class BatchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.project_id = 'project'
+        self.mock_pubsub = mock.Mock()
+        self.batches = []
+
+        def new_batch_http_request(callback):
+            batch = FakeBatch(callback)
+            self.batches.append(batch)
+            return batch
+
+        self.mock_pubsub.new_batch_http_request.side_effect = \
+            new_batch_http_request
+        self.client = client.PubSubClient(self.mock_pubsub, self.project_id,
+                                          resource_cache_ttl=60)
+
+    def _fail(self, mock_request, status):
+        mock_request.return_value.execute.side_effect = errors.HttpError(
+            mock.Mock(status=status), b'error')
+
+
+class TestEnsure(BatchTestCase):
+
+    def test_ensure_topics(self):
+        """Ensure that ensure_topics creates only topics which aren't known
+        to exist, in a single batch.
+        """
+
+        self.client.create_topic('foo')
+        mock_topics = self.mock_pubsub.topics.return_value
+        mock_topics.reset_mock()
+
+        self.client.ensure_topics(['foo', 'bar', 'baz'])
+
+        self.assertFalse(mock_topics.get.called)
+        self.assertEqual([mock.call(body={'name': '/topics/project/bar'}),
+                          mock.call(body={'name': '/topics/project/baz'})],
+                         mock_topics.create.call_args_list)
+        self.assertEqual(1, len(self.batches))
+
+    def test_ensure_topics_error(self):
+        """Ensure that ensure_topics raises if a create failed."""
+
+        self._fail(self.mock_pubsub.topics.return_value.create, 403)
+
+        self.assertRaises(errors.HttpError, self.client.ensure_topics,
+                          ['foo'])
+
+    def test_ensure_subscriptions(self):
+        """Ensure that ensure_subscriptions creates only subscriptions which
+        aren't known to exist.
+        """
+
+        mock_subscriptions = self.mock_pubsub.subscriptions.return_value
+        mock_subscriptions.create.return_value.execute.side_effect = [
+            None, errors.HttpError(mock.Mock(status=409), b'exists')]
+
+        self.client.ensure_subscriptions([('foo', 'bar'),
+                                          ('baz', 'bar', 'https://a.com')])
+        self.client.ensure_subscriptions([('foo', 'bar')])
+
+        self.assertEqual(2, mock_subscriptions.create.call_count)
+        mock_subscriptions.create.assert_called_with(body={
+            'name': '/subscriptions/project/baz',
+            'topic': '/topics/project/bar',
+            'pushConfig': {
+                'pushEndpoint': 'https://a.com',
+            }
+        })
+
+
+class TestBulkAdmin(BatchTestCase):
+
+    def test_create_topics(self):
+        """Ensure that create_topics checks which topics exist and creates
+        the missing ones, with one batch each.
+        """
+
+        mock_topics = self.mock_pubsub.topics.return_value
+        mock_topics.get.return_value.execute.side_effect = [
+            None, errors.HttpError(mock.Mock(status=404), b'not found')]
+
+        results = self.client.create_topics(['foo', 'bar'])
+
+        self.assertEqual({'foo': None, 'bar': None}, results)
+        mock_topics.create.assert_called_once_with(
+            body={'name': '/topics/project/bar'})
+        self.assertEqual(2, len(self.batches))
+        self.assertIn('/topics/project/foo', self.client.known_resources)
+        self.assertIn('/topics/project/bar', self.client.known_resources)
+
+    def test_create_topics_errors(self):
+        """Ensure that create_topics returns the error for each topic which
+        couldn't be created.
+        """
+
+        self._fail(self.mock_pubsub.topics.return_value.get, 500)
+
+        results = self.client.create_topics(['foo'])
+
+        self.assertEqual(500, results['foo'].resp.status)
+        self.assertNotIn('/topics/project/foo', self.client.known_resources)
+
+    def test_create_topics_create_first(self):
+        """Ensure that create_topics skips the existence check when
+        create_first is set.
+        """
+
+        self.client.create_first = True
+        mock_topics = self.mock_pubsub.topics.return_value
+        self._fail(mock_topics.create, 409)
+
+        results = self.client.create_topics(['foo'])
+
+        self.assertEqual({'foo': None}, results)
+        self.assertFalse(mock_topics.get.called)
+        self.assertEqual(1, len(self.batches))
+
+    def test_create_topics_chunked(self):
+        """Ensure that large bulk operations are split into several batch
+        requests.
+        """
+
+        self.client.create_first = True
+
+        self.client.create_topics(['t%d' % i
+                                   for i in range(client.BATCH_SIZE + 1)])
+
+        self.assertEqual([client.BATCH_SIZE, 1],
+                         [len(b.requests) for b in self.batches])
+
+    def test_delete_topics(self):
+        """Ensure that delete_topics deletes every topic in one batch and
+        treats topics which don't exist as deleted.
+        """
+
+        mock_topics = self.mock_pubsub.topics.return_value
+        mock_topics.delete.return_value.execute.side_effect = [
+            None, errors.HttpError(mock.Mock(status=404), b'not found'),
+            errors.HttpError(mock.Mock(status=500), b'error')]
+
+        results = self.client.delete_topics(['foo', 'bar', 'baz'])
+
+        self.assertIsNone(results['foo'])
+        self.assertIsNone(results['bar'])
+        self.assertEqual(500, results['baz'].resp.status)
+        self.assertEqual(1, len(self.batches))
+        mock_topics.delete.assert_any_call(topic='/topics/project/foo')
+
+    def test_subscribe_many(self):
+        """Ensure that subscribe_many creates the missing subscriptions."""
+
+        mock_subscriptions = self.mock_pubsub.subscriptions.return_value
+        self._fail(mock_subscriptions.get, 404)
+
+        results = self.client.subscribe_many(
+            iter([('foo', 'bar', 'https://a.com')]))
+
+        self.assertEqual({'foo': None}, results)
+        mock_subscriptions.create.assert_called_once_with(body={
+            'name': '/subscriptions/project/foo',
+            'topic': '/topics/project/bar',
+            'pushConfig': {
+                'pushEndpoint': 'https://a.com',
+            }
+        })
+
+    def test_unsubscribe_many(self):
+        """Ensure that unsubscribe_many deletes every subscription and
+        forgets it.
+        """
+
+        self.client.subscribe('foo', 'bar')
+        mock_subscriptions = self.mock_pubsub.subscriptions.return_value
+        self._fail(mock_subscriptions.delete, 404)
+
+        results = self.client.unsubscribe_many(['foo', 'foo'])
+
+        self.assertEqual({'foo': None}, results)
+        mock_subscriptions.delete.assert_called_once_with(
+            subscription='/subscriptions/project/foo')
+        self.assertNotIn('/subscriptions/project/foo',
+                         self.client.known_resources)
+
+
+class TestCodec(unittest.TestCase):
+
+    def setUp(self):
+        self.project_id = 'project'
+        self.mock_pubsub = mock.Mock()
+        self.client = client.PubSubClient(self.mock_pubsub, self.project_id,
+                                          codec=codec.JsonCodec())
+
+    def test_publish_labels(self):
+        """Ensure that published messages are encoded with the codec and
+        labelled with its name.
+        """
+
+        self.client.publish('foo', {'bar': 1})
+
+        self.mock_pubsub.topics.return_value.publish.assert_called_once_with(
+            body={
+                'topic': '/topics/project/foo',
+                'message': {
+                    'data': base64.b64encode(b'{"bar":1}').decode('ascii'),
+                    'label': [{'key': codec.CODEC_LABEL,
+                               'strValue': 'json'}],
+                }
+            })
+
+    def test_publish_raw_no_label(self):
+        """Ensure that messages encoded raw carry no codec label."""
+
+        self.client.codec = codec.ZlibCodec(threshold=1000)
+
+        self.client.publish_batch('foo', [b'bar'])
+
+        self.mock_pubsub.topics.return_value.publishBatch \
+            .assert_called_once_with(body={
+                'topic': '/topics/project/foo',
+                'messages': [
+                    {'data': base64.b64encode(b'bar').decode('ascii')}],
+            })
+
+    def test_pull_decodes(self):
+        """Ensure that pulled messages are decoded with the codec recorded in
+        their labels, and unlabelled messages are returned raw.
+        """
+
+        self.client.codec = None
+        mock_subscriptions = self.mock_pubsub.subscriptions.return_value
+        mock_subscriptions.pullBatch.return_value.execute.return_value = {
+            'pullResponses': [
+                {
+                    'ackId': 'abc',
+                    'pubsubEvent': {
+                        'message': {
+                            'data': base64.b64encode(
+                                zlib.compress(b'{"bar":1}')),
+                            'label': [{'key': codec.CODEC_LABEL,
+                                       'strValue': 'zlib+json'}],
+                        },
+                    },
+                },
+                {
+                    'ackId': 'def',
+                    'pubsubEvent': {
+                        'message': {'data': base64.b64encode(b'raw')},
+                    },
+                },
+            ]
+        }
+
+        messages = self.client.pull_many('foo')
+
+        self.assertEqual([{'bar': 1}, b'raw'], [m.data for m in messages])
+
+
+    def test_pull_decode_error(self):
+        """Ensure that a message which can't be decoded is returned raw with
+        its decode error, without affecting the other messages.
+        """
+
+        mock_subscriptions = self.mock_pubsub.subscriptions.return_value
+        mock_subscriptions.pullBatch.return_value.execute.return_value = {
+            'pullResponses': [
+                {
+                    'ackId': 'abc',
+                    'pubsubEvent': {
+                        'message': {
+                            'data': base64.b64encode(b'bar'),
+                            'label': [{'key': codec.CODEC_LABEL,
+                                       'strValue': 'custom'}],
+                        },
+                    },
+                },
+                {
+                    'ackId': 'def',
+                    'pubsubEvent': {
+                        'message': {'data': base64.b64encode(b'raw')},
+                    },
+                },
+            ]
+        }
+
+        messages = self.client.pull_many('foo')
+
+        self.assertEqual([b'bar', b'raw'], [m.data for m in messages])
+        self.assertIsInstance(messages[0].decode_error, ValueError)
+        self.assertIsNone(messages[1].decode_error)
+        mock_subscriptions.acknowledge.assert_called_once_with(body={
+            'subscription': '/subscriptions/project/foo',
+            'ackId': ['abc', 'def'],
+        })
+
+    def test_pull_single_decode_error(self):
+        """Ensure that pull raises the decode error of a message which can't
+        be decoded and leaves it unacknowledged.
+        """
+
+        mock_subscriptions = self.mock_pubsub.subscriptions.return_value
+        mock_subscriptions.pull.return_value.execute.return_value = {
+            'ackId': 'abc',
+            'pubsubEvent': {
+                'message': {
+                    'data': base64.b64encode(b'bar'),
+                    'label': [{'key': codec.CODEC_LABEL,
+                               'strValue': 'custom'}],
+                },
+            },
+        }
+
+        self.assertRaises(ValueError, self.client.pull, 'foo')
+
+        self.assertFalse(mock_subscriptions.acknowledge.called)
+
+
+class TestBytesLike(unittest.TestCase):
+
+    def setUp(self):
+        self.project_id = 'project'
+        self.mock_pubsub = mock.Mock()
+        self.client = client.PubSubClient(self.mock_pubsub, self.project_id)
+
+    def test_publish_bytes_like(self):
+        """Ensure that bytearrays and memoryviews are published like
+        strings.
+        """
+
+        for message in (bytearray(b'bar'), memoryview(b'bar')):
+            self.mock_pubsub.reset_mock()
+
+            self.client.publish('foo', message)
+
+            self.mock_pubsub.topics.return_value.publish \
+                .assert_called_once_with(body={
+                    'topic': '/topics/project/foo',
+                    'message': {
+                        'data': base64.b64encode(b'bar').decode('ascii')},
+                })
+
+    def test_publish_compressed_bytes_like(self):
+        """Ensure that bytes-like messages can be compressed."""
+
+        self.client.codec = codec.ZlibCodec(threshold=10)
+
+        self.client.publish_batch('foo', [bytearray(b'a' * 100),
+                                          memoryview(b'a' * 100)])
+
+        body = self.mock_pubsub.topics.return_value.publishBatch \
+            .call_args[1]['body']
+        for message in body['messages']:
+            self.assertEqual(b'a' * 100, zlib.decompress(
+                base64.b64decode(message['data'])))
+
+    def test_pull_memoryview(self):
+        """Ensure that pull returns a memoryview when as_memoryview is
+        set.
+        """
+
+        mock_subscriptions = self.mock_pubsub.subscriptions.return_value
+        mock_subscriptions.pull.return_value.execute.return_value = {
+            'pubsubEvent': {
+                'message': {'data': base64.b64encode(b'hello world')},
+            },
+            'ackId': 'abc',
+        }
+
+        message = self.client.pull('foo', as_memoryview=True)
+
+        self.assertIsInstance(message, memoryview)
+        self.assertEqual(b'hello world', message.tobytes())
+
+
+class TestSharedTokenCache(unittest.TestCase):
+
+    @mock.patch('pubsub.discovery.build_service')
+    def test_get_client_shared_token_cache(self, mock_build):
+        """Ensure that the credentials are wrapped in SharedTokenCredentials
+        when a token cache is requested.
+        """
+        from pubsub.auth import SharedTokenCredentials
+
+        mock_cred = mock.Mock()
+
+        pubsub_client = client.get_client('project', credentials=mock_cred,
+                                          token_cache_path='/tmp/token.json',
+                                          pool_size=1)
+
+        credentials = pubsub_client.http_pool.credentials
+        self.assertIsInstance(credentials, SharedTokenCredentials)
+        self.assertEqual(mock_cred, credentials.credentials)
+        self.assertEqual('/tmp/token.json', credentials.path)
+
+
+class TestRetry(unittest.TestCase):
+
+    def setUp(self):
+        self.project_id = 'project'
+        self.mock_pubsub = mock.Mock()
+        self.mock_retry = mock.Mock()
+        self.mock_retry.call.side_effect = lambda operation, fn: fn()
+        self.client = client.PubSubClient(self.mock_pubsub, self.project_id,
+                                          retry=self.mock_retry)
+
+    def test_operations(self):
+        """Ensure that requests are executed through the retrier with their
+        operation name.
+        """
+
+        self.client.publish('foo', b'bar')
+        self.client.delete_topic('foo')
+        self.client.acknowledge('foo', ['abc'])
+
+        calls = self.mock_retry.call.call_args_list
+        self.assertEqual(['publish', 'delete_topic', 'acknowledge'],
+                         [c[0][0] for c in calls])
+        self.mock_pubsub.topics.return_value.publish.return_value.execute \
+            .assert_called_once_with()
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.project_id = 'project'
+        self.mock_pubsub = mock.Mock()
+        self.limiter = ratelimit.AdaptiveRateLimiter(initial_rate=100)
+
+    def test_publish_cost(self):
+        """Ensure that publishes take a token per message."""
+
+        pubsub_client = client.PubSubClient(self.mock_pubsub, self.project_id,
+                                            rate_limiter=self.limiter)
+
+        pubsub_client.publish('foo', b'bar')
+        pubsub_client.publish_batch('foo', [b'bar'] * 10)
+        pubsub_client.acknowledge('foo', ['abc'])
+
+        self.assertLessEqual(self.limiter.stats()['tokens'], 90)
+
+    def test_retries_throttled(self):
+        """Ensure that each attempt of a retried publish goes through the
+        limiter, and throttling lowers the rate.
+        """
+
+        retrier = retry.Retrier(retry.RetryPolicy(max_attempts=2),
+                                sleep=mock.Mock())
+        pubsub_client = client.PubSubClient(self.mock_pubsub, self.project_id,
+                                            retry=retrier,
+                                            rate_limiter=self.limiter)
+        execute = self.mock_pubsub.topics.return_value.publish.return_value \
+            .execute
+        execute.side_effect = [
+            errors.HttpError(mock.Mock(status=429), b'error'), {}]
+
+        pubsub_client.publish('foo', b'bar')
+
+        stats = self.limiter.stats()
+        self.assertEqual(1, stats['throttled'])
+        self.assertAlmostEqual(50, stats['rate'], places=1)
+        self.assertEqual(2, execute.call_count)
+
+
+class TestLeases(unittest.TestCase):
+
+    def setUp(self):
+        self.project_id = 'project'
+        self.subscription = '/subscriptions/project/foo'
+        self.mock_pubsub = mock.Mock()
+        self.client = client.PubSubClient(self.mock_pubsub, self.project_id)
+        self.client.lease_manager = mock.Mock()
+
+    def test_modify_ack_deadline(self):
+        """Ensure that modify_ack_deadline sends the ack ids in one
+        request.
+        """
+
+        self.client.modify_ack_deadline('foo', ['abc', 'def'], 30)
+
+        self.mock_pubsub.subscriptions.return_value.modifyAckDeadline \
+            .assert_called_once_with(body={
+                'subscription': self.subscription,
+                'ackIds': ['abc', 'def'],
+                'ackDeadlineSeconds': 30,
+            })
+
+    def test_lease_pulled_messages(self):
+        """Ensure that messages pulled without being acknowledged are leased
+        until they are acknowledged or released.
+        """
+
+        self.mock_pubsub.subscriptions.return_value.pullBatch.return_value \
+            .execute.return_value = {'pullResponses': [
+                {'ackId': 'abc', 'pubsubEvent': {'message': {
+                    'data': base64.b64encode(b'bar')}}},
+                {'ackId': 'def', 'pubsubEvent': {'message': {
+                    'data': base64.b64encode(b'baz')}}},
+            ]}
+
+        self.client.pull_many('foo', auto_ack=False)
+        self.client.acknowledge('foo', ['abc'])
+        self.client.release('foo', ['def'])
+
+        manager = self.client.lease_manager
+        manager.add.assert_called_once_with(self.subscription,
+                                            ['abc', 'def'])
+        manager.remove.assert_has_calls([
+            mock.call(self.subscription, ['abc']),
+            mock.call(self.subscription, ['def'], handled=False)])
+
+    def test_auto_ack_not_leased(self):
+        """Ensure that messages acknowledged by pull_many aren't leased."""
+
+        self.mock_pubsub.subscriptions.return_value.pullBatch.return_value \
+            .execute.return_value = {'pullResponses': [
+                {'ackId': 'abc', 'pubsubEvent': {'message': {
+                    'data': base64.b64encode(b'bar')}}},
+            ]}
+
+        self.client.pull_many('foo')
+
+        self.assertFalse(self.client.lease_manager.add.called)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.project_id = 'project'
+        self.mock_pubsub = mock.Mock()
+        self.mock_metrics = mock.Mock()
+        self.client = client.PubSubClient(self.mock_pubsub, self.project_id,
+                                          metrics=self.mock_metrics)
+
+    def test_publish(self):
+        """Ensure that publish records the request, the message and its
+        encoding.
+        """
+
+        self.client.publish('foo', b'bar')
+
+        self.mock_metrics.record_request.assert_called_once_with(
+            'publish', mock.ANY)
+        self.mock_metrics.record_messages.assert_called_once_with(
+            'publish', 1, len('YmFy'))
+        self.mock_metrics.record_codec.assert_called_once_with(
+            'encode', mock.ANY)
+
+    def test_pull_many(self):
+        """Ensure that pull_many records the pulled and acknowledged
+        messages and their decoding.
+        """
+
+        data = base64.b64encode(b'bar').decode('ascii')
+        self.mock_pubsub.subscriptions.return_value.pullBatch.return_value \
+            .execute.return_value = {
+                'pullResponses': [
+                    {'ackId': '1', 'pubsubEvent': {'message': {'data': data}}},
+                    {'ackId': '2', 'pubsubEvent': {'message': {'data': data}}},
+                ]
+            }
+
+        self.client.pull_many('foo')
+
+        self.assertEqual(
+            [mock.call('pull', 2, 2 * len(data)),
+             mock.call('acknowledge', 2, 0)],
+            self.mock_metrics.record_messages.call_args_list)
+        self.assertEqual(2, self.mock_metrics.record_codec.call_count)
+        self.assertEqual(
+            ['pull', 'acknowledge'],
+            [c[0][0] for c in self.mock_metrics.record_request.call_args_list])
+
+    def test_error(self):
+        """Ensure that failed requests are recorded with their status."""
+
+        self.mock_pubsub.topics.return_value.delete.return_value.execute \
+            .side_effect = errors.HttpError(mock.Mock(status=500), b'error')
+
+        self.assertRaises(errors.HttpError, self.client.delete_topic, 'foo')
+
+        self.mock_metrics.record_request.assert_called_once_with(
+            'delete_topic', mock.ANY, 500)
+
+    def test_disabled(self):
+        """Ensure that nothing is timed without metrics."""
+
+        pubsub_client = client.PubSubClient(self.mock_pubsub, self.project_id)
+
+        with mock.patch('pubsub.client.clock') as mock_clock:
+            pubsub_client.publish('foo', b'bar')
+
+        self.assertFalse(mock_clock.called)
@@ -0,0 +1,125 @@
+import json
+import unittest
+import zlib
+
+from pubsub import codec
+
+
+class TestCodecs(unittest.TestCase):
+
+    def test_raw(self):
+        """Ensure that the raw codec leaves data unchanged."""
+
+        self.assertEqual(('raw', b'foo'), codec.RawCodec().encode(b'foo'))
+        self.assertEqual(b'foo', codec.RawCodec().decode(b'foo'))
+
+    def test_json(self):
+        """Ensure that the JSON codec round trips values."""
+
+        name, data = codec.JsonCodec().encode({'foo': [1, 2]})
+
+        self.assertEqual('json', name)
+        self.assertEqual({'foo': [1, 2]}, json.loads(data.decode('utf-8')))
+        self.assertEqual({'foo': [1, 2]}, codec.JsonCodec().decode(data))
+
+    def test_zlib_below_threshold(self):
+        """Ensure that values below the threshold aren't compressed."""
+
+        zlib_codec = codec.ZlibCodec(codec.JsonCodec(), threshold=100)
+
+        self.assertEqual(('json', b'[1]'), zlib_codec.encode([1]))
+
+    def test_zlib_above_threshold(self):
+        """Ensure that values above the threshold are compressed and
+        labelled with both stages.
+        """
+
+        zlib_codec = codec.ZlibCodec(codec.JsonCodec(), threshold=10)
+        value = ['a' * 100]
+
+        name, data = zlib_codec.encode(value)
+
+        self.assertEqual('zlib+json', name)
+        self.assertEqual(value, json.loads(zlib.decompress(data).decode(
+            'utf-8')))
+
+    def test_zlib_raw(self):
+        """Ensure that compressed raw data is labelled zlib."""
+
+        name, data = codec.ZlibCodec(threshold=10).encode(b'a' * 100)
+
+        self.assertEqual('zlib', name)
+        self.assertEqual(b'a' * 100, zlib.decompress(data))
+
+    def test_zlib_max_size(self):
+        """Ensure that data which decompresses to more than max_size bytes
+        is rejected.
+        """
+
+        data = zlib.compress(b'a' * 1000)
+
+        self.assertEqual(b'a' * 1000,
+                         codec.ZlibCodec(max_size=1000).decode(data))
+        self.assertRaises(ValueError, codec.ZlibCodec(max_size=999).decode,
+                          data)
+
+    def test_zlib_corrupt(self):
+        """Ensure that corrupt compressed data raises."""
+
+        self.assertRaises(zlib.error, codec.ZlibCodec().decode, b'garbage')
+
+    def test_zlib_incompressible(self):
+        """Ensure that data which doesn't shrink is sent uncompressed."""
+
+        self.assertEqual(('raw', b'abcdefghij'),
+                         codec.ZlibCodec(threshold=1).encode(b'abcdefghij'))
+
+
+class TestDecode(unittest.TestCase):
+
+    def test_no_label(self):
+        """Ensure that data without a codec label is returned as is."""
+
+        self.assertEqual(b'foo', codec.decode(b'foo'))
+        self.assertEqual(b'foo', codec.decode(b'foo', [{'key': 'other',
+                                                        'strValue': 'json'}]))
+
+    def test_stages(self):
+        """Ensure that each stage recorded in the label is decoded."""
+
+        data = zlib.compress(b'{"foo":1}')
+        labels = [{'key': codec.CODEC_LABEL, 'strValue': 'zlib+json'}]
+
+        self.assertEqual({'foo': 1}, codec.decode(data, labels))
+
+    def test_unknown_codec(self):
+        """Ensure that an unknown codec name raises ValueError."""
+
+        labels = [{'key': codec.CODEC_LABEL, 'strValue': 'nope'}]
+
+        self.assertRaises(ValueError, codec.decode, b'foo', labels)
+
+    def test_register_codec(self):
+        """Ensure that user-defined codecs can be registered."""
+
+        class UpperCodec(codec.Codec):
+            name = 'upper'
+
+            def encode(self, value):
+                return self.name, value.upper()
+
+            def decode(self, data):
+                return data.lower()
+
+        codec.register_codec(UpperCodec())
+        labels = codec.encode_labels('upper')
+
+        self.assertEqual(b'foo', codec.decode(b'FOO', labels))
+        self.assertRaises(ValueError, codec.register_codec, codec.Codec())
+
+    def test_encode_labels(self):
+        """Ensure that raw messages have no codec label."""
+
+        self.assertEqual([], codec.encode_labels('raw'))
+        self.assertEqual([{'key': codec.CODEC_LABEL, 'strValue': 'json'}],
+                         codec.encode_labels('json'))
@@ -0,0 +1,168 @@
+import unittest
+
+import mock
+
+from pubsub import client
+from pubsub import dedup
+
+
+def _message(ack_id, data=b'data', message_id=None):
+    return client.Message('foo', ack_id, data, message_id, len(data))
+
+
+class TestKeys(unittest.TestCase):
+
+    def test_message_key(self):
+        """Ensure that messages are keyed by message id, falling back to a
+        hash of their content.
+        """
+
+        self.assertEqual('id-1', dedup.message_key(
+            _message('ack-1', message_id='id-1')))
+        self.assertEqual(dedup.content_key(_message('ack-1')),
+                         dedup.message_key(_message('ack-2')))
+
+    def test_content_key(self):
+        """Ensure that equal content has equal keys whatever its type."""
+
+        self.assertEqual(
+            dedup.content_key(_message('ack-1', b'data')),
+            dedup.content_key(_message('ack-2', memoryview(b'data'))))
+        self.assertEqual(
+            dedup.content_key(client.Message('foo', 'ack-1',
+                                             {'a': 1, 'b': 2})),
+            dedup.content_key(client.Message('foo', 'ack-2',
+                                             {'b': 2, 'a': 1})))
+        self.assertNotEqual(dedup.content_key(_message('ack-1', b'foo')),
+                            dedup.content_key(_message('ack-1', b'bar')))
+
+
+class TestBloomFilter(unittest.TestCase):
+
+    def test_membership(self):
+        """Ensure that added keys are always found and the false-positive
+        rate is close to the configured one.
+        """
+
+        bloom = dedup.BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add('key-%d' % i)
+
+        self.assertTrue(all('key-%d' % i in bloom for i in range(1000)))
+        false_positives = sum('other-%d' % i in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+        self.assertEqual(1000, len(bloom))
+
+    def test_invalid(self):
+        """Ensure that invalid sizes are rejected."""
+
+        self.assertRaises(ValueError, dedup.BloomFilter, 0, 0.01)
+        self.assertRaises(ValueError, dedup.BloomFilter, 10, 1)
+
+
+class TestDeduplicator(unittest.TestCase):
+
+    def test_filter(self):
+        """Ensure that handled messages are reported as duplicates and
+        repeats within a batch as repeats.
+        """
+
+        deduplicator = dedup.Deduplicator()
+        deduplicator.add('id-1')
+
+        fresh, duplicates, repeats = deduplicator.filter([
+            _message('ack-1', message_id='id-1'),
+            _message('ack-2', message_id='id-2'),
+            _message('ack-3', message_id='id-2'),
+        ])
+
+        self.assertEqual(['ack-2'], [m.ack_id for m in fresh])
+        self.assertEqual(['ack-1'], [m.ack_id for m in duplicates])
+        self.assertEqual(['ack-3'], [m.ack_id for m in repeats])
+        stats = deduplicator.stats()
+        self.assertEqual(1, stats['exact_hits'])
+        self.assertEqual(1, stats['misses'])
+
+    def test_unhandled_messages_not_remembered(self):
+        """Ensure that filtering a message doesn't record it, so it is
+        delivered again if its handler fails.
+        """
+
+        deduplicator = dedup.Deduplicator()
+        message = _message('ack-1', message_id='id-1')
+
+        deduplicator.filter([message])
+        fresh, _, _ = deduplicator.filter([message])
+
+        self.assertEqual([message], fresh)
+
+    def test_lru_eviction(self):
+        """Ensure that keys evicted from the LRU are still found in the
+        Bloom filter.
+        """
+
+        deduplicator = dedup.Deduplicator(max_keys=2)
+        for key in ('id-1', 'id-2', 'id-3'):
+            deduplicator.add(key)
+
+        self.assertIn('id-1', deduplicator)
+        self.assertIn('id-3', deduplicator)
+        stats = deduplicator.stats()
+        self.assertEqual(1, stats['evictions'])
+        self.assertEqual(1, stats['bloom_hits'])
+        self.assertEqual(1, stats['exact_hits'])
+        self.assertEqual(2, stats['keys'])
+
+    @mock.patch('pubsub.dedup.time')
+    def test_window(self, mock_time):
+        """Ensure that keys are forgotten once they are older than two
+        windows.
+        """
+
+        mock_time.time.return_value = 0
+        deduplicator = dedup.Deduplicator(max_keys=1, window=10)
+        deduplicator.add('id-1')
+        deduplicator.add('id-2')
+
+        mock_time.time.return_value = 15
+        deduplicator.add('id-3')
+        self.assertIn('id-1', deduplicator)
+
+        mock_time.time.return_value = 35
+        deduplicator.add('id-4')
+        self.assertNotIn('id-1', deduplicator)
+        self.assertEqual(2, deduplicator.stats()['rotations'])
+
+    def test_capacity_rotation(self):
+        """Ensure that a full Bloom filter is rotated out so the
+        false-positive rate stays bounded.
+        """
+
+        deduplicator = dedup.Deduplicator(max_keys=1, bloom_capacity=2)
+        for key in ('id-1', 'id-2', 'id-3', 'id-4', 'id-5'):
+            deduplicator.add(key)
+
+        self.assertEqual(2, deduplicator.stats()['rotations'])
+        self.assertNotIn('id-1', deduplicator)
+        self.assertIn('id-3', deduplicator)
+
+    def test_drop_duplicates(self):
+        """Ensure that duplicates are acknowledged in one request and
+        dropped, and repeats within the batch are released unacknowledged.
+        """
+
+        mock_client = mock.Mock()
+        deduplicator = dedup.Deduplicator()
+        deduplicator.add('id-1')
+
+        fresh = dedup.drop_duplicates(mock_client, 'foo', deduplicator, [
+            _message('ack-1', message_id='id-1'),
+            _message('ack-2', message_id='id-2'),
+            _message('ack-3', message_id='id-1'),
+            _message('ack-4', message_id='id-2'),
+        ])
+
+        self.assertEqual(['ack-2'], [m.ack_id for m in fresh])
+        mock_client.acknowledge.assert_called_once_with(
+            'foo', ['ack-1', 'ack-3'])
+        mock_client.release.assert_called_once_with('foo', ['ack-4'])
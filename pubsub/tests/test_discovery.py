@@ -0,0 +1,138 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from apiclient import errors
+import mock
+
+from pubsub import discovery
+
+
+DOCUMENT = {'name': 'pubsub', 'version': 'v1beta1', 'resources': {}}
+
+
+class TestGetDocument(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.cache_dir, 'pubsub-v1beta1.json')
+        self.mock_http = mock.Mock()
+        self.mock_http.request.return_value = (
+            mock.Mock(status=200), json.dumps(DOCUMENT).encode('utf-8'))
+        discovery._documents.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        discovery._documents.clear()
+
+    def _write(self, cached):
+        with open(self.path, 'w') as f:
+            json.dump(cached, f)
+
+    def test_fetch_and_cache(self):
+        """Ensure that the document is fetched and written to the cache when
+        it isn't cached.
+        """
+
+        document = discovery.get_document(self.mock_http,
+                                          cache_dir=self.cache_dir)
+
+        self.assertEqual(DOCUMENT, document)
+        self.mock_http.request.assert_called_once_with(
+            discovery.DISCOVERY_URI)
+        with open(self.path) as f:
+            self.assertEqual(DOCUMENT, json.load(f)['document'])
+
+    def test_cached(self):
+        """Ensure that a fresh cached document is used without fetching."""
+
+        self._write({'format': discovery.CACHE_FORMAT,
+                     'cached_at': time.time(), 'document': DOCUMENT})
+
+        document = discovery.get_document(self.mock_http,
+                                          cache_dir=self.cache_dir)
+
+        self.assertEqual(DOCUMENT, document)
+        self.assertFalse(self.mock_http.request.called)
+
+    def test_memoized(self):
+        """Ensure that the document is only read from disk once."""
+
+        discovery.get_document(self.mock_http, cache_dir=self.cache_dir)
+        os.remove(self.path)
+
+        discovery.get_document(self.mock_http, cache_dir=self.cache_dir)
+
+        self.assertEqual(1, self.mock_http.request.call_count)
+
+    def test_expired(self):
+        """Ensure that an expired document is fetched again."""
+
+        self._write({'format': discovery.CACHE_FORMAT,
+                     'cached_at': time.time() - 100, 'document': DOCUMENT})
+
+        discovery.get_document(self.mock_http, cache_dir=self.cache_dir,
+                               max_age=10)
+
+        self.assertEqual(1, self.mock_http.request.call_count)
+
+    def test_version_mismatch(self):
+        """Ensure that a cached document for another API version or cache
+        format is ignored.
+        """
+
+        self._write({'format': discovery.CACHE_FORMAT,
+                     'cached_at': time.time(),
+                     'document': dict(DOCUMENT, version='v1')})
+        discovery.get_document(self.mock_http, cache_dir=self.cache_dir)
+
+        discovery._documents.clear()
+        self._write({'format': discovery.CACHE_FORMAT + 1,
+                     'cached_at': time.time(), 'document': DOCUMENT})
+        discovery.get_document(self.mock_http, cache_dir=self.cache_dir)
+
+        self.assertEqual(2, self.mock_http.request.call_count)
+
+    def test_offline(self):
+        """Ensure that an expired document is used if fetching fails."""
+
+        self._write({'format': discovery.CACHE_FORMAT,
+                     'cached_at': 0, 'document': DOCUMENT})
+        self.mock_http.request.side_effect = IOError('offline')
+
+        document = discovery.get_document(self.mock_http,
+                                          cache_dir=self.cache_dir)
+
+        self.assertEqual(DOCUMENT, document)
+
+    def test_fetch_error(self):
+        """Ensure that an HttpError is raised if the document can't be
+        fetched and isn't cached.
+        """
+
+        self.mock_http.request.return_value = (mock.Mock(status=500), b'')
+
+        self.assertRaises(errors.HttpError, discovery.get_document,
+                          self.mock_http, cache_dir=self.cache_dir)
+
+
+class TestBuildService(unittest.TestCase):
+
+    @mock.patch('pubsub.discovery.get_document')
+    @mock.patch('googleapiclient.discovery.build_from_document')
+    def test_build_service(self, mock_build, mock_get_document):
+        """Ensure that the service is built from the cached document."""
+
+        mock_http = mock.Mock()
+
+        service = discovery.build_service(mock_http, cache_dir='/tmp/cache')
+
+        self.assertEqual(mock_build.return_value, service)
+        mock_get_document.assert_called_once_with(
+            mock_http, cache_dir='/tmp/cache',
+            max_age=discovery.DEFAULT_MAX_AGE)
+        mock_build.assert_called_once_with(mock_get_document.return_value,
+                                           http=mock_http)
@@ -0,0 +1,186 @@
+import json
+import threading
+import time
+import unittest
+
+from apiclient import errors
+import httplib2
+import mock
+
+from pubsub import client
+from pubsub import emulator
+
+
+class EmulatorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.emulator = emulator.Emulator(pull_timeout=5)
+        self.client = client.PubSubClient(self.emulator, 'project')
+        self.client.create_topic('topic')
+        self.client.subscribe('sub', 'topic')
+
+
+class TestEmulator(EmulatorTestCase):
+
+    def test_publish_pull(self):
+        """Ensure that published messages are pulled and acknowledged."""
+
+        self.client.publish('topic', b'foo')
+
+        self.assertEqual(b'foo', self.client.pull('sub'))
+        self.assertIsNone(self.client.pull('sub'))
+        self.assertEqual({'/subscriptions/project/sub':
+                          {'pending': 0, 'outstanding': 0}},
+                         self.emulator.stats())
+
+    def test_fan_out(self):
+        """Ensure that every subscription of a topic receives each
+        message.
+        """
+
+        self.client.subscribe('other', 'topic')
+
+        ids = self.client.publish_batch('topic', [b'foo', b'bar'])
+
+        for name in ('sub', 'other'):
+            messages = self.client.pull_many(name)
+            self.assertEqual([b'foo', b'bar'], [m.data for m in messages])
+            self.assertEqual(ids, [m.message_id for m in messages])
+
+    def test_idempotent_admin(self):
+        """Ensure that existing and missing resources are reported with the
+        statuses the client expects.
+        """
+
+        self.client.create_topic('topic')
+        self.client.subscribe('sub', 'topic')
+        self.client.delete_topic('missing')
+        self.client.unsubscribe('missing')
+
+        self.assertRaises(errors.HttpError, self.client.publish, 'missing',
+                          b'foo')
+        self.assertRaises(errors.HttpError, self.client.subscribe, 'new',
+                          'missing')
+
+    def test_bulk_admin(self):
+        """Ensure that bulk operations work with the emulator's batch
+        requests.
+        """
+
+        results = self.client.create_topics(['topic', 'a', 'b'])
+        self.assertEqual({'topic': None, 'a': None, 'b': None}, results)
+
+        self.client.delete_topics(['a', 'b'])
+
+        self.assertRaises(errors.HttpError, self.emulator.get_topic,
+                          '/topics/project/a')
+
+    def test_redeliver_nacked(self):
+        """Ensure that messages whose ack deadline is set to 0 are
+        redelivered with a new ack id, and stale ack ids are ignored.
+        """
+
+        self.client.publish('topic', b'foo')
+        first = self.client.pull_many('sub', auto_ack=False)[0]
+
+        self.emulator.modify_ack_deadline('/subscriptions/project/sub',
+                                          [first.ack_id], 0)
+        self.client.acknowledge('sub', [first.ack_id])
+        second = self.client.pull_many('sub', auto_ack=False)[0]
+
+        self.assertEqual(first.message_id, second.message_id)
+        self.assertNotEqual(first.ack_id, second.ack_id)
+
+    @mock.patch('pubsub.emulator.time')
+    def test_redeliver_expired(self, mock_time):
+        """Ensure that unacknowledged messages are redelivered once their
+        ack deadline passes.
+        """
+
+        mock_time.time.return_value = 100
+        self.client.publish_batch('topic', [b'foo', b'bar', b'baz'])
+        first = self.client.pull_many('sub', max_messages=2, auto_ack=False)
+        self.client.acknowledge('sub', [first[1].ack_id])
+
+        mock_time.time.return_value = 109
+        self.assertEqual([b'baz'],
+                         [m.data for m in self.client.pull_many('sub')])
+
+        mock_time.time.return_value = 110
+        self.assertEqual([b'foo'],
+                         [m.data for m in self.client.pull_many('sub')])
+
+    def test_blocking_pull(self):
+        """Ensure that a blocking pull returns once a message is
+        published.
+        """
+
+        timer = threading.Timer(0.05, self.client.publish,
+                                args=('topic', b'foo'))
+        timer.start()
+        start = time.time()
+
+        self.assertEqual(b'foo', self.client.pull('sub', block=True))
+        self.assertTrue(time.time() - start < 5)
+        timer.join()
+
+    def test_blocking_pull_timeout(self):
+        """Ensure that a blocking pull returns nothing after the pull
+        timeout.
+        """
+
+        self.emulator.pull_timeout = 0.01
+
+        self.assertEqual([], self.client.pull_many('sub', block=True))
+
+
+class TestEmulatorServer(EmulatorTestCase):
+
+    def setUp(self):
+        super(TestEmulatorServer, self).setUp()
+        self.server = emulator.EmulatorServer(self.emulator).start()
+        self.http = httplib2.Http()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def request(self, method, path, body=None):
+        resp, content = self.http.request(
+            self.server.url + path, method,
+            body=json.dumps(body) if body is not None else None,
+            headers={'content-type': 'application/json'})
+        return resp.status, json.loads(content.decode('utf-8'))
+
+    def test_rest_api(self):
+        """Ensure that the REST API is served over HTTP."""
+
+        status, _ = self.request(
+            'POST', 'topics/publish',
+            {'topic': '/topics/project/topic',
+             'message': {'data': 'Zm9v'}})
+        self.assertEqual(200, status)
+
+        status, resp = self.request(
+            'POST', 'subscriptions/pullBatch',
+            {'subscription': '/subscriptions/project/sub',
+             'returnImmediately': True, 'maxEvents': 10})
+        self.assertEqual(200, status)
+        self.assertEqual(
+            'Zm9v', resp['pullResponses'][0]['pubsubEvent']['message']['data'])
+
+        status, _ = self.request('GET', 'topics//topics/project/topic')
+        self.assertEqual(200, status)
+
+    def test_errors(self):
+        """Ensure that errors are returned with their status."""
+
+        status, resp = self.request('GET', 'topics//topics/project/missing')
+        self.assertEqual(404, status)
+        self.assertEqual(404, resp['error']['code'])
+
+        status, _ = self.request('POST', 'topics',
+                                 {'name': '/topics/project/topic'})
+        self.assertEqual(409, status)
+
+        status, _ = self.request('POST', 'topics/publish', {})
+        self.assertEqual(400, status)
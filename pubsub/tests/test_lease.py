@@ -0,0 +1,149 @@
+import threading
+import time
+import unittest
+
+import mock
+
+from pubsub import client
+from pubsub import emulator
+from pubsub import lease
+
+
+class TestLeaseManager(unittest.TestCase):
+
+    def setUp(self):
+        self.mock_client = mock.Mock()
+        self.managers = []
+
+    def tearDown(self):
+        for manager in self.managers:
+            manager.close()
+
+    def _manager(self, **kwargs):
+        manager = lease.LeaseManager(self.mock_client, **kwargs)
+        self.managers.append(manager)
+        return manager
+
+    def _wait_for(self, done):
+        for _ in range(300):
+            if done():
+                return
+            threading.Event().wait(0.01)
+
+    def test_extend_in_batches(self):
+        """Ensure that leases due to expire are extended together with one
+        request.
+        """
+
+        manager = self._manager(ack_deadline=1, min_extension=5,
+                                lead_time=0.5)
+        manager.add('/subscriptions/project/foo', ['ack-1', 'ack-2'])
+
+        self._wait_for(lambda: manager.stats()['extended'])
+
+        self.mock_client._send_modify_ack_deadline.assert_called_once_with(
+            '/subscriptions/project/foo', mock.ANY, 5)
+        self.assertEqual(
+            ['ack-1', 'ack-2'],
+            sorted(self.mock_client._send_modify_ack_deadline.call_args[0][1]))
+        stats = manager.stats()
+        self.assertEqual(2, stats['extended'])
+        self.assertEqual(1, stats['requests'])
+        self.assertEqual(2, stats['leased'])
+
+    def test_removed_leases_not_extended(self):
+        """Ensure that acknowledged and released messages aren't
+        extended.
+        """
+
+        manager = self._manager(ack_deadline=1, lead_time=0.5)
+        manager.add('foo', ['ack-1', 'ack-2'])
+        manager.remove('foo', ['ack-1'])
+        manager.remove('foo', ['ack-2'], handled=False)
+
+        # Wait past the point the leases would have been extended.
+        threading.Event().wait(0.7)
+
+        self.assertFalse(self.mock_client._send_modify_ack_deadline.called)
+        self.assertEqual(0, manager.stats()['leased'])
+
+    @mock.patch('pubsub.lease.time')
+    def test_percentile(self, mock_time):
+        """Ensure that extensions last for the percentile of the handling
+        times of acknowledged messages, within the bounds.
+        """
+
+        mock_time.time.return_value = 0
+        manager = self._manager(ack_deadline=1000, min_extension=10,
+                                max_extension=60, percentile=50)
+        self.assertEqual(10, manager.extension())
+
+        manager.add('foo', ['ack-%d' % i for i in range(5)])
+        for i, now in enumerate([20, 30, 40, 100, 200]):
+            mock_time.time.return_value = now
+            manager.remove('foo', ['ack-%d' % i])
+        self.assertEqual(40, manager.extension())
+
+        manager.add('foo', ['ack-5', 'ack-6', 'ack-7'])
+        mock_time.time.return_value = 2000
+        manager.remove('foo', ['ack-5'], handled=False)
+        self.assertEqual(40, manager.extension())
+        manager.remove('foo', ['ack-6', 'ack-7'])
+        self.assertEqual(60, manager.extension())
+
+    def test_max_lease(self):
+        """Ensure that leases aren't extended past max_lease."""
+
+        manager = self._manager(ack_deadline=1, min_extension=5,
+                                max_lease=1, lead_time=0.5)
+        manager.add('foo', ['ack-1'])
+
+        self._wait_for(lambda: manager.stats()['expired'])
+
+        self.assertFalse(self.mock_client._send_modify_ack_deadline.called)
+        self.assertEqual(0, manager.stats()['leased'])
+
+    def test_failure(self):
+        """Ensure that failed extensions are counted and retried."""
+
+        self.mock_client._send_modify_ack_deadline.side_effect = [
+            Exception('error'), None]
+        manager = self._manager(ack_deadline=1, min_extension=5,
+                                lead_time=0.4)
+        manager.add('foo', ['ack-1'])
+
+        self._wait_for(lambda: manager.stats()['extended'])
+
+        stats = manager.stats()
+        self.assertEqual(1, stats['failed'])
+        self.assertEqual(1, stats['extended'])
+        self.assertEqual(
+            2, self.mock_client._send_modify_ack_deadline.call_count)
+
+
+class TestLeasing(unittest.TestCase):
+
+    def test_long_handler(self):
+        """Ensure that a message held longer than the ack deadline isn't
+        redelivered while its lease is extended.
+        """
+
+        pubsub_client = client.PubSubClient(
+            emulator.Emulator(ack_deadline=1, pull_timeout=0.05), 'project')
+        pubsub_client.create_topic('topic')
+        pubsub_client.subscribe('sub', 'topic')
+        manager = pubsub_client.start_lease_manager(
+            ack_deadline=1, min_extension=1, lead_time=0.5)
+        self.addCleanup(pubsub_client.close)
+
+        pubsub_client.publish('topic', b'data')
+        message, = pubsub_client.pull_many('sub', auto_ack=False)
+        time.sleep(1.5)
+
+        self.assertEqual([], pubsub_client.pull_many('sub', auto_ack=False))
+        pubsub_client.acknowledge('sub', [message.ack_id])
+        self.assertGreaterEqual(manager.stats()['extended'], 1)
+        self.assertEqual(0, manager.stats()['leased'])
+        self.assertEqual({'pending': 0, 'outstanding': 0},
+                         pubsub_client.pubsub.stats()[
+                             '/subscriptions/project/sub'])
@@ -0,0 +1,78 @@
+import json
+import unittest
+
+from pubsub import metrics
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_empty(self):
+        """Ensure that an empty histogram has no percentiles."""
+
+        histogram = metrics.Histogram()
+
+        self.assertIsNone(histogram.percentile(50))
+        self.assertEqual(0, histogram.summary()['count'])
+
+    def test_percentile(self):
+        """Ensure that percentiles are estimated by bucket upper bounds,
+        capped at the largest observation.
+        """
+
+        histogram = metrics.Histogram(buckets=(1, 2, 4))
+
+        for value in [0.5] * 90 + [1.5] * 9 + [3]:
+            histogram.observe(value)
+
+        self.assertEqual(1, histogram.percentile(50))
+        self.assertEqual(1, histogram.percentile(90))
+        self.assertEqual(2, histogram.percentile(99))
+        self.assertEqual(3, histogram.percentile(100))
+        self.assertEqual(100, histogram.count)
+        self.assertEqual(0.5, histogram.min)
+        self.assertEqual(3, histogram.max)
+
+    def test_overflow(self):
+        """Ensure that observations above the largest bucket are
+        reported as the maximum.
+        """
+
+        histogram = metrics.Histogram(buckets=(1,))
+
+        histogram.observe(10)
+
+        self.assertEqual(10, histogram.percentile(99))
+
+
+class TestInMemoryMetrics(unittest.TestCase):
+
+    def test_snapshot(self):
+        """Ensure that recorded events are aggregated in the snapshot."""
+
+        recorder = metrics.InMemoryMetrics()
+
+        recorder.record_request('publish', 0.01)
+        recorder.record_request('publish', 0.02, 503)
+        recorder.record_request('publish', 0.03, 503)
+        recorder.record_messages('publish', 10, 100)
+        recorder.record_messages('publish', 5, 50)
+        recorder.record_codec('encode', 0.001)
+
+        snapshot = recorder.snapshot()
+
+        self.assertEqual(3, snapshot['latency']['publish']['count'])
+        self.assertEqual({'publish': {503: 2}}, snapshot['errors'])
+        self.assertEqual({'publish': 15}, snapshot['messages'])
+        self.assertEqual({'publish': 150}, snapshot['bytes'])
+        self.assertEqual(1, snapshot['codec']['encode']['count'])
+        json.dumps(snapshot)
+
+    def test_reset(self):
+        """Ensure that reset forgets recorded events."""
+
+        recorder = metrics.InMemoryMetrics()
+        recorder.record_messages('pull', 1, 10)
+
+        recorder.reset()
+
+        self.assertEqual({}, recorder.snapshot()['messages'])
@@ -0,0 +1,359 @@
+import threading
+import time
+import unittest
+
+import mock
+
+from pubsub import client
+from pubsub import dedup
+from pubsub import emulator
+from pubsub import ordering
+
+
+def _message(key, seq):
+    return client.Message('foo', 'ack-%s-%d' % (key, seq), (key, seq),
+                          size=1)
+
+
+def _key(message):
+    return message.data[0]
+
+
+class TestOrderedSubscriber(unittest.TestCase):
+
+    def setUp(self):
+        self.mock_client = mock.Mock()
+        self.batches = []
+
+        def pull_many(subscription, max_messages, block, auto_ack):
+            if self.batches:
+                return self.batches.pop(0)
+            threading.Event().wait(0.01)
+            return []
+
+        self.mock_client.pull_many.side_effect = pull_many
+        # Mock's call counting isn't thread-safe, so the workers'
+        # acknowledgements are recorded in a list.
+        self.acked = []
+        self.mock_client.acknowledge.side_effect = \
+            lambda subscription, ack_ids: self.acked.extend(ack_ids)
+        self.subscribers = []
+
+    def tearDown(self):
+        for sub in self.subscribers:
+            sub.stop(5)
+
+    def _subscriber(self, handler, **kwargs):
+        sub = ordering.OrderedSubscriber(self.mock_client, 'foo', handler,
+                                         _key, **kwargs)
+        self.subscribers.append(sub)
+        sub.start()
+        return sub
+
+    def _wait_for(self, done):
+        for _ in range(500):
+            if done():
+                return
+            threading.Event().wait(0.01)
+
+    def test_order_per_key(self):
+        """Ensure that messages with the same key are handled one at a time
+        in order while different keys are handled in parallel.
+        """
+
+        self.batches = [[_message(key, seq) for seq in range(10)
+                         for key in 'abc']]
+        lock = threading.Lock()
+        active = {}
+        handled = {'a': [], 'b': [], 'c': []}
+        concurrency = []
+
+        def handler(message):
+            key, seq = message.data
+            with lock:
+                self.assertFalse(active.get(key))
+                active[key] = True
+                concurrency.append(sum(active.values()))
+            threading.Event().wait(0.005)
+            with lock:
+                active[key] = False
+                handled[key].append(seq)
+
+        sub = self._subscriber(handler, workers=3)
+        self._wait_for(lambda: sub.stats()['processed'] == 30)
+
+        self.assertEqual({'a': list(range(10)), 'b': list(range(10)),
+                          'c': list(range(10))}, handled)
+        self.assertGreater(max(concurrency), 1)
+        self.assertEqual(30, len(self.acked))
+        stats = sub.stats()
+        self.assertEqual(0, stats['outstanding_messages'])
+        self.assertEqual(0, stats['keys'])
+
+    def test_handler_error(self):
+        """Ensure that when a handler raises, the messages queued behind it
+        for the same key are left unacknowledged and the failed message is
+        nacked to come back straight away.
+        """
+
+        self.batches = [[_message('a', 0), _message('a', 1), _message('a', 2),
+                         _message('b', 0)]]
+        handled = []
+
+        def handler(message):
+            if message.data == ('a', 0):
+                raise Exception('error')
+            handled.append(message.data)
+
+        sub = self._subscriber(handler, workers=1)
+        self._wait_for(lambda: sub.stats()['failed'] == 1 and
+                       sub.stats()['processed'] == 1)
+
+        self.assertEqual([('b', 0)], handled)
+        self.mock_client.acknowledge.assert_called_once_with('foo',
+                                                             ['ack-b-0'])
+        self.mock_client.release.assert_any_call(
+            'foo', ['ack-a-0', 'ack-a-1', 'ack-a-2'])
+        self.mock_client.modify_ack_deadline.assert_called_once_with(
+            'foo', ['ack-a-0'], 0)
+        stats = sub.stats()
+        self.assertEqual(2, stats['deferred'])
+        self.assertEqual(0, stats['outstanding_messages'])
+
+    def test_unordered_messages(self):
+        """Ensure that messages without a key are handled in parallel."""
+
+        self.batches = [[_message(None, 0), _message(None, 1)]]
+        second = threading.Event()
+        overlapped = []
+
+        def handler(message):
+            if message.data[1] == 0:
+                overlapped.append(second.wait(5))
+            else:
+                second.set()
+
+        sub = self._subscriber(handler, workers=2)
+        self._wait_for(lambda: sub.stats()['processed'] == 2)
+
+        self.assertEqual([True], overlapped)
+
+    def test_overflow_block(self):
+        """Ensure that the puller waits while a key's queue is full and that
+        ordering is kept.
+        """
+
+        self.batches = [[_message('a', seq) for seq in range(3)] +
+                        [_message('b', 0)]]
+        release = threading.Event()
+        handled = []
+
+        def handler(message):
+            release.wait(5)
+            handled.append(message.data)
+
+        sub = self._subscriber(handler, workers=2, max_key_messages=2)
+        threading.Event().wait(0.05)
+
+        stats = sub.stats()
+        self.assertEqual(2, stats['outstanding_messages'])
+        self.assertEqual(2, stats['max_key_depth'])
+
+        release.set()
+        self._wait_for(lambda: sub.stats()['processed'] == 4)
+
+        self.assertEqual([('a', 0), ('a', 1), ('a', 2)],
+                         [data for data in handled if data[0] == 'a'])
+        self.assertEqual(0, sub.stats()['deferred'])
+
+    def test_overflow_defer(self):
+        """Ensure that messages for a full key are left for redelivery while
+        other keys keep being handled.
+        """
+
+        self.batches = [[_message('a', seq) for seq in range(3)] +
+                        [_message('b', 0)]]
+        release = threading.Event()
+        handled = []
+
+        def handler(message):
+            if message.data[0] == 'a':
+                release.wait(5)
+            handled.append(message.data)
+
+        sub = self._subscriber(handler, workers=2, max_key_messages=1,
+                               overflow=ordering.DEFER)
+        self._wait_for(lambda: ('b', 0) in handled)
+
+        self.assertEqual([('b', 0)], handled)
+        self.assertEqual(2, sub.stats()['deferred'])
+        self.mock_client.modify_ack_deadline.assert_called_once_with(
+            'foo', ['ack-a-1'], 0)
+
+        release.set()
+        self._wait_for(lambda: sub.stats()['processed'] == 2)
+
+        self.assertEqual([('b', 0), ('a', 0)], handled)
+
+    def _redeliver(self, steps):
+        # Each pull waits for a step's condition, then returns its batch of
+        # messages for key 'a'.
+        def pull_many(subscription, max_messages, block, auto_ack):
+            if not steps:
+                threading.Event().wait(0.01)
+                return []
+            ready, batch = steps.pop(0)
+            self._wait_for(ready)
+            return [client.Message('foo', 'ack-%d' % seq, ('a', seq),
+                                   str(seq), size=1) for seq in batch]
+
+        self.mock_client.pull_many.side_effect = pull_many
+
+    def test_defer_hold(self):
+        """Ensure that once messages are deferred, the key's later messages
+        wait for them to be redelivered, in order.
+        """
+
+        release = threading.Event()
+        handled = []
+
+        def handler(message):
+            release.wait(5)
+            handled.append(message.data[1])
+
+        self._redeliver([
+            (lambda: True, [0, 1, 2]),
+            (lambda: release.set() or handled == [0], [3]),
+            (lambda: True, [2, 1]),
+            (lambda: handled == [0, 1], [3, 2]),
+            (lambda: handled == [0, 1, 2], [3]),
+        ])
+        sub = self._subscriber(handler, max_key_messages=1,
+                               overflow=ordering.DEFER)
+        self._wait_for(lambda: len(handled) == 4)
+
+        self.assertEqual([0, 1, 2, 3], handled)
+        self.assertEqual(0, sub.stats()['held_keys'])
+
+    def test_handler_error_hold(self):
+        """Ensure that after a handler raises, the key's later messages wait
+        for the released messages to be redelivered, in order.
+        """
+
+        handled = []
+        failed = []
+
+        def handler(message):
+            if message.data[1] == 0 and not failed:
+                failed.append(0)
+                raise Exception('error')
+            handled.append(message.data[1])
+
+        self._redeliver([
+            (lambda: True, [0, 1]),
+            (lambda: failed, [2]),
+            (lambda: True, [1, 0]),
+            (lambda: handled == [0], [2, 1]),
+            (lambda: handled == [0, 1], [2]),
+        ])
+        sub = self._subscriber(handler, workers=1)
+        self._wait_for(lambda: len(handled) == 3)
+
+        self.assertEqual([0, 1, 2], handled)
+        self.assertEqual(0, sub.stats()['held_keys'])
+
+    def test_hold_expires(self):
+        """Ensure that a key isn't held longer than max_hold."""
+
+        release = threading.Event()
+        handled = []
+
+        def handler(message):
+            release.wait(5)
+            handled.append(message.data[1])
+
+        self._redeliver([
+            (lambda: True, [0, 1]),
+            (lambda: release.set() or handled == [0], []),
+            (lambda: threading.Event().wait(0.05) or True, [2]),
+        ])
+        sub = self._subscriber(handler, max_key_messages=1,
+                               overflow=ordering.DEFER, max_hold=0.01)
+        self._wait_for(lambda: len(handled) == 2)
+
+        self.assertEqual([0, 2], handled)
+        self.assertEqual(0, sub.stats()['held_keys'])
+
+    def test_deduplicate(self):
+        """Ensure that redelivered messages are acked and dropped without
+        reaching the handler.
+        """
+
+        self._redeliver([
+            (lambda: True, [0, 1]),
+            (lambda: len(handled) == 2, [1, 2]),
+        ])
+        handled = []
+        sub = self._subscriber(handled.append,
+                               deduplicator=dedup.Deduplicator())
+        self._wait_for(lambda: len(handled) == 3)
+
+        self.assertEqual([0, 1, 2], [m.data[1] for m in handled])
+        self.assertEqual(1, sub.stats()['duplicates'])
+        self.assertEqual(['ack-0', 'ack-1', 'ack-1', 'ack-2'],
+                         sorted(self.acked))
+
+    def test_stop_idle(self):
+        """Ensure that stop doesn't wait for a long-poll pull in flight."""
+
+        emulated = emulator.Emulator(pull_timeout=30)
+        pubsub_client = client.PubSubClient(emulated, 'project')
+        pubsub_client.create_topic('topic')
+        pubsub_client.subscribe('sub', 'topic')
+        sub = ordering.OrderedSubscriber(pubsub_client, 'sub', mock.Mock(),
+                                         _key)
+        sub.start()
+        self._wait_for(lambda: sub._engine.stats()['in_flight'])
+
+        start = time.time()
+        sub.stop(5)
+        elapsed = time.time() - start
+        # Wake the abandoned pull so its thread exits.
+        pubsub_client.publish('topic', b'data')
+        sub._engine.join(5)
+
+        self.assertLess(elapsed, 1)
+        self.assertEqual(0, sub.stats()['processed'])
+
+    def test_invalid_overflow(self):
+        """Ensure that an unknown overflow policy is rejected."""
+
+        self.assertRaises(ValueError, ordering.OrderedSubscriber,
+                          self.mock_client, 'foo', None, _key,
+                          overflow='drop')
+
+
+class TestConsume(unittest.TestCase):
+
+    @mock.patch('pubsub.ordering.OrderedSubscriber')
+    def test_consume_key(self, mock_subscriber):
+        """Ensure that consume starts an OrderedSubscriber when a key is
+        given.
+        """
+
+        pubsub_client = client.PubSubClient(mock.Mock(), 'project')
+
+        sub = pubsub_client.consume('foo', len, key=_key, workers=8)
+
+        self.assertEqual(mock_subscriber.return_value, sub)
+        mock_subscriber.assert_called_once_with(pubsub_client, 'foo', len,
+                                                _key, workers=8)
+        sub.start.assert_called_once_with()
+
+    def test_consume_key_with_processes(self):
+        """Ensure that ordering isn't combined with worker processes."""
+
+        pubsub_client = client.PubSubClient(mock.Mock(), 'project')
+
+        self.assertRaises(ValueError, pubsub_client.consume, 'foo', len,
+                          processes=2, key=_key)
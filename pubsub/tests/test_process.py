@@ -0,0 +1,212 @@
+import multiprocessing
+import os
+import time
+import unittest
+
+import mock
+
+from pubsub import client
+from pubsub import codec
+from pubsub import dedup
+from pubsub import emulator
+from pubsub import process
+
+
+def _handle(message):
+    if message.data == b'fail':
+        raise ValueError('failed')
+    if message.data == b'crash':
+        os._exit(1)
+
+
+def _handle_json(message):
+    if message.data != {'foo': 'bar'}:
+        raise ValueError('unexpected data %r' % (message.data,))
+
+
+class TestBatchFraming(unittest.TestCase):
+
+    def test_round_trip(self):
+        """Ensure that bytes-like and decoded values survive the trip to a
+        worker.
+        """
+
+        parent, child = multiprocessing.Pipe()
+        messages = [
+            client.Message('foo', 'ack-1', b'data', 'id-1', 4),
+            client.Message('foo', 'ack-2', memoryview(b'view'), 'id-2', 4),
+            client.Message('foo', 'ack-3', bytearray(b'array'), 'id-3', 5),
+            client.Message('foo', 'ack-4', {'foo': [1, 2]}, 'id-4', 9),
+        ]
+
+        process._send_batch(parent, 7, messages)
+        batch_id, received = process._recv_batch(child)
+
+        self.assertEqual(7, batch_id)
+        self.assertEqual([b'data', b'view', b'array', {'foo': [1, 2]}],
+                         [m.data for m in received])
+        self.assertEqual(['ack-1', 'ack-2', 'ack-3', 'ack-4'],
+                         [m.ack_id for m in received])
+        self.assertEqual([4, 4, 5, 9], [m.size for m in received])
+
+        parent.send_bytes(process._STOP)
+        self.assertIsNone(process._recv_batch(child))
+
+
+class TestProcessSubscriber(unittest.TestCase):
+
+    def setUp(self):
+        self.emulator = emulator.Emulator(pull_timeout=0.05)
+        self.client = client.PubSubClient(self.emulator, 'project')
+        self.client.create_topic('topic')
+        self.client.subscribe('sub', 'topic')
+        self.subscription = '/subscriptions/project/sub'
+
+    def _wait(self, subscriber, done):
+        deadline = time.time() + 10
+        while not done(subscriber.stats()) and time.time() < deadline:
+            time.sleep(0.01)
+        subscriber.stop(5)
+        subscriber._engine.join(5)
+
+    def test_handle_and_ack(self):
+        """Ensure that messages are handled by the workers and acknowledged
+        once handled.
+        """
+
+        self.client.publish_batch('topic', [b'data-%d' % i
+                                            for i in range(50)])
+        subscriber = process.ProcessSubscriber(self.client, 'sub', _handle,
+                                               processes=2,
+                                               worker_batch_size=10)
+        subscriber.start()
+
+        self._wait(subscriber, lambda stats: stats['processed'] == 50)
+
+        self.assertEqual({'outstanding_messages': 0, 'outstanding_bytes': 0,
+                          'processed': 50, 'failed': 0, 'duplicates': 0,
+                          'restarts': 0, 'pull_concurrency': 1},
+                         subscriber.stats())
+        self.assertEqual({'pending': 0, 'outstanding': 0},
+                         self.emulator.stats()[self.subscription])
+
+    def test_handler_error(self):
+        """Ensure that messages whose handler raises aren't acknowledged."""
+
+        self.client.publish_batch('topic', [b'ok', b'fail'])
+        subscriber = process.ProcessSubscriber(self.client, 'sub', _handle,
+                                               processes=1)
+        subscriber.start()
+
+        self._wait(subscriber, lambda stats: stats['failed'] >= 1)
+
+        self.assertEqual(1, subscriber.stats()['processed'])
+        self.assertEqual(1, self.emulator.stats()[self.subscription][
+            'outstanding'])
+
+    def test_decoded_values(self):
+        """Ensure that values decoded by a codec reach the handler."""
+
+        self.client.codec = codec.JsonCodec()
+        self.client.publish('topic', {'foo': 'bar'})
+        subscriber = process.ProcessSubscriber(self.client, 'sub',
+                                               _handle_json, processes=1)
+        subscriber.start()
+
+        self._wait(subscriber, lambda stats: stats['processed'] +
+                   stats['failed'] >= 1)
+
+        self.assertEqual(1, subscriber.stats()['processed'])
+
+    def test_worker_crash(self):
+        """Ensure that a worker which dies is replaced, the batch it was
+        handling is released and the batches it hadn't started are handled
+        by its replacement.
+        """
+
+        self.client.publish('topic', b'crash')
+        self.client.publish_batch('topic', [b'ok'] * 5)
+        subscriber = process.ProcessSubscriber(self.client, 'sub', _handle,
+                                               processes=1, batch_size=1)
+        subscriber.start()
+
+        self._wait(subscriber, lambda stats: stats['processed'] == 5)
+
+        stats = subscriber.stats()
+        self.assertEqual(5, stats['processed'])
+        self.assertEqual(1, stats['restarts'])
+        self.assertEqual(0, stats['outstanding_messages'])
+
+    def test_deduplicate(self):
+        """Ensure that duplicates are acknowledged without being sent to
+        the workers and that handled messages are remembered.
+        """
+
+        self.emulator.ack_deadline = 0.2
+        self.client.subscribe('dedup', 'topic')
+        self.client.publish_batch('topic', [b'same', b'same', b'other'])
+        deduplicator = dedup.Deduplicator(key=dedup.content_key)
+        subscriber = process.ProcessSubscriber(self.client, 'dedup', _handle,
+                                               processes=1,
+                                               deduplicator=deduplicator)
+        subscriber.start()
+
+        # The repeat in the first pull is released, and acknowledged as a
+        # duplicate when it is redelivered.
+        self._wait(subscriber, lambda stats: stats['processed'] == 2 and
+                   stats['duplicates'] == 2)
+
+        stats = subscriber.stats()
+        self.assertEqual(2, stats['processed'])
+        self.assertEqual(2, stats['duplicates'])
+        self.assertEqual({'pending': 0, 'outstanding': 0},
+                         self.emulator.stats()['/subscriptions/project/dedup'])
+        self.assertIn(dedup.content_key(client.Message('sub', None, b'same')),
+                      deduplicator)
+
+    def test_stop_idle(self):
+        """Ensure that stop doesn't wait for a long-poll pull in flight."""
+
+        self.emulator.pull_timeout = 30
+        subscriber = process.ProcessSubscriber(self.client, 'sub', _handle,
+                                               processes=1)
+        subscriber.start()
+        deadline = time.time() + 10
+        while not subscriber._engine.stats()['in_flight'] and \
+                time.time() < deadline:
+            time.sleep(0.01)
+
+        start = time.time()
+        subscriber.stop(5)
+        elapsed = time.time() - start
+        # Wake the abandoned pull so its thread exits.
+        self.client.publish('topic', b'ok')
+        subscriber._engine.join(5)
+
+        self.assertLess(elapsed, 2)
+        self.assertEqual(0, subscriber.stats()['processed'])
+
+    def test_invalid_processes(self):
+        """Ensure that at least one process is required."""
+
+        self.assertRaises(ValueError, process.ProcessSubscriber, self.client,
+                          'sub', _handle, processes=-1)
+
+
+class TestConsume(unittest.TestCase):
+
+    @mock.patch('pubsub.process.ProcessSubscriber')
+    def test_consume_processes(self, mock_subscriber):
+        """Ensure that consume starts a ProcessSubscriber when processes is
+        given.
+        """
+
+        pubsub_client = client.PubSubClient(mock.Mock(), 'project')
+
+        sub = pubsub_client.consume('foo', _handle, processes=4,
+                                    batch_size=10)
+
+        self.assertEqual(mock_subscriber.return_value, sub)
+        mock_subscriber.assert_called_once_with(
+            pubsub_client, 'foo', _handle, processes=4, batch_size=10)
+        sub.start.assert_called_once_with()
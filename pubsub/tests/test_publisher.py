@@ -0,0 +1,159 @@
+import threading
+import unittest
+
+import mock
+
+from pubsub import publisher
+
+
+class TestBatchPublisher(unittest.TestCase):
+
+    def setUp(self):
+        self.mock_client = mock.Mock()
+        self.mock_client._encode_message.side_effect = \
+            lambda message: {'data': message}
+        self.mock_client._publish_encoded.side_effect = \
+            lambda topic, messages: ['%s-%d' % (topic, i)
+                                     for i in range(len(messages))]
+
+    def test_flush_on_max_messages(self):
+        """Ensure that a batch is sent as soon as it reaches max_messages."""
+
+        sent = threading.Event()
+        self.mock_client._publish_encoded.side_effect = \
+            lambda topic, messages: sent.set() or ['1', '2']
+        pub = publisher.BatchPublisher(self.mock_client, max_messages=2,
+                                       max_latency=60)
+
+        first = pub.publish('foo', 'a')
+        second = pub.publish('foo', 'b')
+
+        self.assertTrue(sent.wait(5))
+        self.assertEqual('1', first.result(5))
+        self.assertEqual('2', second.result(5))
+        self.mock_client._publish_encoded.assert_called_once_with(
+            'foo', [{'data': 'a'}, {'data': 'b'}])
+        pub.close()
+
+    def test_flush_on_max_bytes(self):
+        """Ensure that a message which would overflow max_bytes starts a new
+        batch.
+        """
+
+        pub = publisher.BatchPublisher(self.mock_client, max_bytes=4,
+                                       max_latency=60)
+
+        pub.publish('foo', 'abc')
+        pub.publish('foo', 'def')
+        pub.flush()
+
+        self.assertEqual([mock.call('foo', [{'data': 'abc'}]),
+                          mock.call('foo', [{'data': 'def'}])],
+                         self.mock_client._publish_encoded.call_args_list)
+        pub.close()
+
+    def test_flush_on_max_latency(self):
+        """Ensure that a partial batch is sent once max_latency elapses."""
+
+        pub = publisher.BatchPublisher(self.mock_client, max_latency=0.01)
+
+        future = pub.publish('foo', 'a')
+
+        self.assertEqual('foo-0', future.result(5))
+        pub.close()
+
+    def test_batches_per_topic(self):
+        """Ensure that messages are batched separately per topic."""
+
+        pub = publisher.BatchPublisher(self.mock_client, max_latency=60)
+
+        pub.publish('foo', 'a')
+        pub.publish('bar', 'b')
+        pub.publish('foo', 'c')
+        pub.flush()
+
+        calls = self.mock_client._publish_encoded.call_args_list
+        self.assertEqual(2, len(calls))
+        self.assertIn(mock.call('foo', [{'data': 'a'}, {'data': 'c'}]), calls)
+        self.assertIn(mock.call('bar', [{'data': 'b'}]), calls)
+        pub.close()
+
+    def test_publish_error(self):
+        """Ensure that a failed batch sets the exception on every future."""
+
+        error = Exception('error')
+        self.mock_client._publish_encoded.side_effect = error
+        pub = publisher.BatchPublisher(self.mock_client, max_latency=60)
+
+        first = pub.publish('foo', 'a')
+        second = pub.publish('foo', 'b')
+        pub.flush()
+
+        self.assertIs(error, first.exception(5))
+        self.assertRaises(Exception, second.result, 5)
+        pub.close()
+
+    def test_close(self):
+        """Ensure that close sends buffered messages and rejects further
+        publishes.
+        """
+
+        pub = publisher.BatchPublisher(self.mock_client, max_latency=60)
+        future = pub.publish('foo', 'a')
+
+        pub.close()
+
+        self.assertTrue(future.done())
+        self.assertEqual('foo-0', future.result())
+        self.assertRaises(publisher.PublisherClosedError, pub.publish, 'foo',
+                          'b')
+
+    def test_failing_callback(self):
+        """Ensure that a done callback which raises doesn't stop later
+        batches from being sent.
+        """
+
+        def fail(future):
+            raise ValueError('callback failed')
+
+        pub = publisher.BatchPublisher(self.mock_client, max_latency=60)
+        pub.publish('foo', 'a').add_done_callback(fail)
+        pub.flush()
+        future = pub.publish('foo', 'b')
+        pub.flush()
+
+        self.assertEqual('foo-0', future.result(5))
+        pub.close()
+
+    def test_invalid_max_messages(self):
+        """Ensure that max_messages must be within the API limit."""
+
+        self.assertRaises(ValueError, publisher.BatchPublisher,
+                          self.mock_client, max_messages=0)
+        self.assertRaises(ValueError, publisher.BatchPublisher,
+                          self.mock_client, max_messages=1001)
+
+
+class TestPublishFuture(unittest.TestCase):
+
+    def test_done_callback(self):
+        """Ensure that done callbacks run when the future resolves, or
+        immediately if it already has.
+        """
+
+        future = publisher.PublishFuture()
+        calls = []
+        future.add_done_callback(calls.append)
+        self.assertEqual([], calls)
+
+        future.set_result('1')
+        future.add_done_callback(calls.append)
+
+        self.assertEqual([future, future], calls)
+
+    def test_result_timeout(self):
+        """Ensure that result raises if the timeout elapses."""
+
+        future = publisher.PublishFuture()
+
+        self.assertRaises(RuntimeError, future.result, 0.01)
@@ -0,0 +1,197 @@
+import threading
+import unittest
+
+import mock
+
+from pubsub import client
+from pubsub import emulator
+from pubsub import pulling
+from pubsub import subscriber
+
+
+def _messages(count):
+    return [client.Message('foo', 'ack', b'data', size=4)
+            for _ in range(count)]
+
+
+class TestPullEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.mock_client = mock.Mock()
+        self.cond = threading.Condition()
+        self.stopping = False
+        self.limit = 1000
+        self.delivered = []
+        self.backlog = 0
+        self.lock = threading.Lock()
+        self.active = 0
+        self.concurrency = []
+        self.requested = []
+
+        def pull_many(subscription, max_messages, block, auto_ack):
+            with self.lock:
+                self.active += 1
+                self.concurrency.append(self.active)
+                self.requested.append(max_messages)
+                count = min(max_messages, self.backlog)
+                self.backlog -= count
+            # Pulls take a round trip, and a pull of an idle subscription
+            # waits for the long-poll to time out.
+            threading.Event().wait(0.01 if count else 0.02)
+            with self.lock:
+                self.active -= 1
+            return _messages(count)
+
+        self.mock_client.pull_many.side_effect = pull_many
+        self.engine = None
+
+    def tearDown(self):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        if self.engine:
+            self.engine.join(5)
+
+    def _capacity(self):
+        if self.stopping:
+            return None
+        return self.limit - len(self.delivered)
+
+    def _deliver(self, messages):
+        with self.cond:
+            self.delivered.extend(messages)
+            self.cond.notify_all()
+
+    def _engine(self, **kwargs):
+        self.engine = pulling.PullEngine(self.mock_client, 'foo', self.cond,
+                                         self._capacity, self._deliver,
+                                         **kwargs)
+        self.engine.start()
+        return self.engine
+
+    def _wait_for(self, done):
+        for _ in range(500):
+            if done():
+                return
+            threading.Event().wait(0.01)
+
+    def test_scale_with_backlog(self):
+        """Ensure that concurrent pulls are added while pulls return full
+        batches and that an idle subscription gets a single long-poll.
+        """
+
+        self.backlog = 500
+        engine = self._engine(max_concurrency=4, batch_size=10)
+
+        self._wait_for(lambda: len(self.delivered) == 500)
+        self._wait_for(lambda: engine.stats()['empty_pulls'] >= 8)
+
+        self.assertEqual(500, len(self.delivered))
+        self.assertEqual(4, max(self.concurrency))
+        self.assertEqual(1, engine.stats()['concurrency'])
+        with self.lock:
+            idle = self.concurrency[-3:]
+        self.assertEqual([1, 1, 1], idle)
+
+    def test_single_pull(self):
+        """Ensure that one pull is in flight with max_concurrency of 1."""
+
+        self.backlog = 100
+        self._engine(batch_size=10)
+
+        self._wait_for(lambda: len(self.delivered) == 100)
+
+        self.assertEqual(1, max(self.concurrency))
+
+    def test_flow_control(self):
+        """Ensure that concurrent pulls never ask for more messages than the
+        owner has room for.
+        """
+
+        self.backlog = 500
+        self.limit = 25
+        self._engine(max_concurrency=4, batch_size=10)
+
+        self._wait_for(lambda: len(self.delivered) == 25)
+        threading.Event().wait(0.05)
+
+        self.assertEqual(25, len(self.delivered))
+        self.assertEqual(25, sum(self.requested))
+
+    def test_on_error(self):
+        """Ensure that failed pulls are reported to on_error."""
+
+        error = Exception('error')
+        self.mock_client.pull_many.side_effect = error
+        errors = []
+
+        def on_error(e):
+            with self.cond:
+                self.stopping = True
+                errors.append(e)
+
+        self._engine(on_error=on_error)
+        self._wait_for(lambda: errors)
+
+        self.assertEqual([error], errors)
+
+    def test_stop(self):
+        """Ensure that messages returned by a pull in flight when the
+        engine is stopped are released rather than delivered.
+        """
+
+        pulled = threading.Event()
+        release = threading.Event()
+
+        def pull_many(subscription, max_messages, block, auto_ack):
+            pulled.set()
+            release.wait(5)
+            return _messages(2)
+
+        self.mock_client.pull_many.side_effect = pull_many
+        engine = self._engine()
+        pulled.wait(5)
+
+        engine.stop()
+        release.set()
+        engine.join(5)
+
+        self.assertEqual([], self.delivered)
+        self.mock_client.release.assert_called_once_with('foo',
+                                                         ['ack', 'ack'])
+
+    def test_invalid_concurrency(self):
+        """Ensure that at least one pull is required."""
+
+        self.assertRaises(ValueError, pulling.PullEngine, self.mock_client,
+                          'foo', self.cond, self._capacity, self._deliver,
+                          max_concurrency=0)
+
+
+class TestConcurrentSubscriber(unittest.TestCase):
+
+    def test_concurrent_pulls(self):
+        """Ensure that a subscriber with concurrent pulls handles every
+        message once.
+        """
+
+        emulated = emulator.Emulator(pull_timeout=0.05)
+        pubsub_client = client.PubSubClient(emulated, 'project')
+        pubsub_client.create_topic('topic')
+        pubsub_client.subscribe('sub', 'topic')
+        pubsub_client.publish_batch('topic', [b'%d' % i for i in range(300)])
+        handled = []
+
+        sub = subscriber.Subscriber(pubsub_client, 'sub', handled.append,
+                                    max_outstanding_messages=100,
+                                    batch_size=10, max_concurrent_pulls=4)
+        sub.start()
+        for _ in range(500):
+            if len(handled) == 300:
+                break
+            threading.Event().wait(0.01)
+        sub.stop(5)
+
+        self.assertEqual(300, len(set(m.data for m in handled)))
+        self.assertEqual({'pending': 0, 'outstanding': 0},
+                         emulated.stats()['/subscriptions/project/sub'])
@@ -0,0 +1,168 @@
+import base64
+import io
+import json
+import threading
+import unittest
+
+import mock
+
+from pubsub import codec
+from pubsub import push
+
+
+def _body(data, labels=None, subscription='/subscriptions/project/foo'):
+    message = {'data': base64.b64encode(data).decode('ascii'),
+               'messageId': '123'}
+    if labels:
+        message['label'] = labels
+    return json.dumps({'subscription': subscription,
+                       'message': message}).encode('utf-8')
+
+
+def _environ(body=b'', method='POST', query=''):
+    return {
+        'REQUEST_METHOD': method,
+        'QUERY_STRING': query,
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': io.BytesIO(body),
+    }
+
+
+class TestDecodePush(unittest.TestCase):
+
+    def test_decode(self):
+        """Ensure that the push envelope is decoded into a Message."""
+
+        message = push.decode_push(_body(b'foo'))
+
+        self.assertEqual(b'foo', message.data)
+        self.assertEqual('123', message.message_id)
+        self.assertEqual('/subscriptions/project/foo', message.subscription)
+        self.assertIsNone(message.ack_id)
+
+    def test_decode_codec(self):
+        """Ensure that data is decoded with the codec in its labels."""
+
+        _, data = codec.JsonCodec().encode({'foo': 1})
+
+        message = push.decode_push(_body(data, codec.encode_labels('json')))
+
+        self.assertEqual({'foo': 1}, message.data)
+
+    def test_invalid(self):
+        """Ensure that bodies which aren't push envelopes are rejected."""
+
+        self.assertRaises(ValueError, push.decode_push, b'not json')
+        self.assertRaises(ValueError, push.decode_push, b'{}')
+        self.assertRaises(ValueError, push.decode_push, b'[]')
+
+
+class TestPushApp(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = mock.Mock()
+        self.start_response = mock.Mock()
+
+    def _call(self, app, environ):
+        app(environ, self.start_response)
+        return self.start_response.call_args[0][0]
+
+    def test_handle(self):
+        """Ensure that the handler is called and the message acknowledged."""
+
+        app = push.PushApp(self.handler)
+
+        self.assertEqual('204 No Content',
+                         self._call(app, _environ(_body(b'foo'))))
+        self.assertEqual(b'foo', self.handler.call_args[0][0].data)
+        self.assertEqual(1, app.stats()['processed'])
+
+    def test_handler_error(self):
+        """Ensure that a failing handler makes the message redelivered."""
+
+        self.handler.side_effect = ValueError('failed')
+        app = push.PushApp(self.handler)
+
+        self.assertEqual('500 Internal Server Error',
+                         self._call(app, _environ(_body(b'foo'))))
+        self.assertEqual(1, app.stats()['failed'])
+
+    def test_bad_requests(self):
+        """Ensure that invalid requests are rejected."""
+
+        app = push.PushApp(self.handler, token='secret')
+
+        self.assertEqual('405 Method Not Allowed',
+                         self._call(app, _environ(method='GET')))
+        self.assertEqual('403 Forbidden',
+                         self._call(app, _environ(_body(b'foo'),
+                                                  query='token=wrong')))
+        self.assertEqual('400 Bad Request',
+                         self._call(app, _environ(b'{}',
+                                                  query='token=secret')))
+        self.assertEqual('204 No Content',
+                         self._call(app, _environ(_body(b'foo'),
+                                                  query='token=secret')))
+        self.assertEqual(1, self.handler.call_count)
+
+    def test_limits(self):
+        """Ensure that oversized bodies are rejected with 413 and corrupt
+        compressed data with 400.
+        """
+
+        app = push.PushApp(self.handler, max_body_size=10)
+        environ = _environ(_body(b'foo'))
+        environ['wsgi.input'] = mock.Mock()
+
+        self.assertEqual('413 Payload Too Large', self._call(app, environ))
+        self.assertFalse(environ['wsgi.input'].read.called)
+
+        app.max_body_size = push.MAX_BODY_SIZE
+        self.assertEqual('400 Bad Request', self._call(app, _environ(
+            _body(b'garbage', codec.encode_labels('zlib')))))
+        self.assertFalse(self.handler.called)
+        self.assertEqual(0, app.stats()['active'])
+
+    def test_overloaded(self):
+        """Ensure that requests beyond max_concurrency are rejected with
+        429.
+        """
+
+        started = threading.Event()
+        release = threading.Event()
+
+        def handler(message):
+            started.set()
+            release.wait(5)
+
+        app = push.PushApp(handler, max_concurrency=1)
+        thread = threading.Thread(target=app, args=(_environ(_body(b'foo')),
+                                                    mock.Mock()))
+        thread.start()
+        started.wait(5)
+
+        with mock.patch('pubsub.push.decode_push') as mock_decode:
+            self.assertEqual('429 Too Many Requests',
+                             self._call(app, _environ(_body(b'bar'))))
+        self.assertFalse(mock_decode.called)
+        release.set()
+        thread.join(5)
+        self.assertEqual({'processed': 1, 'failed': 0, 'rejected': 1,
+                          'active': 0}, app.stats())
+
+
+class TestLimiter(unittest.TestCase):
+
+    def test_pending(self):
+        """Ensure that pending requests wait for a slot and time out."""
+
+        limiter = push.Limiter(max_concurrency=1, max_pending=1,
+                               pending_timeout=0.01)
+        self.assertTrue(limiter.acquire())
+
+        self.assertFalse(limiter.acquire())
+
+        threading.Timer(0.01, limiter.release).start()
+        limiter.pending_timeout = 5
+        self.assertTrue(limiter.acquire())
+        self.assertEqual(0, limiter.pending)
@@ -0,0 +1,130 @@
+import unittest
+
+from apiclient import errors
+import mock
+
+from pubsub import metrics
+from pubsub import ratelimit
+
+
+def _http_error(status):
+    return errors.HttpError(mock.Mock(status=status), b'error')
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_reject(self):
+        """Ensure that REJECT mode raises once the bucket is empty."""
+
+        limiter = ratelimit.AdaptiveRateLimiter(initial_rate=10, burst=2,
+                                                mode=ratelimit.REJECT)
+        limiter.acquire()
+        limiter.acquire()
+
+        self.assertRaises(ratelimit.RateLimitExceeded, limiter.acquire)
+        self.assertEqual(1, limiter.stats()['rejected'])
+
+    def test_block(self):
+        """Ensure that BLOCK mode waits for tokens to be refilled."""
+
+        limiter = ratelimit.AdaptiveRateLimiter(initial_rate=100, burst=10)
+        limiter.acquire(10)
+
+        start = metrics.clock()
+        limiter.acquire(5)
+
+        self.assertGreaterEqual(metrics.clock() - start, 0.04)
+        self.assertEqual(0, limiter.stats()['waiting'])
+
+    def test_block_timeout(self):
+        """Ensure that waiting for tokens gives up after the timeout."""
+
+        limiter = ratelimit.AdaptiveRateLimiter(initial_rate=10, min_rate=1,
+                                                burst=1, timeout=0.01)
+        limiter.acquire()
+
+        self.assertRaises(ratelimit.RateLimitExceeded, limiter.acquire)
+        self.assertEqual(1, limiter.stats()['rejected'])
+
+    def test_large_batch(self):
+        """Ensure that a batch larger than the bucket takes a full bucket
+        and leaves it in debt.
+        """
+
+        limiter = ratelimit.AdaptiveRateLimiter(initial_rate=10, burst=10,
+                                                mode=ratelimit.REJECT)
+        limiter.acquire(25)
+
+        self.assertLess(limiter.stats()['tokens'], -14)
+        self.assertRaises(ratelimit.RateLimitExceeded, limiter.acquire)
+
+
+@mock.patch('pubsub.ratelimit.clock')
+class TestAdaptation(unittest.TestCase):
+
+    def _limiter(self, mock_clock, **kwargs):
+        mock_clock.return_value = 100
+        return ratelimit.AdaptiveRateLimiter(initial_rate=100, min_rate=10,
+                                             max_rate=120, increase=10,
+                                             **kwargs)
+
+    def test_additive_increase(self, mock_clock):
+        """Ensure that the rate grows linearly with time while publishes
+        succeed, up to max_rate.
+        """
+
+        limiter = self._limiter(mock_clock)
+
+        mock_clock.return_value = 101
+        limiter.record(0.1)
+        self.assertEqual(110, limiter.rate)
+
+        mock_clock.return_value = 101.5
+        limiter.record(0.1)
+        self.assertEqual(115, limiter.rate)
+
+        mock_clock.return_value = 110
+        limiter.record(0.1)
+        self.assertEqual(120, limiter.rate)
+
+    def test_multiplicative_decrease(self, mock_clock):
+        """Ensure that throttling halves the rate at most once per
+        cooldown, down to min_rate.
+        """
+
+        limiter = self._limiter(mock_clock, cooldown=1)
+
+        limiter.record(0.1, throttled=True)
+        limiter.record(0.1, throttled=True)
+        self.assertEqual(50, limiter.rate)
+
+        for now in (101, 102, 103):
+            mock_clock.return_value = now
+            limiter.record(0.1, throttled=True)
+
+        stats = limiter.stats()
+        self.assertEqual(10, stats['rate'])
+        self.assertEqual(5, stats['throttled'])
+        self.assertEqual(4, stats['decreases'])
+
+    def test_latency(self, mock_clock):
+        """Ensure that publishes slower than target_latency decrease the
+        rate.
+        """
+
+        limiter = self._limiter(mock_clock, target_latency=0.5)
+
+        limiter.record(0.6)
+
+        self.assertEqual(50, limiter.rate)
+
+    def test_call(self, mock_clock):
+        """Ensure that call records a 429 as throttling and re-raises it."""
+
+        limiter = self._limiter(mock_clock)
+        fn = mock.Mock(side_effect=_http_error(429))
+
+        self.assertRaises(errors.HttpError, limiter.call, 1, fn)
+
+        self.assertEqual(1, limiter.stats()['throttled'])
+        self.assertEqual(50, limiter.rate)
@@ -0,0 +1,182 @@
+import socket
+import unittest
+
+from apiclient import errors
+import mock
+
+from pubsub import retry
+
+
+def _http_error(status):
+    return errors.HttpError(mock.Mock(status=status), b'error')
+
+
+class TestRetryPolicy(unittest.TestCase):
+
+    def test_is_retryable(self):
+        """Ensure that transient HTTP and socket errors are retryable and
+        other errors aren't.
+        """
+
+        policy = retry.RetryPolicy()
+
+        self.assertTrue(policy.is_retryable(_http_error(429)))
+        self.assertTrue(policy.is_retryable(_http_error(503)))
+        self.assertTrue(policy.is_retryable(socket.error('reset')))
+        self.assertFalse(policy.is_retryable(_http_error(404)))
+        self.assertFalse(policy.is_retryable(ValueError('bad')))
+
+    @mock.patch('pubsub.retry.random')
+    def test_backoff(self, mock_random):
+        """Ensure that the backoff bound grows exponentially up to
+        max_backoff and is jittered.
+        """
+
+        mock_random.uniform.side_effect = lambda low, high: high
+        policy = retry.RetryPolicy(initial_backoff=1, max_backoff=5,
+                                   multiplier=2)
+
+        self.assertEqual([1, 2, 4, 5], [policy.backoff(i) for i in range(4)])
+        mock_random.uniform.assert_called_with(0, 5)
+
+
+class TestRetryBudget(unittest.TestCase):
+
+    def test_budget(self):
+        """Ensure that withdrawals are limited by the deposited tokens."""
+
+        budget = retry.RetryBudget(ratio=0.5, max_tokens=1)
+
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+
+        budget.deposit()
+        self.assertFalse(budget.withdraw())
+        budget.deposit()
+        budget.deposit()
+        self.assertEqual(1, budget.tokens)
+        self.assertTrue(budget.withdraw())
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    @mock.patch('pubsub.retry.time')
+    def test_open_and_reset(self, mock_time):
+        """Ensure that the circuit opens after consecutive failures, lets a
+        single trial through after the reset timeout and closes if it
+        succeeds.
+        """
+
+        mock_time.time.return_value = 100
+        breaker = retry.CircuitBreaker(failure_threshold=2, reset_timeout=10)
+
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.OPEN, breaker.state)
+        self.assertFalse(breaker.allow())
+
+        mock_time.time.return_value = 110
+        self.assertEqual(breaker.HALF_OPEN, breaker.state)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+
+        breaker.record_success()
+        self.assertEqual(breaker.CLOSED, breaker.state)
+        self.assertTrue(breaker.allow())
+
+    @mock.patch('pubsub.retry.time')
+    def test_trial_failure(self, mock_time):
+        """Ensure that a failed trial reopens the circuit."""
+
+        mock_time.time.return_value = 100
+        breaker = retry.CircuitBreaker(failure_threshold=1, reset_timeout=10)
+        breaker.record_failure()
+        mock_time.time.return_value = 110
+        breaker.allow()
+
+        breaker.record_failure()
+
+        self.assertFalse(breaker.allow())
+
+
+class TestRetrier(unittest.TestCase):
+
+    def setUp(self):
+        self.mock_sleep = mock.Mock()
+        self.policy = retry.RetryPolicy(max_attempts=3)
+
+    def test_success(self):
+        """Ensure that the result is returned without retrying."""
+
+        retrier = retry.Retrier(self.policy, sleep=self.mock_sleep)
+
+        self.assertEqual('ok', retrier.call('publish', lambda: 'ok'))
+        self.assertFalse(self.mock_sleep.called)
+
+    def test_retry_transient(self):
+        """Ensure that transient errors are retried with backoff."""
+
+        fn = mock.Mock(side_effect=[_http_error(503), socket.error(), 'ok'])
+        retrier = retry.Retrier(self.policy, sleep=self.mock_sleep)
+
+        self.assertEqual('ok', retrier.call('publish', fn))
+        self.assertEqual(3, fn.call_count)
+        self.assertEqual(2, self.mock_sleep.call_count)
+
+    def test_max_attempts(self):
+        """Ensure that the last error is raised once max_attempts is
+        reached.
+        """
+
+        fn = mock.Mock(side_effect=_http_error(503))
+        retrier = retry.Retrier(self.policy, sleep=self.mock_sleep)
+
+        self.assertRaises(errors.HttpError, retrier.call, 'publish', fn)
+        self.assertEqual(3, fn.call_count)
+
+    def test_non_retryable(self):
+        """Ensure that non-retryable errors are raised immediately."""
+
+        fn = mock.Mock(side_effect=_http_error(404))
+        retrier = retry.Retrier(self.policy, sleep=self.mock_sleep)
+
+        self.assertRaises(errors.HttpError, retrier.call, 'publish', fn)
+        self.assertEqual(1, fn.call_count)
+
+    def test_per_operation_policy(self):
+        """Ensure that operations can have their own policy."""
+
+        fn = mock.Mock(side_effect=_http_error(503))
+        retrier = retry.Retrier(
+            self.policy, policies={'pull': retry.RetryPolicy(max_attempts=1)},
+            sleep=self.mock_sleep)
+
+        self.assertRaises(errors.HttpError, retrier.call, 'pull', fn)
+        self.assertEqual(1, fn.call_count)
+
+    def test_budget_exhausted(self):
+        """Ensure that no retries are made once the budget is spent."""
+
+        fn = mock.Mock(side_effect=_http_error(503))
+        retrier = retry.Retrier(self.policy,
+                                budget=retry.RetryBudget(ratio=0,
+                                                         max_tokens=1),
+                                sleep=self.mock_sleep)
+
+        self.assertRaises(errors.HttpError, retrier.call, 'publish', fn)
+        self.assertEqual(2, fn.call_count)
+
+    def test_circuit_open(self):
+        """Ensure that requests fail fast while the circuit is open."""
+
+        fn = mock.Mock(side_effect=_http_error(503))
+        retrier = retry.Retrier(self.policy,
+                                breaker=retry.CircuitBreaker(
+                                    failure_threshold=2),
+                                sleep=self.mock_sleep)
+
+        self.assertRaises(retry.CircuitOpenError, retrier.call, 'publish', fn)
+        self.assertEqual(2, fn.call_count)
+        self.assertRaises(retry.CircuitOpenError, retrier.call, 'publish', fn)
+        self.assertEqual(2, fn.call_count)
@@ -0,0 +1,333 @@
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+from apiclient import errors
+import mock
+
+from pubsub import client
+from pubsub import ratelimit
+from pubsub import retry
+from pubsub import spool
+
+
+def _message(i):
+    return {'data': 'data-%d' % i}
+
+
+class SpoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.mock_client = mock.Mock()
+        self.published = []
+        self.mock_client._send_encoded.side_effect = \
+            lambda topic, messages: self.published.append(
+                (topic, [m['data'] for m in messages]))
+        self.spools = []
+
+    def tearDown(self):
+        for s in self.spools:
+            s.close(5)
+        shutil.rmtree(self.directory)
+
+    def _spool(self, **kwargs):
+        kwargs.setdefault('initial_backoff', 0.01)
+        s = spool.Spool(self.mock_client, self.directory, **kwargs)
+        self.spools.append(s)
+        return s
+
+    def _segments(self):
+        return sorted(name for name in os.listdir(self.directory)
+                      if name.startswith('segment-'))
+
+
+class TestSpool(SpoolTestCase):
+
+    def test_drain_batches(self):
+        """Ensure that consecutive messages for a topic are published
+        together, in order.
+        """
+
+        blocked = threading.Event()
+        self.mock_client._send_encoded.side_effect = \
+            lambda topic, messages: (
+                blocked.wait(5),
+                self.published.append((topic, [m['data'] for m in messages])))
+        s = self._spool(batch_size=2)
+
+        for i, topic in enumerate(['foo', 'foo', 'foo', 'bar', 'foo']):
+            s.append(topic, _message(i))
+        blocked.set()
+
+        self.assertTrue(s.flush(5))
+        self.assertEqual(['data-%d' % i for i in range(5)],
+                         [d for _, batch in self.published for d in batch])
+        # The first batch may have been taken before the rest of the
+        # messages were appended, but batches never mix topics.
+        self.assertEqual(['foo', 'bar', 'foo'],
+                         [topic for topic, _ in self.published][-3:])
+        self.assertTrue(all(len(batch) <= 2 for _, batch in self.published))
+        self.assertEqual(5, s.stats()['drained'])
+
+    def test_retry_outage(self):
+        """Ensure that batches are retried while publishing fails with
+        anything but a rejection by the backend.
+        """
+
+        failures = [socket.error('down'),
+                    errors.HttpError(mock.Mock(status=503), b''),
+                    errors.HttpError(mock.Mock(status=429), b''),
+                    retry.CircuitOpenError('open'),
+                    ratelimit.RateLimitExceeded('limited'),
+                    ValueError('unexpected')]
+
+        def publish(topic, messages):
+            if failures:
+                raise failures.pop(0)
+            self.published.append((topic, [m['data'] for m in messages]))
+
+        self.mock_client._send_encoded.side_effect = publish
+        s = self._spool()
+
+        s.append('foo', _message(0))
+
+        self.assertTrue(s.flush(5))
+        self.assertEqual([('foo', ['data-0'])], self.published)
+        self.assertEqual(6, s.stats()['failures'])
+
+    def test_drop_rejected(self):
+        """Ensure that batches the backend rejects are dropped."""
+
+        self.mock_client._send_encoded.side_effect = errors.HttpError(
+            mock.Mock(status=404), b'')
+        s = self._spool()
+
+        s.append('foo', _message(0))
+
+        self.assertTrue(s.flush(5))
+        self.assertEqual(1, s.stats()['dropped'])
+
+    def test_batch_bytes(self):
+        """Ensure that batches are capped at batch_bytes and that a larger
+        message is published on its own.
+        """
+
+        blocked = threading.Event()
+        self.mock_client._send_encoded.side_effect = \
+            lambda topic, messages: (
+                blocked.wait(5),
+                self.published.append((topic, [m['data'] for m in messages])))
+        s = self._spool(batch_bytes=14)
+
+        s.append('foo', {'data': 'first'})
+        for i in range(4):
+            s.append('foo', _message(i))
+        s.append('foo', {'data': 'x' * 20})
+        blocked.set()
+
+        self.assertTrue(s.flush(5))
+        batches = [batch for _, batch in self.published]
+        self.assertEqual(['data-0', 'data-1', 'data-2', 'data-3', 'x' * 20],
+                         [d for batch in batches for d in batch][-5:])
+        self.assertEqual(['x' * 20], batches[-1])
+        self.assertTrue(all(sum(len(d) for d in batch) <= 14
+                            for batch in batches[:-1]))
+        self.assertTrue(any(len(batch) == 2 for batch in batches))
+
+    def test_split_rejected(self):
+        """Ensure that a rejected batch is split and published in halves,
+        and only the messages rejected on their own are dropped.
+        """
+
+        blocked = threading.Event()
+
+        def publish(topic, messages):
+            blocked.wait(5)
+            data = [m['data'] for m in messages]
+            if len(data) > 2:
+                raise errors.HttpError(mock.Mock(status=413), b'')
+            if 'bad' in data:
+                raise errors.HttpError(mock.Mock(status=400), b'')
+            self.published.append((topic, data))
+
+        self.mock_client._send_encoded.side_effect = publish
+        s = self._spool()
+
+        s.append('foo', {'data': 'first'})
+        for i in range(6):
+            s.append('foo', {'data': 'bad'} if i == 2 else _message(i))
+        blocked.set()
+
+        self.assertTrue(s.flush(5))
+        self.assertEqual(['first', 'data-0', 'data-1', 'data-3', 'data-4',
+                          'data-5'],
+                         [d for _, batch in self.published for d in batch])
+        self.assertEqual(1, s.stats()['dropped'])
+        self.assertEqual(6, s.stats()['drained'])
+
+    def test_checkpoint_error(self):
+        """Ensure that the drainer keeps publishing when the checkpoint
+        can't be written.
+        """
+
+        s = self._spool()
+
+        with mock.patch('pubsub.spool.tempfile.mkstemp',
+                        side_effect=OSError(28, 'No space left on device')):
+            s.append('foo', _message(0))
+            self.assertTrue(s.flush(5))
+            s.append('foo', _message(1))
+            self.assertTrue(s.flush(5))
+
+        self.assertEqual([('foo', ['data-0']), ('foo', ['data-1'])],
+                         self.published)
+        self.assertEqual(['segment-%020d.log' % 0],
+                         os.listdir(self.directory))
+
+    def test_remove_error(self):
+        """Ensure that the drainer moves on to the next segment when a
+        drained segment can't be removed.
+        """
+
+        blocked = threading.Event()
+        self.mock_client._send_encoded.side_effect = \
+            lambda topic, messages: blocked.wait(5)
+        s = self._spool(segment_size=64, max_bytes=64 * 10)
+
+        for i in range(3):
+            s.append('foo', _message(i))
+        with mock.patch('pubsub.spool.os.remove',
+                        side_effect=OSError(30, 'Read-only file system')):
+            blocked.set()
+            self.assertTrue(s.flush(5))
+
+        self.assertEqual(3, s.stats()['drained'])
+        self.assertEqual(1, s.stats()['segments'])
+
+    def test_rotate_segments(self):
+        """Ensure that the log rotates into new segments and drained
+        segments are deleted.
+        """
+
+        blocked = threading.Event()
+        self.mock_client._send_encoded.side_effect = \
+            lambda topic, messages: blocked.wait(5)
+        s = self._spool(segment_size=64, max_bytes=64 * 10)
+
+        for i in range(6):
+            s.append('foo', _message(i))
+        self.assertTrue(len(self._segments()) > 1)
+
+        blocked.set()
+        self.assertTrue(s.flush(5))
+        self.assertEqual(1, len(self._segments()))
+        self.assertEqual(6, s.stats()['drained'])
+
+    def test_full(self):
+        """Ensure that appending beyond max_bytes raises SpoolFullError."""
+
+        self.mock_client._send_encoded.side_effect = socket.error('down')
+        s = self._spool(segment_size=64, max_bytes=128)
+
+        # Each segment holds a single message.
+        s.append('foo', _message(0))
+        s.append('foo', _message(1))
+
+        self.assertRaises(spool.SpoolFullError, s.append, 'foo',
+                          _message(2))
+
+    def test_too_large(self):
+        """Ensure that messages larger than a segment are rejected."""
+
+        s = self._spool(segment_size=64, max_bytes=128)
+
+        self.assertRaises(ValueError, s.append, 'foo', {'data': 'x' * 64})
+
+    def test_recover(self):
+        """Ensure that undrained messages are published by the next spool
+        opened on the directory and a torn record is ignored.
+        """
+
+        self.mock_client._send_encoded.side_effect = socket.error('down')
+        s = self._spool(segment_size=1024)
+        for i in range(3):
+            s.append('foo', _message(i))
+        s.close(5)
+        # Simulate a crash in the middle of writing a record.
+        path = os.path.join(self.directory, self._segments()[-1])
+        with open(path, 'r+b') as f:
+            data = f.read()
+            f.seek(data.index(b'data-2') + len(b'data-2"}]'))
+            f.write(b'\x10\x00\x00\x00\x00\x00\x00\x00{"torn')
+
+        self.mock_client._send_encoded.side_effect = \
+            lambda topic, messages: self.published.append(
+                (topic, [m['data'] for m in messages]))
+        s = self._spool(segment_size=1024)
+        s.append('foo', _message(3))
+
+        self.assertTrue(s.flush(5))
+        self.assertEqual(['data-0', 'data-1', 'data-2', 'data-3'],
+                         [d for _, batch in self.published for d in batch])
+
+    def test_checkpoint(self):
+        """Ensure that drained messages aren't published again by the next
+        spool.
+        """
+
+        s = self._spool()
+        s.append('foo', _message(0))
+        self.assertTrue(s.flush(5))
+        s.close(5)
+
+        s = self._spool()
+        s.append('foo', _message(1))
+
+        self.assertTrue(s.flush(5))
+        self.assertEqual([('foo', ['data-0']), ('foo', ['data-1'])],
+                         self.published)
+
+
+class TestClientSpool(SpoolTestCase):
+
+    def test_publish_spooled(self):
+        """Ensure that publishes go through the spool once it is started."""
+
+        mock_pubsub = mock.Mock()
+        pubsub_client = client.PubSubClient(mock_pubsub, 'project')
+        pubsub_client.start_spool(self.directory, initial_backoff=0.01)
+
+        pubsub_client.publish('foo', b'bar')
+        self.assertEqual([], pubsub_client.publish_batch('foo', [b'baz']))
+
+        self.assertTrue(pubsub_client.spool.flush(5))
+        self.assertFalse(mock_pubsub.topics.return_value.publish.called)
+        body = mock_pubsub.topics.return_value.publishBatch.call_args_list[
+            -1][1]['body']
+        self.assertEqual('/topics/project/foo', body['topic'])
+        pubsub_client.close()
+        self.assertIsNone(pubsub_client.spool)
+
+    def test_batch_publisher_spooled(self):
+        """Ensure that batch publishers publish through the spool."""
+
+        mock_pubsub = mock.Mock()
+        pubsub_client = client.PubSubClient(mock_pubsub, 'project')
+        pubsub_client.start_spool(self.directory, initial_backoff=0.01)
+        mock_publish = mock_pubsub.topics.return_value.publishBatch
+        mock_publish.return_value.execute.side_effect = [
+            errors.HttpError(mock.Mock(status=503), b''),
+            {'messageIds': ['1']}]
+        pub = pubsub_client.batch_publisher(max_latency=0.01)
+
+        future = pub.publish('foo', b'bar')
+
+        self.assertIsNone(future.result(5))
+        self.assertTrue(pubsub_client.spool.flush(5))
+        self.assertEqual(2, mock_publish.call_count)
+        pub.close()
+        pubsub_client.close()
@@ -0,0 +1,301 @@
+import threading
+import time
+import unittest
+
+import mock
+
+from pubsub import client
+from pubsub import dedup
+from pubsub import emulator
+from pubsub import subscriber
+
+
+def _messages(count, start=0):
+    return [client.Message('foo', 'ack-%d' % i, 'data-%d' % i, size=6)
+            for i in range(start, start + count)]
+
+
+class TestMessageStream(unittest.TestCase):
+
+    def setUp(self):
+        self.mock_client = mock.Mock()
+        self.pulled = threading.Event()
+        self.batches = [_messages(2), _messages(1, 2)]
+
+        def pull_many(subscription, max_messages, block, auto_ack):
+            if self.batches:
+                self.pulled.set()
+                return self.batches.pop(0)
+            threading.Event().wait(0.01)
+            return []
+
+        self.mock_client.pull_many.side_effect = pull_many
+        self.streams = []
+
+    def tearDown(self):
+        for stream in self.streams:
+            stream.close()
+            stream._engine.join(5)
+
+    def _stream(self, **kwargs):
+        stream = subscriber.MessageStream(self.mock_client, 'foo', **kwargs)
+        self.streams.append(stream)
+        return stream
+
+    def test_iterate(self):
+        """Ensure that the stream yields prefetched messages in order and
+        acks each one as it is handed out.
+        """
+
+        stream = self._stream()
+
+        messages = [stream.get(5) for _ in range(3)]
+        stream.close()
+
+        self.assertEqual(['data-0', 'data-1', 'data-2'],
+                         [m.data for m in messages])
+        self.assertEqual([mock.call('foo', ['ack-0']),
+                          mock.call('foo', ['ack-1']),
+                          mock.call('foo', ['ack-2'])],
+                         self.mock_client.acknowledge.call_args_list)
+        self.mock_client.pull_many.assert_any_call(
+            'foo', max_messages=100, block=True, auto_ack=False)
+
+    def test_no_auto_ack(self):
+        """Ensure that messages aren't acked when auto_ack is False."""
+
+        stream = self._stream(auto_ack=False)
+
+        self.assertEqual('data-0', stream.get(5).data)
+        stream.close()
+
+        self.assertFalse(self.mock_client.acknowledge.called)
+
+    def test_buffer_limit(self):
+        """Ensure that the puller never requests more messages than there is
+        room for in the buffer.
+        """
+
+        self.batches = [_messages(2)]
+        stream = self._stream(buffer_size=2)
+        self.assertTrue(self.pulled.wait(5))
+        threading.Event().wait(0.05)
+
+        self.assertEqual(2, stream.buffered())
+        self.assertEqual(1, self.mock_client.pull_many.call_count)
+
+        stream.get(5)
+        stream.close()
+
+        for call in self.mock_client.pull_many.call_args_list:
+            self.assertTrue(call[1]['max_messages'] <= 2)
+
+    def test_pull_error(self):
+        """Ensure that an error raised by the puller is raised to the
+        consumer.
+        """
+
+        error = Exception('error')
+        self.mock_client.pull_many.side_effect = error
+        stream = self._stream()
+
+        self.assertRaises(Exception, stream.get, 5)
+        stream.close()
+
+    def test_get_timeout(self):
+        """Ensure that get returns None if no message arrives in time."""
+
+        self.batches = []
+        stream = self._stream()
+
+        self.assertIsNone(stream.get(0.01))
+        stream.close()
+
+    def test_iterator_ends_on_close(self):
+        """Ensure that iteration stops once the stream is closed."""
+
+        stream = self._stream()
+        received = []
+        for message in stream:
+            received.append(message)
+            if len(received) == 3:
+                stream.close()
+
+        self.assertEqual(3, len(received))
+
+
+class TestSubscriber(unittest.TestCase):
+
+    def setUp(self):
+        self.mock_client = mock.Mock()
+        self.batches = [_messages(3)]
+        self.max_messages = []
+
+        def pull_many(subscription, max_messages, block, auto_ack):
+            self.max_messages.append(max_messages)
+            if self.batches:
+                return self.batches.pop(0)
+            threading.Event().wait(0.01)
+            return []
+
+        self.mock_client.pull_many.side_effect = pull_many
+        # Mock's call counting isn't thread-safe, so the workers'
+        # acknowledgements are recorded in a list.
+        self.acked = []
+        self.mock_client.acknowledge.side_effect = \
+            lambda subscription, ack_ids: self.acked.extend(ack_ids)
+
+    def _wait_for(self, sub, processed, failed=0):
+        for _ in range(500):
+            stats = sub.stats()
+            if stats['processed'] + stats['failed'] >= processed + failed:
+                return
+            threading.Event().wait(0.01)
+
+    def test_handle_and_ack(self):
+        """Ensure that every message is passed to the handler and acked once
+        the handler returns.
+        """
+
+        handled = []
+        sub = subscriber.Subscriber(self.mock_client, 'foo', handled.append,
+                                    workers=2)
+        sub.start()
+        self._wait_for(sub, 3)
+        sub.stop(5)
+
+        self.assertEqual(['data-0', 'data-1', 'data-2'],
+                         sorted(m.data for m in handled))
+        self.assertEqual(3, len(self.acked))
+        self.assertEqual({'outstanding_messages': 0, 'outstanding_bytes': 0,
+                          'processed': 3, 'failed': 0, 'duplicates': 0,
+                          'pull_concurrency': 1}, sub.stats())
+
+    def test_handler_error(self):
+        """Ensure that a message isn't acked if the handler raises."""
+
+        def handler(message):
+            raise Exception('error')
+
+        sub = subscriber.Subscriber(self.mock_client, 'foo', handler)
+        sub.start()
+        self._wait_for(sub, 0, 3)
+        sub.stop(5)
+
+        self.assertFalse(self.mock_client.acknowledge.called)
+        self.assertEqual(3, sub.stats()['failed'])
+        self.mock_client.release.assert_any_call('foo', ['ack-0'])
+
+    def test_max_outstanding_messages(self):
+        """Ensure that no more than max_outstanding_messages are pulled while
+        the handlers are busy.
+        """
+
+        self.batches = [_messages(2), _messages(2, 2)]
+        release = threading.Event()
+        sub = subscriber.Subscriber(self.mock_client, 'foo',
+                                    lambda message: release.wait(5),
+                                    max_outstanding_messages=2)
+        sub.start()
+        threading.Event().wait(0.05)
+
+        self.assertEqual([2], self.max_messages)
+        self.assertEqual(2, sub.stats()['outstanding_messages'])
+
+        release.set()
+        self._wait_for(sub, 4)
+        sub.stop(5)
+
+        self.assertTrue(all(count <= 2 for count in self.max_messages))
+
+    def test_max_outstanding_bytes(self):
+        """Ensure that pulling pauses once max_outstanding_bytes is
+        reached.
+        """
+
+        release = threading.Event()
+        sub = subscriber.Subscriber(self.mock_client, 'foo',
+                                    lambda message: release.wait(5),
+                                    max_outstanding_bytes=6)
+        sub.start()
+        threading.Event().wait(0.05)
+
+        self.assertEqual(1, len(self.max_messages))
+        self.assertEqual(18, sub.stats()['outstanding_bytes'])
+
+        release.set()
+        self._wait_for(sub, 3)
+        sub.stop(5)
+
+    def test_stop_drains(self):
+        """Ensure that stop waits for pulled messages to be handled."""
+
+        handled = []
+
+        def handler(message):
+            threading.Event().wait(0.01)
+            handled.append(message)
+
+        sub = subscriber.Subscriber(self.mock_client, 'foo', handler,
+                                    workers=1)
+        sub.start()
+        for _ in range(500):
+            if not self.batches:
+                break
+            threading.Event().wait(0.01)
+        sub.stop(5)
+
+        self.assertEqual(3, len(handled))
+
+    def test_deduplicate(self):
+        """Ensure that redelivered messages are acked and dropped without
+        reaching the handler.
+        """
+
+        first = _messages(2)
+        redelivered = [client.Message('foo', 'ack-%d' % i, 'data-0',
+                                      'id-0', 6) for i in (2, 3)]
+        first[0] = client.Message('foo', 'ack-0', 'data-0', 'id-0', 6)
+        self.batches = [first, redelivered]
+        handled = []
+        sub = subscriber.Subscriber(self.mock_client, 'foo', handled.append,
+                                    workers=1, max_outstanding_messages=2,
+                                    deduplicator=dedup.Deduplicator())
+        sub.start()
+        for _ in range(500):
+            if sub.stats()['duplicates'] == 2:
+                break
+            threading.Event().wait(0.01)
+        sub.stop(5)
+
+        self.assertEqual(['ack-0', 'ack-1'], [m.ack_id for m in handled])
+        self.assertEqual(2, sub.stats()['duplicates'])
+        self.mock_client.acknowledge.assert_any_call('foo',
+                                                     ['ack-2', 'ack-3'])
+
+
+class TestStop(unittest.TestCase):
+
+    def test_stop_idle(self):
+        """Ensure that stop doesn't wait for a long-poll pull in flight."""
+
+        emulated = emulator.Emulator(pull_timeout=30)
+        pubsub_client = client.PubSubClient(emulated, 'project')
+        pubsub_client.create_topic('topic')
+        pubsub_client.subscribe('sub', 'topic')
+        sub = subscriber.Subscriber(pubsub_client, 'sub', mock.Mock())
+        sub.start()
+        for _ in range(500):
+            if sub._engine.stats()['in_flight']:
+                break
+            threading.Event().wait(0.01)
+
+        start = time.time()
+        sub.stop(5)
+        elapsed = time.time() - start
+        # Wake the abandoned pull so its thread exits.
+        pubsub_client.publish('topic', b'data')
+        sub._engine.join(5)
+
+        self.assertLess(elapsed, 1)
+        self.assertEqual(0, sub.stats()['processed'])
@@ -0,0 +1,96 @@
+import threading
+import unittest
+
+import mock
+
+from pubsub import transport
+
+
+class TestHttpPool(unittest.TestCase):
+
+    def setUp(self):
+        self.mock_credentials = mock.Mock()
+        self.mock_credentials.authorize.side_effect = lambda http: http
+        self.http_factory = mock.Mock(side_effect=lambda: mock.Mock())
+
+    def test_reuse(self):
+        """Ensure that released connections are reused instead of creating
+        new ones.
+        """
+
+        pool = transport.HttpPool(self.mock_credentials, size=2,
+                                  http_factory=self.http_factory)
+
+        with pool.connection() as first:
+            pass
+        with pool.connection() as second:
+            pass
+
+        self.assertIs(first, second)
+        self.assertEqual(1, self.http_factory.call_count)
+        self.mock_credentials.authorize.assert_called_once_with(first)
+
+    def test_bounded(self):
+        """Ensure that no more than size connections are created and that an
+        acquire waits for a connection to be released.
+        """
+
+        pool = transport.HttpPool(self.mock_credentials, size=1,
+                                  http_factory=self.http_factory)
+        http = pool.acquire()
+        acquired = []
+        thread = threading.Thread(target=lambda: acquired.append(
+            pool.acquire()))
+        thread.start()
+        threading.Event().wait(0.05)
+
+        self.assertEqual([], acquired)
+
+        pool.release(http)
+        thread.join(5)
+
+        self.assertEqual([http], acquired)
+        self.assertEqual(1, self.http_factory.call_count)
+        stats = pool.stats()
+        self.assertEqual(1, stats['waits'])
+        self.assertTrue(stats['wait_time'] > 0)
+        self.assertEqual(1, stats['in_use'])
+
+    def test_timeout(self):
+        """Ensure that PoolTimeout is raised when no connection becomes
+        available in time.
+        """
+
+        pool = transport.HttpPool(self.mock_credentials, size=1, timeout=0.01,
+                                  http_factory=self.http_factory)
+        pool.acquire()
+
+        self.assertRaises(transport.PoolTimeout, pool.acquire)
+        self.assertEqual(1, pool.stats()['timeouts'])
+
+    def test_authorize_error(self):
+        """Ensure that a failure to create a connection frees its slot."""
+
+        self.mock_credentials.authorize.side_effect = Exception('error')
+        pool = transport.HttpPool(self.mock_credentials, size=1,
+                                  http_factory=self.http_factory)
+
+        self.assertRaises(Exception, pool.acquire)
+        self.assertEqual(0, pool.stats()['created'])
+        self.assertEqual(0, pool.stats()['in_use'])
+
+    def test_stats(self):
+        """Ensure that stats reports the pool's connections."""
+
+        pool = transport.HttpPool(self.mock_credentials, size=3,
+                                  http_factory=self.http_factory)
+        first = pool.acquire()
+        pool.acquire()
+        pool.release(first)
+
+        stats = pool.stats()
+
+        self.assertEqual(3, stats['size'])
+        self.assertEqual(2, stats['created'])
+        self.assertEqual(1, stats['in_use'])
+        self.assertEqual(1, stats['idle'])
@@ -0,0 +1,133 @@
+import contextlib
+import threading
+import time
+
+import httplib2
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes available within the pool's
+    timeout.
+    """
+
+
+class HttpPool(object):
+    """A bounded, thread-safe pool of authorized httplib2.Http objects.
+    httplib2.Http isn't thread-safe, so each request checks out a connection
+    for its duration. All connections share one credentials object, and idle
+    connections keep their keep-alive sockets open for reuse.
+    """
+
+    def __init__(self, credentials, size=10, timeout=None,
+                 http_factory=httplib2.Http):
+        """Args:
+            credentials: the credentials used to authorize every connection.
+            size: the maximum number of connections.
+            timeout: the maximum number of seconds to wait for a connection,
+                     or None to wait indefinitely.
+            http_factory: a callable returning a new httplib2.Http.
+        """
+
+        if size < 1:
+            raise ValueError('size must be at least 1')
+
+        self.credentials = credentials
+        self.size = size
+        self.timeout = timeout
+        self.http_factory = http_factory
+
+        self._cond = threading.Condition()
+        self._idle = []
+        self._created = 0
+        self._in_use = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+        self._timeouts = 0
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Check out a connection for the duration of the with block."""
+
+        http = self.acquire()
+        try:
+            yield http
+        finally:
+            self.release(http)
+
+    def acquire(self):
+        """Check out a connection, creating one if the pool isn't full or
+        waiting for one to be released otherwise.
+
+        Returns:
+            an authorized httplib2.Http.
+
+        Raises:
+            PoolTimeout if no connection became available within timeout.
+        """
+
+        with self._cond:
+            if not self._idle and self._created >= self.size:
+                self._wait()
+
+            self._in_use += 1
+            if self._idle:
+                return self._idle.pop()
+            self._created += 1
+
+        try:
+            return self.credentials.authorize(self.http_factory())
+        except Exception:
+            with self._cond:
+                self._created -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, http):
+        """Return a connection to the pool."""
+
+        with self._cond:
+            self._in_use -= 1
+            self._idle.append(http)
+            self._cond.notify()
+
+    def stats(self):
+        """Return a dict of pool metrics: the maximum size, the number of
+        connections created, in use and idle, how many acquires had to wait,
+        the total and maximum time spent waiting in seconds, and the number of
+        acquires which timed out.
+        """
+
+        with self._cond:
+            return {
+                'size': self.size,
+                'created': self._created,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'waits': self._waits,
+                'wait_time': self._wait_time,
+                'max_wait_time': self._max_wait_time,
+                'timeouts': self._timeouts,
+            }
+
+    def _wait(self):
+        # Must be called with self._cond held.
+        start = time.time()
+        deadline = None if self.timeout is None else start + self.timeout
+        self._waits += 1
+        try:
+            while not self._idle and self._created >= self.size:
+                if deadline is None:
+                    self._cond.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout('No connection available after %ss' %
+                                      self.timeout)
+                self._cond.wait(remaining)
+        finally:
+            waited = time.time() - start
+            self._wait_time += waited
+            self._max_wait_time = max(self._max_wait_time, waited)
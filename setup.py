@@ -13,6 +13,7 @@ setup_args = dict(
     packages=find_packages(),
     include_package_data=True,
     install_requires=['google-api-python-client', 'pyopenssl', 'httplib2'],
+    extras_require={'aio': ['aiohttp']},
     author='Tyler Treat',
     author_email='ttreat31@gmail.com',
     classifiers=[